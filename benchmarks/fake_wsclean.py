@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the wsclean executable used by the benchmarks.
+
+Parses the arguments WSClean builds, prints the progress lines of a
+wsclean log, sleeps for a fixed time per output and writes small FITS
+images under the names wsclean would use, so the wrapper, the runner, the
+progress parsing and the code collecting outputs can be timed without
+wsclean or a measurement set.
+"""
+import os
+import sys
+import time
+import numpy as np
+from astropy.io import fits
+
+# seconds spent per output image, stands in for the gridding work
+SECONDS_PER_OUTPUT = float(os.environ.get('FAKE_WSCLEAN_SECONDS', '0.01'))
+# major cycles logged per run, and the factor the residual peak changes by in each
+MAJOR_CYCLES = int(os.environ.get('FAKE_WSCLEAN_MAJOR_CYCLES', '3'))
+PEAK_FACTOR = float(os.environ.get('FAKE_WSCLEAN_PEAK_FACTOR', '0.5'))
+
+
+def parse_args(argv):
+    """Options of interest from a wsclean command line, the MS is the last argument"""
+    opts = {'name': 'wsclean', 'size': (64, 64), 'intervals_out': 1, 'channels_out': 1,
+            'predict': False, 'vis': argv[-1] if argv else None}
+    i = 0
+    while i < len(argv) - 1:
+        arg = argv[i]
+        if arg == '-name':
+            opts['name'] = argv[i + 1]
+        elif arg == '-size':
+            opts['size'] = (int(argv[i + 1]), int(argv[i + 2]))
+        elif arg == '-intervals-out':
+            opts['intervals_out'] = int(argv[i + 1])
+        elif arg == '-channels-out':
+            opts['channels_out'] = int(argv[i + 1])
+        elif arg == '-predict':
+            opts['predict'] = True
+        i += 1
+    return opts
+
+
+def output_prefixes(name, intervals_out, channels_out):
+    """Image name prefixes, as WSClean.output_name"""
+    prefixes = []
+    for interval in range(intervals_out):
+        for channel in range(channels_out):
+            prefix = name
+            if intervals_out > 1:
+                prefix += f"-t{interval:04d}"
+            if channels_out > 1:
+                prefix += f"-{channel:04d}"
+            prefixes.append(prefix)
+    return prefixes
+
+
+def log_progress(opts):
+    """Print the phases, major cycles and peaks of a wsclean imaging run"""
+    print(f"Reordering {opts['vis']} into {opts['intervals_out']} x {opts['channels_out']} parts.", flush=True)
+    print(" == Constructing PSF ==", flush=True)
+    peak = 2.0
+    for cycle in range(1, MAJOR_CYCLES + 1):
+        print(" == Constructing image ==", flush=True)
+        time.sleep(SECONDS_PER_OUTPUT)
+        print(f" == Deconvolving ({cycle}) ==", flush=True)
+        if cycle == 1:
+            print("Estimated standard deviation of background noise: 25.3 mJy", flush=True)
+        print(f"Iteration {(cycle - 1) * 100}, scale 0 px : {peak * 1000:.2f} mJy at 512,512", flush=True)
+        print(f"Next major iteration at: {peak * 0.9 * 1000:.2f} mJy", flush=True)
+        print(" == Converting model image to visibilities ==", flush=True)
+        peak *= PEAK_FACTOR
+    print(f"Stopped on peak {peak * 1000:.2f} mJy, because maximum number of iterations was reached.", flush=True)
+
+
+def main(argv):
+    opts = parse_args(argv)
+    prefixes = output_prefixes(opts['name'], opts['intervals_out'], opts['channels_out'])
+    if opts['predict']:
+        missing = [p for p in prefixes if not os.path.exists(p + '-model.fits')]
+        time.sleep(SECONDS_PER_OUTPUT * len(prefixes))
+        if missing:
+            print(f"fake wsclean: missing model {missing[0]}-model.fits", file=sys.stderr)
+            return 1
+        return 0
+
+    log_progress(opts)
+    nx, ny = opts['size']
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---SIN', 'DEC--SIN'
+    header['CRPIX1'], header['CRPIX2'] = nx / 2 + 1, ny / 2 + 1
+    header['CDELT1'], header['CDELT2'] = -2.5 / 3600, 2.5 / 3600
+    header['CRVAL1'], header['CRVAL2'] = 260.0, -23.0
+    rng = np.random.default_rng(0)
+    for prefix in prefixes:
+        time.sleep(SECONDS_PER_OUTPUT)
+        image = rng.normal(0, 1, (1, 1, ny, nx)).astype(np.float32)
+        model = np.zeros_like(image)
+        model[0, 0, ny // 2, nx // 2] = 1.0
+        for suffix, data in (('image', image), ('model', model), ('residual', image), ('psf', image)):
+            fits.PrimaryHDU(data, header=header).writeto(f"{prefix}-{suffix}.fits", overwrite=True)
+    print("Writing restored image...", flush=True)
+    print(f"fake wsclean: wrote {len(prefixes)} outputs for {opts['vis']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
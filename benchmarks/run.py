@@ -0,0 +1,233 @@
+"""
+Offline benchmark suite of the pipeline's building blocks.
+
+    python -m benchmarks.run                      # compare with benchmarks/baseline.json
+    python -m benchmarks.run --update-baseline    # record a new baseline
+    python -m benchmarks.run --sizes 512 --only rotateimage,wsclean
+
+Every result is the median of --repeat runs. A result slower than the
+baseline by more than --threshold (relative) is reported as a regression
+and makes the run exit with status 1. Benchmarks whose dependencies are
+missing (e.g. casatools for the measurement set ones) are skipped.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from benchmarks import synthetic
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+FAKE_WSCLEAN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_wsclean.py')
+
+
+def time_call(func, repeat):
+    """Median and minimum wall time of repeat calls of func"""
+    durations = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t_start)
+    return {'median_sec': float(np.median(durations)), 'min_sec': float(np.min(durations)), 'repeat': repeat}
+
+
+def bench_rotateimage(workdir, sizes, repeat):
+    from eovsa_synop.rotation_corr_util import rotateimage
+
+    results = {}
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        data = rng.normal(0, 1, (size, size)).astype(np.float32)
+        results[f'rotateimage[{size}]'] = time_call(lambda: rotateimage(data, size // 2, size // 2, 15.0), repeat)
+    return results
+
+
+def bench_rotation_fits(workdir, sizes, repeat):
+    import astropy.units as u
+    from astropy.time import Time
+    from eovsa_synop.rotation_corr_util import solar_diff_rot_heliofits, sunpyfits_to_j2000fits
+
+    results = {}
+    newtime = Time(synthetic.OBSTIME) + 2 * u.hour
+    for size in sizes:
+        in_fits = synthetic.make_helio_fits(os.path.join(workdir, f'helio{size}.fits'), size)
+        rot_fits = os.path.join(workdir, f'helio{size}.rot.fits')
+        # the first call also builds the rotation plan
+        results[f'solar_diff_rot_heliofits[{size},cold]'] = time_call(
+            lambda: solar_diff_rot_heliofits(in_fits, newtime, rot_fits), 1)
+        results[f'solar_diff_rot_heliofits[{size}]'] = time_call(
+            lambda: solar_diff_rot_heliofits(in_fits, newtime, rot_fits), repeat)
+        results[f'sunpyfits_to_j2000fits[{size}]'] = time_call(
+            lambda: sunpyfits_to_j2000fits(rot_fits, os.path.join(workdir, f'helio{size}.j2000.fits')), repeat)
+        sparse_in = synthetic.make_model_fits(os.path.join(workdir, f'model{size}.fits'), size)
+        results[f'model_fits_write[{size}]'] = time_call(
+            lambda: synthetic.make_model_fits(sparse_in, size), repeat)
+    return results
+
+
+def bench_wsclean(workdir, sizes, repeat):
+    from eovsa_synop.wrap_wsclean import WSClean
+
+    # the stub is found as wsclean on PATH and run with this interpreter
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(bin_dir, 'wsclean')
+    with open(stub, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_WSCLEAN}" "$@"\n')
+    os.chmod(stub, 0o755)
+    path = os.environ.get('PATH', '')
+    os.environ['PATH'] = bin_dir + os.pathsep + path
+
+    try:
+        clean_obj = WSClean(vis=os.path.join(workdir, 'fake.ms'))
+        clean_obj.setup(size=256, scale="2.5asec", weight_briggs=0.0, pol="xx", niter=3000, mgain=0.85,
+                        data_column="DATA", name=os.path.join(workdir, 'ws', 'eovsa'), multiscale=True,
+                        auto_mask=6, auto_threshold=3, intervals_out=8, no_update_model=True,
+                        no_negative=True, quiet=True, spws='0,1', threads=4)
+        os.makedirs(os.path.join(workdir, 'ws'), exist_ok=True)
+
+        n_calls = 1000
+        timing = time_call(lambda: [clean_obj.build_command() for _ in range(n_calls)], repeat)
+        results = {'WSClean.build_command': {key: value / n_calls if key.endswith('_sec') else value
+                                             for key, value in timing.items()}}
+        results['WSClean.run[8 intervals]'] = time_call(lambda: clean_obj.run(), repeat)
+        results['WSClean.output_files'] = time_call(lambda: clean_obj.output_files(), repeat)
+    finally:
+        os.environ['PATH'] = path
+    return results
+
+
+def bench_measurement_sets(workdir, sizes, repeat):
+    from eovsa_synop.split_by_scan import split_ms_by_scan
+    from eovsa_synop.merge_scans import merge_split_scans
+
+    template = synthetic.make_ms(os.path.join(workdir, 'template.ms'))
+    results = {}
+    for mode in ('copy', 'single_pass', 'reference'):
+        def split_once():
+            run_dir = tempfile.mkdtemp(dir=workdir)
+            msfile = os.path.join(run_dir, 'UDBBENCH.ms')
+            shutil.copytree(template, msfile)
+            split_ms_by_scan(msfile, mode=mode)
+        results[f'split_ms_by_scan[{mode}]'] = time_call(split_once, repeat)
+
+    split_dir = tempfile.mkdtemp(dir=workdir)
+    shutil.copytree(template, os.path.join(split_dir, 'UDBBENCH.ms'))
+    split_ms_by_scan(os.path.join(split_dir, 'UDBBENCH.ms'), mode='copy')
+    cwd = os.getcwd()
+    # merge_split_scans works on the current directory
+    os.chdir(split_dir)
+    try:
+        for mode in ('stream', 'virtual'):
+            def merge_once():
+                shutil.rmtree('UDBBENCH_merged.ms', ignore_errors=True)
+                merge_split_scans('UDBBENCH', mode=mode)
+            results[f'merge_split_scans[{mode}]'] = time_call(merge_once, repeat)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+BENCHMARKS = {
+    'rotateimage': bench_rotateimage,
+    'rotation_fits': bench_rotation_fits,
+    'wsclean': bench_wsclean,
+    'measurement_sets': bench_measurement_sets,
+}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline.
+
+    Returns
+    -------
+    list of str
+        Names of the results slower than the baseline by more than threshold
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print(f"  {name:<45s} {result['median_sec']:10.4f} s  (new)")
+            continue
+        ratio = result['median_sec'] / max(base['median_sec'], 1e-12)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"  {name:<45s} {result['median_sec']:10.4f} s  x{ratio:5.2f} of baseline{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of eovsa_synop")
+    parser.add_argument('--sizes', default='512,1024,2048', help="image sizes, comma separated")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark")
+    parser.add_argument('--only', default=None, help="benchmark groups to run: " + ','.join(BENCHMARKS))
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="baseline JSON file")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative slowdown reported as regression")
+    parser.add_argument('--update-baseline', action='store_true', help="write the results as the new baseline")
+    parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    # no IERS or other downloads during the benchmarks
+    from astropy.utils import iers
+    iers.conf.auto_download = False
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    groups = args.only.split(',') if args.only else list(BENCHMARKS)
+    results, skipped = {}, {}
+    workdir = tempfile.mkdtemp(prefix='eovsa_synop_bench_')
+    try:
+        for group in groups:
+            print(f"Running {group}")
+            group_dir = os.path.join(workdir, group)
+            os.makedirs(group_dir)
+            try:
+                results.update(BENCHMARKS[group](group_dir, sizes, args.repeat))
+            except ImportError as e:
+                print(f"Skipping {group}: {str(e)}")
+                skipped[group] = str(e)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'results': results,
+        'skipped': skipped,
+        'machine': {'host': socket.gethostname(), 'python': platform.python_version(),
+                    'numpy': np.__version__, 'cpu_count': os.cpu_count()},
+        'time': time.time(),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    regressions = []
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Wrote baseline {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print(f"Compared with {args.baseline} (threshold {args.threshold:.0%}):")
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        print(f"No baseline {args.baseline}, run with --update-baseline to record one")
+        compare(results, {}, args.threshold)
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
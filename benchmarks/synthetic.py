@@ -0,0 +1,113 @@
+"""
+Synthetic inputs for the benchmarks: helioprojective maps, CLEAN model
+images and small measurement sets, all generated offline.
+"""
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.time import Time
+
+# arcsec per pixel, as the pipeline images
+PIXEL_SCALE = 2.5
+OBSTIME = '2024-12-12T20:00:00'
+
+
+def make_helio_fits(path, size, obstime=OBSTIME, exptime=600., seed=0):
+    """
+    Write a helioprojective map of the radio Sun as sunpy saves it.
+
+    The map holds a uniform disk with a few compact sources and noise, an
+    Earth observer at obstime, and the EXPTIME and P_ANGLE keywords the
+    rotation functions need.
+    """
+    import sunpy.map
+    from sunpy.coordinates import Helioprojective, get_earth, sun
+    from astropy.coordinates import SkyCoord
+
+    obstime = Time(obstime)
+    frame = Helioprojective(observer=get_earth(obstime), obstime=obstime)
+    center = SkyCoord(0 * u.arcsec, 0 * u.arcsec, frame=frame)
+    header = sunpy.map.make_fitswcs_header((size, size), center, scale=[PIXEL_SCALE, PIXEL_SCALE] * u.arcsec / u.pix)
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    r = np.hypot(xx - size / 2, yy - size / 2) * PIXEL_SCALE
+    data = np.where(r < sun.angular_radius(obstime).to_value(u.arcsec), 1.0, 0.0)
+    for _ in range(5):
+        x0, y0 = rng.uniform(0.3, 0.7, 2) * size
+        data += 10 * np.exp(-((xx - x0) ** 2 + (yy - y0) ** 2) / (2 * (size / 100) ** 2))
+    data += rng.normal(0, 0.01, data.shape)
+
+    smap = sunpy.map.Map(data.astype(np.float32), header)
+    smap.meta['exptime'] = exptime
+    smap.meta['p_angle'] = sun.P(obstime).to_value(u.deg)
+    smap.save(path, overwrite=True)
+    return path
+
+
+def make_model_fits(path, size, n_components=500, obstime=OBSTIME, seed=0):
+    """
+    Write a sparse CLEAN model image with a wsclean-like 4D RA-DEC header.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.zeros((1, 1, size, size), dtype=np.float32)
+    y = rng.integers(size // 4, 3 * size // 4, n_components)
+    x = rng.integers(size // 4, 3 * size // 4, n_components)
+    data[0, 0, y, x] = rng.exponential(1.0, n_components)
+
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---SIN', 'DEC--SIN'
+    header['CUNIT1'], header['CUNIT2'] = 'deg', 'deg'
+    header['CRPIX1'], header['CRPIX2'] = size / 2 + 1, size / 2 + 1
+    header['CDELT1'], header['CDELT2'] = -PIXEL_SCALE / 3600, PIXEL_SCALE / 3600
+    header['CRVAL1'], header['CRVAL2'] = 260.6, -23.0
+    header['CTYPE3'], header['CRPIX3'], header['CDELT3'], header['CRVAL3'] = 'FREQ', 1.0, 1e8, 2e9
+    header['CTYPE4'], header['CRPIX4'], header['CDELT4'], header['CRVAL4'] = 'STOKES', 1.0, 1.0, 1.0
+    header['BUNIT'] = 'JY/PIXEL'
+    header['DATE-OBS'] = Time(obstime).isot
+    header['TELESCOP'] = 'EOVSA'
+    fits.PrimaryHDU(data, header=header).writeto(path, overwrite=True)
+    return path
+
+
+def make_ms(path, n_scans=3, n_ant=5, n_chan=8, scan_sec=60, int_sec=10, seed=0):
+    """
+    Simulate a small measurement set with casatools.simulator.
+
+    One spectral window and one solar field are observed in n_scans scans;
+    DATA is filled with noise.
+    """
+    from casatools import simulator, measures, table
+
+    sm = simulator()
+    me = measures()
+    rng = np.random.default_rng(seed)
+    sm.open(path)
+    try:
+        east = rng.uniform(-500, 500, n_ant)
+        north = rng.uniform(-500, 500, n_ant)
+        sm.setconfig(telescopename='EOVSA', x=east.tolist(), y=north.tolist(), z=[0.] * n_ant,
+                     dishdiameter=[2.1] * n_ant, mount=['alt-az'] * n_ant,
+                     antname=[f'eo{i + 1:02d}' for i in range(n_ant)], coordsystem='local',
+                     referencelocation=me.position('WGS84', '-118.2864deg', '37.2332deg', '1207m'))
+        sm.setspwindow(spwname='spw0', freq='2GHz', deltafreq='10MHz', freqresolution='10MHz',
+                       nchannels=n_chan, stokes='XX YY')
+        sm.setfeed(mode='perfect X Y')
+        sm.setfield(sourcename='Sun', sourcedirection=me.direction('J2000', '17h22m', '-23d00m'))
+        sm.settimes(integrationtime=f'{int_sec}s', usehourangle=False,
+                    referencetime=me.epoch('utc', '2024/12/12/20:00:00'))
+        for scan in range(n_scans):
+            start = scan * scan_sec * 1.5
+            sm.observe('Sun', 'spw0', starttime=f'{start}s', stoptime=f'{start + scan_sec}s')
+    finally:
+        sm.close()
+
+    tb = table()
+    tb.open(path, nomodify=False)
+    try:
+        shape = tb.getcol('DATA').shape
+        noise = rng.normal(1, 0.1, shape) + 1j * rng.normal(0, 0.1, shape)
+        tb.putcol('DATA', noise.astype(np.complex64))
+    finally:
+        tb.close()
+    return path
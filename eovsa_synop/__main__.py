@@ -0,0 +1,5 @@
+import sys
+
+from eovsa_synop.cli import main
+
+sys.exit(main())
@@ -0,0 +1,419 @@
+import os
+import shutil
+import numpy as np
+
+from eovsa_synop.telemetry import timed
+
+SPEED_OF_LIGHT = 299792458.0
+
+# image geometry of the synoptic maps, see pipeline.process_unit
+IMAGE_SIZE = 1024
+PIXEL_SCALE_ARCSEC = 2.5
+
+# visibility columns averaged with the data weights
+DATA_COLUMNS = ('DATA', 'CORRECTED_DATA', 'MODEL_DATA')
+# columns dropped from the averaged MS, WEIGHT holds the averaged weights
+DROPPED_COLUMNS = ('WEIGHT_SPECTRUM', 'SIGMA_SPECTRUM', 'FLAG_CATEGORY')
+_MEAN_COLUMNS = ('TIME', 'TIME_CENTROID', 'UVW')
+_SUM_COLUMNS = ('INTERVAL', 'EXPOSURE')
+
+
+def bandwidth_loss(x):
+    """
+    Peak loss of a point source from bandwidth smearing.
+
+    Bridle & Schwab (1999) for a square bandpass and a Gaussian beam, with
+    x = (channel width / frequency) * (source offset / beam width).
+    """
+    from scipy import special
+
+    x = np.maximum(np.asarray(x, dtype=float), 1e-12)
+    return 1 - 1.0645 * special.erf(0.8326 * x) / x
+
+
+def time_loss(tau, offset_in_beams):
+    """
+    Peak loss of a point source from time-average smearing over tau seconds.
+
+    Bridle & Schwab (1999) for a source offset_in_beams beam widths from
+    the phase center, in the worst case of an array at the pole.
+    """
+    return 1.2215e-9 * offset_in_beams**2 * np.asarray(tau, dtype=float)**2
+
+
+def max_baseline(vis, antennas=None):
+    """
+    Longest baseline of a measurement set in meters.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    antennas : list of int, optional
+        Only baselines between these antennas, e.g. the kept ones
+    """
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(vis, 'ANTENNA'))
+    try:
+        positions = tb.getcol('POSITION').T
+    finally:
+        tb.close()
+    if antennas is not None:
+        positions = positions[[ant for ant in antennas if ant < len(positions)]]
+    diff = positions[:, None, :] - positions[None, :, :]
+    return float(np.sqrt((diff**2).sum(axis=-1)).max())
+
+
+def _spw_table(vis):
+    """Channel frequencies and widths per spw, and the spw of every data description."""
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    try:
+        freqs = [tb.getcell('CHAN_FREQ', spw) for spw in range(tb.nrows())]
+        widths = [np.abs(tb.getcell('CHAN_WIDTH', spw)) for spw in range(tb.nrows())]
+    finally:
+        tb.close()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    try:
+        spw_of_ddid = tb.getcol('SPECTRAL_WINDOW_ID')
+    finally:
+        tb.close()
+    return freqs, widths, spw_of_ddid
+
+
+def safe_bins(vis, image_size=IMAGE_SIZE, pixel_scale_arcsec=PIXEL_SCALE_ARCSEC, max_loss=0.02,
+              antennas=None, baseline_m=None):
+    """
+    Time and channel bins of every spw within a smearing budget.
+
+    A point source at the edge of the image (the corner of the field is
+    ignored) may lose at most max_loss of its peak to bandwidth smearing,
+    and as much to time-average smearing, at the highest frequency of the
+    spw on the longest baseline. Low-frequency spws, with wider beams, are
+    averaged more.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    image_size : int, optional
+        Image size in pixels, defaults to IMAGE_SIZE
+    pixel_scale_arcsec : float, optional
+        Pixel size in arcsec, defaults to PIXEL_SCALE_ARCSEC
+    max_loss : float, optional
+        Tolerated fractional peak loss of each kind of smearing, defaults to 0.02
+    antennas : list of int, optional
+        Antennas whose baselines set the resolution, defaults to all
+    baseline_m : float, optional
+        Longest baseline, computed from the ANTENNA table by default
+
+    Returns
+    -------
+    dict
+        {spw: {'timebin_sec': float, 'chanbin': int}}
+    """
+    if baseline_m is None:
+        baseline_m = max_baseline(vis, antennas=antennas)
+    offset = np.deg2rad(image_size / 2 * pixel_scale_arcsec / 3600)
+
+    # largest x = dnu/nu * offset/beam within the budget, the loss grows with x
+    x_lo, x_hi = 0., 10.
+    for _ in range(60):
+        x_mid = (x_lo + x_hi) / 2
+        x_lo, x_hi = (x_mid, x_hi) if bandwidth_loss(x_mid) <= max_loss else (x_lo, x_mid)
+    # beam = c / (nu B), so the tolerated channel width does not depend on nu
+    max_width_hz = x_lo * SPEED_OF_LIGHT / (baseline_m * offset)
+
+    freqs, widths, _ = _spw_table(vis)
+    bins = {}
+    for spw, (chan_freqs, chan_widths) in enumerate(zip(freqs, widths)):
+        beam = SPEED_OF_LIGHT / (np.max(chan_freqs) * baseline_m)
+        timebin_sec = np.sqrt(max_loss / time_loss(1., offset / beam))
+        chanbin = int(max(1, min(len(chan_freqs), max_width_hz // np.max(chan_widths))))
+        bins[spw] = {'timebin_sec': float(timebin_sec), 'chanbin': chanbin}
+    return bins
+
+
+def average_rows(columns, timebin_sec, chanbin, t_ref=0., time_grid=None):
+    """
+    Average the rows of one spw over time bins and channel bins.
+
+    Rows of the same baseline, field and scan whose TIME falls in the same
+    bin of timebin_sec (counted from t_ref) are combined, and channels are
+    combined in groups of chanbin (the last group may be smaller).
+    Visibilities are averaged with their WEIGHT over the unflagged samples;
+    a cell with no unflagged sample keeps the plain mean and is flagged.
+    With time_grid, TIME of an output row is the mean of the grid times in
+    its bin, so it is the same for every baseline and spw of the bin.
+
+    Parameters
+    ----------
+    columns : dict
+        Main table columns in casatools layout (row axis last); DATA-like
+        columns and FLAG are (ncorr, nchan, nrow), WEIGHT and SIGMA
+        (ncorr, nrow), and TIME, ANTENNA1 and ANTENNA2 are required
+    timebin_sec : float
+        Time bin width in seconds
+    chanbin : int
+        Number of channels averaged together
+    t_ref : float, optional
+        Start of the first time bin, e.g. the first TIME of the scan
+    time_grid : numpy.ndarray, optional
+        Sorted unique TIMEs of the whole measurement set; TIME is the mean
+        of the rows of a bin without it
+
+    Returns
+    -------
+    dict
+        The averaged columns, same keys and layout, in the order of time
+        bin, scan, field, ANTENNA1 and ANTENNA2
+    """
+    time = columns['TIME']
+    tbin = np.floor((time - t_ref) / timebin_sec).astype(np.int64)
+    keys = [columns[name] for name in ('SCAN_NUMBER', 'FIELD_ID') if name in columns]
+    order = np.lexsort([columns['ANTENNA2'], columns['ANTENNA1']] + keys + [tbin])
+    sorted_keys = np.stack([tbin[order], columns['ANTENNA1'][order], columns['ANTENNA2'][order]] +
+                           [key[order] for key in keys])
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = np.any(sorted_keys[:, 1:] != sorted_keys[:, :-1], axis=0)
+    row_starts = np.nonzero(new_group)[0]
+    n_rows = np.diff(np.append(row_starts, len(order)))
+
+    flag = columns['FLAG'][..., order]
+    nchan = flag.shape[1]
+    chan_starts = np.arange(0, nchan, chanbin)
+    n_chans = np.diff(np.append(chan_starts, nchan))
+
+    def bin_sum(values):
+        return np.add.reduceat(np.add.reduceat(values, chan_starts, axis=1), row_starts, axis=2)
+
+    weight = columns['WEIGHT'][..., order] if 'WEIGHT' in columns else np.ones(flag.shape[::2], np.float32)
+    w = np.where(flag, np.float32(0), weight[:, None, :].astype(np.float32))
+    sum_w = bin_sum(w)
+    n_samples = n_chans[None, :, None] * n_rows[None, None, :]
+    out_flag = sum_w <= 0
+
+    out = {}
+    for name, values in columns.items():
+        values = values[..., order]
+        if name in DATA_COLUMNS:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[name] = np.where(out_flag, bin_sum(values) / n_samples,
+                                     bin_sum(values * w) / sum_w).astype(values.dtype)
+        elif name == 'FLAG':
+            out[name] = out_flag
+        elif name == 'WEIGHT':
+            out[name] = sum_w.mean(axis=1).astype(values.dtype)
+        elif name == 'SIGMA':
+            out_weight = sum_w.mean(axis=1)
+            with np.errstate(divide='ignore'):
+                out[name] = np.where(out_weight > 0, 1 / np.sqrt(out_weight), 0).astype(values.dtype)
+        elif name == 'FLAG_ROW':
+            out[name] = out_flag.all(axis=(0, 1))
+        elif name in _MEAN_COLUMNS:
+            out[name] = np.add.reduceat(values, row_starts, axis=-1) / n_rows
+        elif name in _SUM_COLUMNS:
+            out[name] = np.add.reduceat(values, row_starts, axis=-1)
+        else:
+            out[name] = values[..., row_starts]
+    if time_grid is not None:
+        grid_bin = np.floor((time_grid - t_ref) / timebin_sec).astype(np.int64)
+        first = np.searchsorted(grid_bin, sorted_keys[0, row_starts], side='left')
+        last = np.searchsorted(grid_bin, sorted_keys[0, row_starts], side='right')
+        cumulative = np.concatenate([[0.], np.cumsum(time_grid - t_ref)])
+        out['TIME'] = t_ref + (cumulative[last] - cumulative[first]) / (last - first)
+    return out
+
+
+def _append_rows(out, parts):
+    """
+    Append the averaged rows of several spws to a table in the order of the input MS.
+
+    Rows are written sorted by TIME, DATA_DESC_ID, ANTENNA1 and ANTENNA2.
+    Columns of the same shape in every part are written at once, the
+    others (e.g. DATA with a different channel count per spw) in runs of
+    consecutive rows of one part.
+    """
+    part_idx = np.concatenate([np.full(len(part['TIME']), k) for k, part in enumerate(parts)])
+    row_idx = np.concatenate([np.arange(len(part['TIME'])) for part in parts])
+    order = np.lexsort([np.concatenate([part[name] for part in parts])
+                        for name in ('ANTENNA2', 'ANTENNA1', 'DATA_DESC_ID', 'TIME')])
+    part_idx, row_idx = part_idx[order], row_idx[order]
+    new_run = np.ones(len(order), dtype=bool)
+    new_run[1:] = (part_idx[1:] != part_idx[:-1]) | (row_idx[1:] != row_idx[:-1] + 1)
+    run_starts = np.nonzero(new_run)[0]
+    run_ends = np.append(run_starts[1:], len(order))
+
+    startrow = out.nrows()
+    out.addrows(len(order))
+    for colname in parts[0]:
+        values = [part[colname] for part in parts]
+        if all(value.shape[:-1] == values[0].shape[:-1] for value in values):
+            out.putcol(colname, np.concatenate(values, axis=-1)[..., order], startrow=startrow)
+            continue
+        for run_start, run_end in zip(run_starts, run_ends):
+            row = row_idx[run_start]
+            out.putcol(colname, values[part_idx[run_start]][..., row:row + run_end - run_start],
+                       startrow=startrow + int(run_start), nrow=int(run_end - run_start))
+
+
+def _average_spw_freqs(outputvis, chanbins):
+    """Rewrite the channels of the SPECTRAL_WINDOW table of an averaged MS."""
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(outputvis, 'SPECTRAL_WINDOW'), nomodify=False)
+    try:
+        for spw, chanbin in chanbins.items():
+            if chanbin == 1:
+                continue
+            freqs = tb.getcell('CHAN_FREQ', spw)
+            starts = np.arange(0, len(freqs), chanbin)
+            counts = np.diff(np.append(starts, len(freqs)))
+            tb.putcell('CHAN_FREQ', spw, np.add.reduceat(freqs, starts) / counts)
+            for colname in ('CHAN_WIDTH', 'EFFECTIVE_BW', 'RESOLUTION'):
+                tb.putcell(colname, spw, np.add.reduceat(tb.getcell(colname, spw), starts))
+            tb.putcell('NUM_CHAN', spw, len(starts))
+    finally:
+        tb.close()
+
+
+def _variable_shape_columns(out, colnames):
+    """Replace fixed-shape array columns, whose channel count changes, by variable-shape ones."""
+    for colname in colnames:
+        desc = out.getcoldesc(colname)
+        if 'shape' not in desc:
+            continue
+        desc.pop('shape')
+        desc['option'] = 0
+        desc['dataManagerType'] = 'TiledShapeStMan'
+        desc['dataManagerGroup'] = f'Tiled{colname}'
+        out.removecols([colname])
+        out.addcols({colname: desc}, {'TYPE': 'TiledShapeStMan', 'NAME': f'Tiled{colname}',
+                                      'SPEC': {'DEFAULTTILESHAPE': [4, 32, 128]}})
+
+
+def _bytes_per_row(tb, colnames):
+    """In-memory size of one row of the given columns."""
+    nbytes = 0
+    for colname in colnames:
+        try:
+            nbytes += np.asarray(tb.getcol(colname, 0, 1)).nbytes
+        except Exception:
+            pass
+    return max(nbytes, 1)
+
+
+@timed('average')
+def average_ms(vis, outputvis, bins=None, max_memory_mb=512, **bin_kwargs):
+    """
+    Write a time and channel averaged copy of a measurement set.
+
+    All spws are averaged on one time grid, the shortest time bin of the
+    spws, so the averaged MS has the same TIMEs in every spw and its rows
+    are ordered by TIME, DATA_DESC_ID and baseline like the input: wsclean
+    -interval and intervals.unflagged_counts count the same timesteps.
+    Channels are binned per spw. Every spw is read once, in time-sorted
+    chunks of whole time bins, and averaged with average_rows. Subtables
+    are copied, with the channels of SPECTRAL_WINDOW averaged alike.
+    WEIGHT_SPECTRUM, SIGMA_SPECTRUM and FLAG_CATEGORY are not carried over.
+
+    Parameters
+    ----------
+    vis : str
+        Input measurement set, e.g. a scan of split_ms_by_scan
+    outputvis : str
+        Averaged measurement set, replaced if it exists
+    bins : dict, optional
+        {spw: {'timebin_sec': float, 'chanbin': int}}, from safe_bins by
+        default; the smallest timebin_sec of the spws present is used for all
+    max_memory_mb : float, optional
+        Memory ceiling of the input rows read at once, defaults to 512
+    **bin_kwargs
+        Passed on to safe_bins, e.g. max_loss or antennas
+
+    Returns
+    -------
+    dict
+        Rows and bytes of the visibility columns before and after, the bins
+        and the common 'timebin_sec'
+    """
+    from casatools import table
+
+    if bins is None:
+        bins = safe_bins(vis, **bin_kwargs)
+    _, _, spw_of_ddid = _spw_table(vis)
+
+    if os.path.exists(outputvis):
+        shutil.rmtree(outputvis)
+    tb = table()
+    tb.open(vis)
+    stats = {'rows_in': 0, 'rows_out': 0, 'bytes_in': 0, 'bytes_out': 0}
+    try:
+        tb.copy(outputvis, deep=True, valuecopy=True, norows=True)
+        out = table(outputvis, nomodify=False)
+        try:
+            present = [colname for colname in DROPPED_COLUMNS if colname in out.colnames()]
+            if present:
+                out.removecols(present)
+            colnames = out.colnames()
+            if any(spw_bins['chanbin'] > 1 for spw_bins in bins.values()):
+                _variable_shape_columns(out, [colname for colname in colnames
+                                              if colname in DATA_COLUMNS + ('FLAG',)])
+
+            ddids = [int(ddid) for ddid in np.unique(tb.getcol('DATA_DESC_ID'))]
+            timebin_sec = min([bins[int(spw_of_ddid[ddid])]['timebin_sec'] for ddid in ddids], default=1.)
+            time_grid = np.unique(tb.getcol('TIME'))
+            t_ref = time_grid[0] if len(time_grid) else 0.
+            grid_bins = np.unique(np.floor((time_grid - t_ref) / timebin_sec))
+            # whole time bins of all spws per chunk, within the memory ceiling
+            rows_per_bin = tb.nrows() / max(len(grid_bins), 1)
+            chunk_rows = max_memory_mb * 1024**2 // _bytes_per_row(tb, colnames)
+            bins_per_chunk = max(1, int(chunk_rows // rows_per_bin))
+
+            subtables, tbins, starts = {}, {}, {}
+            try:
+                for ddid in ddids:
+                    subtables[ddid] = tb.query(f'DATA_DESC_ID=={ddid}', sortlist='TIME,ANTENNA1,ANTENNA2')
+                    tbins[ddid] = np.floor((subtables[ddid].getcol('TIME') - t_ref) / timebin_sec)
+                    starts[ddid] = 0
+                for k in range(0, len(grid_bins), bins_per_chunk):
+                    last_bin = grid_bins[min(k + bins_per_chunk, len(grid_bins)) - 1]
+                    parts = []
+                    for ddid in ddids:
+                        start = starts[ddid]
+                        end = int(np.searchsorted(tbins[ddid], last_bin, side='right'))
+                        if end == start:
+                            continue
+                        columns = {colname: subtables[ddid].getcol(colname, start, end - start)
+                                   for colname in colnames}
+                        averaged = average_rows(columns, timebin_sec, bins[int(spw_of_ddid[ddid])]['chanbin'],
+                                                t_ref=t_ref, time_grid=time_grid)
+                        parts.append(averaged)
+                        starts[ddid] = end
+                        stats['rows_in'] += end - start
+                        stats['rows_out'] += len(averaged['TIME'])
+                        for colname in DATA_COLUMNS + ('FLAG',):
+                            if colname in columns:
+                                stats['bytes_in'] += columns[colname].nbytes
+                                stats['bytes_out'] += averaged[colname].nbytes
+                    if parts:
+                        _append_rows(out, parts)
+            finally:
+                for subtb in subtables.values():
+                    subtb.close()
+        finally:
+            out.close()
+    finally:
+        tb.close()
+
+    _average_spw_freqs(outputvis, {spw: spw_bins['chanbin'] for spw, spw_bins in bins.items()})
+    stats['bins'] = bins
+    stats['timebin_sec'] = float(timebin_sec)
+    print(f"Averaged {vis} -> {outputvis}: {stats['rows_in']} -> {stats['rows_out']} rows, "
+          f"visibilities {stats['bytes_in'] / max(stats['bytes_out'], 1):.1f}x smaller")
+    return stats
@@ -0,0 +1,242 @@
+import os
+import time
+import threading
+import multiprocessing
+from glob import glob
+
+from eovsa_synop import telemetry
+from eovsa_synop.work_queue import WorkQueue, STATES
+
+
+def find_days(patterns):
+    """
+    Full-day measurement sets matching glob patterns, e.g. "data/UDB202412*.ms".
+
+    Scan files written by split_ms_by_scan and merged files are left out.
+    """
+    ms_files = set()
+    for pattern in patterns:
+        for vis in glob(pattern):
+            name = os.path.basename(vis.rstrip('/'))
+            if name.endswith('.ms') and '_scan' not in name and '_merged' not in name:
+                ms_files.add(os.path.abspath(vis.rstrip('/')))
+    return sorted(ms_files)
+
+
+def enqueue_days(queue_root, ms_files, runtime_base="./runtime", spws_all=None, joint_spw=False,
+                 keep_antennas=range(13), split_mode='copy', flag_mode='flagdata', average=False, average_loss=0.02,
+                 threads=4, **unit_kwargs):
+    """
+    Add the work items of several days to a queue.
+
+    Every day gets a 'prepare' item (antenna flagging, split by scan and
+    per-scan flagging, see pipeline.prepare_day) and one 'unit' item per
+    (scan, spw group), or per scan with joint_spw, claimable once the
+    prepare item of its day is done. Items already in the queue are kept,
+    so a day can be enqueued again safely.
+
+    Parameters
+    ----------
+    queue_root : str
+        Queue directory, shared by the workers
+    ms_files : list of str
+        Full-day measurement sets, e.g. from find_days
+    runtime_base : str, optional
+        Parent of the per-day runtime directories runtime_base/YYYYMMDD
+    spws_all : list of str, optional
+        Spectral window groups, defaults to pipeline.SPWS_ALL
+    joint_spw, keep_antennas, split_mode, flag_mode, average, average_loss
+        See pipeline.run_day
+    threads : int, optional
+        Threads per unit (wsclean -j, flagging)
+    **unit_kwargs
+        Passed on to process_unit, e.g. fused=True; plan_cache_dir defaults
+        to the rotplans directory of the day, as in run_day
+
+    Returns
+    -------
+    int
+        Number of items added
+    """
+    from astropy.time import Time
+    from eovsa_synop import pipeline
+    from eovsa_synop.ms_index import get_ms_index
+
+    if spws_all is None:
+        spws_all = pipeline.SPWS_ALL
+    queue = WorkQueue(queue_root)
+    n_added = 0
+    for vis in ms_files:
+        vis = os.path.abspath(vis.rstrip('/'))
+        ms_index = get_ms_index(vis)
+        day = Time(ms_index.timerange()[0], format='mjd').iso[0:10]
+        tag = day.replace('-', '')
+        runtime_root = os.path.join(os.path.abspath(runtime_base), tag)
+        lock_ms = vis if split_mode == 'reference' and not average else None
+        day_unit_kwargs = dict(unit_kwargs, threads=threads, lock_ms=lock_ms)
+        day_unit_kwargs.setdefault('plan_cache_dir', os.path.join(runtime_root, "rotplans"))
+
+        prepare_id = f"{tag}_prepare"
+        n_added += queue.put(prepare_id, {
+            'kind': 'prepare', 'vis': vis, 'day': day, 'runtime_root': runtime_root,
+            'keep_antennas': list(keep_antennas), 'split_mode': split_mode, 'flag_mode': flag_mode,
+            'average': average, 'average_loss': average_loss, 'threads': threads,
+        })
+
+        # the names split_ms_by_scan (and prepare_day when averaging) will give the scan files
+        base_name = os.path.splitext(vis)[0]
+        scan_files = [(scan, f"{base_name}_scan{scan}.ms") for scan in ms_index.scans]
+        if average:
+            scan_files = [(scan, os.path.join(runtime_root, "averaged", os.path.basename(msfile)))
+                          for scan, msfile in scan_files]
+        for msfile, scan_num, spws_this, runtime_dir in pipeline.day_units(scan_files, spws_all, runtime_root,
+                                                                           joint_spw=joint_spw):
+            group = os.path.basename(runtime_dir).split('_', 1)[1]
+            n_added += queue.put(f"{tag}_scan{scan_num:03d}_{group}", {
+                'kind': 'unit', 'vis': vis, 'day': day, 'runtime_root': runtime_root,
+                'msfile': msfile, 'scan': scan_num, 'spws': spws_this, 'runtime_dir': runtime_dir,
+                'unit_kwargs': day_unit_kwargs,
+            }, requires=[prepare_id])
+        print(f"Queued {day}: {len(ms_index.scans)} scans")
+    return n_added
+
+
+def execute_item(item):
+    """
+    Run the work of a queue item.
+
+    Returns
+    -------
+    dict
+        Result recorded with the item when it is done
+    """
+    from eovsa_synop import pipeline
+    from eovsa_synop.checkpoint import CheckpointStore
+
+    payload = item['payload']
+    telemetry.configure(os.path.join(payload['runtime_root'], "telemetry.jsonl"))
+    with telemetry.labels(day=payload['day']):
+        if payload['kind'] == 'prepare':
+            _, scan_files = pipeline.prepare_day(payload['vis'], runtime_root=payload['runtime_root'],
+                                                 keep_antennas=payload['keep_antennas'],
+                                                 split_mode=payload['split_mode'], flag_mode=payload['flag_mode'],
+                                                 average=payload['average'], average_loss=payload['average_loss'],
+                                                 n_threads=payload['threads'])
+            return {'scans': [scan_num for scan_num, _ in scan_files]}
+
+        if not os.path.exists(payload['msfile']):
+            # the scan had no rows to split
+            return {'scan': payload['scan'], 'spws': payload['spws'], 'status': 'no_data'}
+        ckpt = CheckpointStore(os.path.join(payload['runtime_root'], "checkpoints.json"))
+        with telemetry.labels(scan=payload['scan'], spws=payload['spws']):
+            return pipeline.process_unit(payload['msfile'], payload['scan'], payload['spws'],
+                                         payload['runtime_dir'],
+                                         upstream=pipeline.unit_upstream(ckpt, payload['msfile']),
+                                         **payload['unit_kwargs'])
+
+
+def run_worker(queue_root, threads_per_worker=4, heartbeat_sec=60., poll_sec=30., max_items=None,
+               worker=None, **queue_kwargs):
+    """
+    Claim and run queue items until the queue is drained.
+
+    A thread touches the claimed item every heartbeat_sec while it runs.
+    When nothing can be claimed but other workers still hold items (whose
+    failure would make them claimable again), the worker polls every
+    poll_sec.
+
+    Parameters
+    ----------
+    queue_root : str
+        Queue directory
+    threads_per_worker : int, optional
+        Threads of the numerical libraries of this worker
+    heartbeat_sec : float, optional
+        Heartbeat period, well below the heartbeat_timeout of the queue
+    poll_sec : float, optional
+        Waiting time when no item can be claimed
+    max_items : int, optional
+        Stop after this many items, defaults to running until drained
+    worker : str, optional
+        Worker name, defaults to host:pid
+    **queue_kwargs
+        Passed on to WorkQueue, e.g. heartbeat_timeout or max_attempts
+
+    Returns
+    -------
+    int
+        Number of items run
+    """
+    from eovsa_synop import pipeline
+
+    pipeline._init_worker(threads_per_worker)
+    queue = WorkQueue(queue_root, **queue_kwargs)
+    n_items = 0
+    while max_items is None or n_items < max_items:
+        item = queue.claim(worker)
+        if item is None:
+            if queue.is_drained():
+                print("Nothing left to claim")
+                break
+            time.sleep(poll_sec)
+            continue
+
+        stop = threading.Event()
+
+        def beat(item=item, stop=stop):
+            while not stop.wait(heartbeat_sec):
+                if not queue.heartbeat(item):
+                    print(f"{item['id']} was taken back from this worker")
+                    return
+
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+        t_start = time.time()
+        print(f"Running {item['id']} (attempt {item['attempts'] + 1})")
+        try:
+            result = execute_item(item)
+        except Exception as e:
+            print(f"Error processing {item['id']}: {str(e)}")
+            queue.fail(item, e)
+        else:
+            if queue.complete(item, result):
+                print(f"Done {item['id']} in {time.time() - t_start:.0f} s")
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+        n_items += 1
+    return n_items
+
+
+def run_workers(queue_root, n_processes=1, **kwargs):
+    """Run n_processes workers of this node, see run_worker."""
+    if n_processes <= 1:
+        return run_worker(queue_root, **kwargs)
+    processes = [multiprocessing.Process(target=run_worker, args=(queue_root,), kwargs=kwargs)
+                 for _ in range(n_processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def print_status(queue_root, straggler_factor=3., **queue_kwargs):
+    """Print the counts, throughput, active workers, stragglers and failures of a queue."""
+    queue = WorkQueue(queue_root, **queue_kwargs)
+    status = queue.status(straggler_factor=straggler_factor)
+    print('  '.join(f"{state} {status['counts'][state]}" for state in STATES))
+    throughput = status['throughput_per_hour']
+    median = f"{status['median_sec']:.0f} s" if status['median_sec'] is not None else "-"
+    print(f"throughput {throughput['last_hour']} items in the last hour, "
+          f"{throughput['overall']:.1f} items/h overall, median item {median}")
+    remaining = status['counts']['pending'] + status['counts']['running']
+    if remaining and throughput['overall'] > 0:
+        print(f"about {remaining / throughput['overall']:.1f} h left at the overall rate")
+    print(f"active workers ({len(status['workers'])}): {' '.join(status['workers'])}")
+    if status['stragglers']:
+        print("stragglers:")
+        for item_id, worker, running_sec, heartbeat_age in status['stragglers']:
+            print(f"  {item_id:<40s} {worker}  running {running_sec:.0f} s, heartbeat {heartbeat_age:.0f} s ago")
+    for item in queue.items('failed'):
+        print(f"failed {item['id']} after {item['attempts']} attempts: {item['errors'][-1]['error']}")
+    return status
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import hashlib
+
+
+def fingerprint(path):
+    """
+    Fingerprint a file or directory.
+
+    Files are hashed by content. Directories (measurement sets) are hashed by
+    the relative path, size and modification time of every file below them,
+    which is cheap and changes whenever any table file is rewritten.
+
+    Parameters
+    ----------
+    path : str
+        File or directory
+
+    Returns
+    -------
+    str
+        Hex digest, or 'missing' if path does not exist
+    """
+    if not os.path.exists(path):
+        return 'missing'
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                st = os.stat(full)
+                h.update(f"{os.path.relpath(full, path)}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    else:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+class CheckpointStore:
+    """
+    Record of completed pipeline stages, kept in a JSON file.
+
+    A stage is identified by name and described by its input files, its
+    parameters and the stages it depends on. It is still valid, and can be
+    skipped, when all three are unchanged since it was recorded and its
+    outputs still exist. Input fingerprints are taken when the stage is
+    recorded, so stages that modify their input in place (e.g. flagging) are
+    valid against the modified state.
+
+    Parameters
+    ----------
+    path : str
+        JSON file of the store, created on the first record
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.records = json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.records, f, indent=1)
+        os.replace(tmp_file, self.path)
+
+    def digest(self, stage, inputs=(), params=None, deps=()):
+        """
+        Digest of a stage's inputs, parameters and dependencies as they are now.
+
+        Parameters
+        ----------
+        stage : str
+            Stage name
+        inputs : list of str, optional
+            Input files or directories
+        params : dict, optional
+            Parameters of the stage, must be JSON serializable (str otherwise)
+        deps : list of str, optional
+            Names of stages in this store the stage depends on
+
+        Returns
+        -------
+        str
+            Hex digest
+        """
+        state = {
+            'stage': stage,
+            'inputs': {path: fingerprint(path) for path in inputs},
+            'params': params,
+            'deps': {dep: self.records.get(dep, {}).get('digest') for dep in deps},
+        }
+        return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_valid(self, stage, inputs=(), params=None, deps=()):
+        """True if the stage was recorded with the same digest and its outputs exist"""
+        record = self.records.get(stage)
+        if record is None or record['digest'] != self.digest(stage, inputs, params, deps):
+            return False
+        return all(os.path.exists(path) for path in record['outputs'])
+
+    def record(self, stage, inputs=(), params=None, deps=(), outputs=(), stopped=None):
+        """
+        Record a completed stage.
+
+        A stage given a stopped reason (e.g. a timeout) is recorded too, so
+        that it is skipped like a completed one until its inputs, parameters
+        or dependencies change; see stop_reason.
+        """
+        self.records[stage] = {
+            'digest': self.digest(stage, inputs, params, deps),
+            'outputs': list(outputs),
+            'time': time.time(),
+        }
+        if stopped is not None:
+            self.records[stage]['stopped'] = stopped
+        self._save()
+
+    def stop_reason(self, stage):
+        """Reason a recorded stage was stopped, None if it completed or is not recorded"""
+        return self.records.get(stage, {}).get('stopped')
+
+    def outputs(self, stage):
+        """Output paths recorded for a stage"""
+        return self.records[stage]['outputs']
+
+    def invalidate(self, stage):
+        """Forget a stage so it runs again"""
+        if self.records.pop(stage, None) is not None:
+            self._save()
+
+    def run(self, stage, func, inputs=(), params=None, deps=(), outputs=None):
+        """
+        Run a stage unless it is still valid.
+
+        Parameters
+        ----------
+        stage : str
+            Stage name
+        func : callable
+            Called without arguments to run the stage
+        inputs, params, deps
+            See digest
+        outputs : list of str or callable, optional
+            Output paths, or a callable returning them after func ran;
+            the stage is recorded only if they all exist, and, when given,
+            only if there is at least one
+
+        Returns
+        -------
+        list of str
+            Output paths of the stage
+
+        Raises
+        ------
+        RuntimeError
+            If func returned without writing all outputs, or without any
+        """
+        if self.is_valid(stage, inputs, params, deps):
+            print(f"Skipping {stage}, checkpoint is valid")
+            return self.outputs(stage)
+        # drop the stale record so a failing stage is left unrecorded
+        self.records.pop(stage, None)
+        func()
+        declared = outputs is not None
+        if callable(outputs):
+            outputs = outputs()
+        outputs = list(outputs or [])
+        if declared and not outputs:
+            raise RuntimeError(f"stage {stage} wrote no output")
+        missing = [path for path in outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"stage {stage} did not write {', '.join(missing)}")
+        self.record(stage, inputs, params, deps, outputs)
+        return outputs
@@ -0,0 +1,349 @@
+import os
+import sys
+import argparse
+
+# Only the standard library is imported here; every command imports what it
+# needs when it runs, so that --help and the metadata commands start fast.
+
+
+def _antenna_list(value):
+    """Parse an antenna selection such as '0-12' or '0,1,2,5'."""
+    antennas = []
+    for part in value.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            antennas.extend(range(int(first), int(last) + 1))
+        else:
+            antennas.append(int(part))
+    return antennas
+
+
+def cmd_info(args):
+    from astropy.time import Time
+    from eovsa_synop.ms_index import get_ms_index
+
+    ms_index = get_ms_index(args.vis, refresh=args.refresh)
+    begin, end = ms_index.timerange()
+    print(f"{args.vis}: {Time(begin, format='mjd').iso} - {Time(end, format='mjd').iso}")
+    print(f"antennas ({len(ms_index.antenna_ids)}): {' '.join(ms_index.antenna_names)}")
+    print(f"fields: {' '.join(ms_index.field_names)}")
+    print(f"spectral windows: {ms_index.nspw}")
+    for spw in range(ms_index.nspw):
+        freqs = ms_index.chan_freqs(spw)
+        print(f"  spw {spw:3d}: {len(freqs):4d} chan  {freqs[0] / 1e9:8.4f} - {freqs[-1] / 1e9:8.4f} GHz")
+    print(f"scans ({len(ms_index.scans)}):")
+    for scan in ms_index.scans:
+        times = ms_index.times_for_scan(scan)
+        print(f"  scan {scan:3d}: {Time(times[0] / 86400, format='mjd').iso} - "
+              f"{Time(times[-1] / 86400, format='mjd').iso}  {len(times):6d} times")
+
+
+def cmd_split(args):
+    from eovsa_synop.split_by_scan import split_ms_by_scan
+
+    split_ms_by_scan(args.vis, mode=args.mode, max_memory_mb=args.max_memory_mb)
+
+
+def cmd_flag(args):
+    from eovsa_synop import flag_ants, flagging, pipeline
+
+    if args.one_pass:
+        flagging.flag_one_pass(args.vis, keep_antennas=args.keep_antennas, timecutoff=args.timecutoff,
+                               freqcutoff=args.freqcutoff, n_threads=args.threads)
+    else:
+        flag_ants.flag_keep_antennas(args.vis, keep_antennas=args.keep_antennas)
+        if not args.antennas_only:
+            pipeline.flag_scan(args.vis)
+
+
+def cmd_average(args):
+    from eovsa_synop import averaging
+
+    bins = averaging.safe_bins(args.vis, image_size=args.size, pixel_scale_arcsec=args.scale_arcsec,
+                               max_loss=args.max_loss, antennas=args.keep_antennas)
+    for spw, spw_bins in bins.items():
+        print(f"  spw {spw:3d}: time bin {spw_bins['timebin_sec']:7.1f} s, {spw_bins['chanbin']:3d} channels")
+    if args.outputvis is not None:
+        averaging.average_ms(args.vis, args.outputvis, bins=bins, max_memory_mb=args.max_memory_mb)
+
+
+def cmd_intervals(args):
+    from astropy.time import Time
+    from eovsa_synop import intervals
+
+    times, counts, full_per_step = intervals.unflagged_counts(args.vis, spws=args.spws)
+    plan = intervals.plan_intervals(times, counts, interval_sec=args.interval_sec, min_fill=args.min_fill,
+                                    full_per_step=full_per_step)
+    print(f"{len(times)} timesteps, {counts.sum()} unflagged visibilities, {len(plan)} intervals")
+    for idx, interval in enumerate(plan):
+        t0, t1 = (Time(t / 86400, format='mjd').iso for t in interval['trange'])
+        print(f"  interval {idx:3d}: {t0} - {t1}  timesteps {interval['index'][0]}-{interval['index'][1]}  "
+              f"predict {interval['predict_index'][0]}-{interval['predict_index'][1]}  fill {interval['fill']:.2f}")
+
+
+def cmd_image(args):
+    from eovsa_synop.wrap_wsclean import WSClean
+
+    clean_obj = WSClean(vis=args.vis)
+    clean_obj.setup(size=args.size, scale=args.scale, weight_briggs=0.0, pol=args.pol,
+                    niter=args.niter, mgain=0.85, data_column=args.data_column,
+                    name=args.name, multiscale=True, auto_mask=6, auto_threshold=3,
+                    intervals_out=args.intervals_out, no_update_model=True,
+                    no_negative=True, quiet=True, spws=args.spws)
+    if args.threads is not None:
+        clean_obj.setup(threads=args.threads)
+    if args.temp_dir is not None:
+        clean_obj.setup(temp_dir=args.temp_dir)
+    return clean_obj.run(dryrun=args.dryrun)
+
+
+def cmd_rotate(args):
+    from astropy.time import Time
+    from eovsa_synop import rotation_corr_util
+    from eovsa_synop.fits_io import FitsWriter
+
+    newtime = Time(args.newtime)
+    writer = FitsWriter(compress=args.compress)
+    for in_fits in args.fits:
+        rot_fits = in_fits.replace('.fits', '.rot.fits')
+        rotation_corr_util.solar_diff_rot_heliofits(in_fits, newtime, rot_fits, sparse=args.sparse, writer=writer)
+        print(f"Wrote {rot_fits}")
+        if args.j2000:
+            j2000_fits = rot_fits.replace('.fits', '.j2000.fits')
+            rotation_corr_util.sunpyfits_to_j2000fits(rot_fits, j2000_fits, template_fits=args.template,
+                                                      sparse=args.sparse, writer=writer)
+            print(f"Wrote {j2000_fits}")
+
+
+def cmd_merge(args):
+    from eovsa_synop.merge_scans import merge_split_scans
+
+    # the scan files are looked up in the current directory
+    directory, base_name = os.path.split(os.path.abspath(args.base_name))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        merge_split_scans(base_name, mode=args.mode, max_memory_mb=args.max_memory_mb)
+    finally:
+        os.chdir(cwd)
+
+
+def cmd_run_day(args):
+    from eovsa_synop import pipeline
+
+    unit_kwargs = {'fused': args.fused, 'solver': args.solver, 'model_series': args.model_series,
+                   'image_timeout': args.image_timeout, 'stall_cycles': args.stall_cycles}
+    if args.scratch_dir is not None:
+        unit_kwargs['scratch_dir'] = args.scratch_dir
+    results = pipeline.run_day(args.vis, runtime_root=args.runtime_root, n_workers=args.workers,
+                               threads_per_worker=args.threads_per_worker, keep_antennas=args.keep_antennas,
+                               split_mode=args.split_mode, joint_spw=args.joint_spw, flag_mode=args.flag_mode,
+                               average=args.average, average_loss=args.average_loss, resume=not args.no_resume,
+                               telemetry_file=args.telemetry_file, **unit_kwargs)
+    failed = [result for result in results if result.get('status') == 'failed']
+    return 1 if failed else 0
+
+
+def cmd_batch_enqueue(args):
+    from eovsa_synop import batch
+
+    ms_files = batch.find_days(args.ms)
+    if not ms_files:
+        print(f"No measurement sets match {' '.join(args.ms)}")
+        return 1
+    unit_kwargs = {'fused': args.fused, 'solver': args.solver, 'model_series': args.model_series,
+                   'image_timeout': args.image_timeout, 'stall_cycles': args.stall_cycles}
+    n_added = batch.enqueue_days(args.queue, ms_files, runtime_base=args.runtime_base, joint_spw=args.joint_spw,
+                                 keep_antennas=args.keep_antennas, split_mode=args.split_mode,
+                                 flag_mode=args.flag_mode, average=args.average, average_loss=args.average_loss,
+                                 threads=args.threads, **unit_kwargs)
+    print(f"Added {n_added} items to {args.queue}")
+
+
+def cmd_batch_worker(args):
+    from eovsa_synop import batch
+
+    batch.run_workers(args.queue, n_processes=args.processes, threads_per_worker=args.threads,
+                      heartbeat_sec=args.heartbeat_sec, poll_sec=args.poll_sec, max_items=args.max_items,
+                      heartbeat_timeout=args.heartbeat_timeout, max_attempts=args.max_attempts)
+
+
+def cmd_batch_status(args):
+    from eovsa_synop import batch
+
+    batch.print_status(args.queue, straggler_factor=args.straggler_factor,
+                       heartbeat_timeout=args.heartbeat_timeout)
+
+
+def cmd_batch_retry(args):
+    from eovsa_synop.work_queue import WorkQueue
+
+    WorkQueue(args.queue).retry_failed()
+
+
+def cmd_telemetry(args):
+    from eovsa_synop import telemetry
+
+    telemetry.summarize(args.file, top=args.top, key=args.key)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='eovsa-synop', description="EOVSA daily synoptic processing")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('info', help="print the scans, spws and antennas of a measurement set")
+    p.add_argument('vis', help="measurement set")
+    p.add_argument('--refresh', action='store_true', help="rebuild the metadata index")
+    p.set_defaults(func=cmd_info)
+
+    p = subparsers.add_parser('split', help="split a measurement set by scan")
+    p.add_argument('vis', help="measurement set")
+    p.add_argument('--mode', default='copy', choices=['copy', 'single_pass', 'reference'])
+    p.add_argument('--max-memory-mb', type=float, default=512)
+    p.set_defaults(func=cmd_split)
+
+    p = subparsers.add_parser('flag', help="flag unused antennas and tfcrop outliers")
+    p.add_argument('vis', help="measurement set")
+    p.add_argument('--keep-antennas', type=_antenna_list, default=list(range(13)),
+                   help="antennas kept, e.g. 0-12 (default) or 0,1,2")
+    p.add_argument('--one-pass', action='store_true', help="flag in a single pass with flagging.flag_one_pass")
+    p.add_argument('--antennas-only', action='store_true', help="only flag the antennas, no tfcrop")
+    p.add_argument('--timecutoff', type=float, default=2.0)
+    p.add_argument('--freqcutoff', type=float, default=2.0)
+    p.add_argument('--threads', type=int, default=1)
+    p.set_defaults(func=cmd_flag)
+
+    p = subparsers.add_parser('average', help="show the safe time/channel bins and write an averaged MS")
+    p.add_argument('vis', help="measurement set")
+    p.add_argument('outputvis', nargs='?', default=None, help="averaged measurement set, only bins are shown without")
+    p.add_argument('--max-loss', type=float, default=0.02, help="peak loss tolerated from each kind of smearing")
+    p.add_argument('--size', type=int, default=1024, help="image size in pixels")
+    p.add_argument('--scale-arcsec', type=float, default=2.5, help="pixel size in arcsec")
+    p.add_argument('--keep-antennas', type=_antenna_list, default=list(range(13)))
+    p.add_argument('--max-memory-mb', type=float, default=512)
+    p.set_defaults(func=cmd_average)
+
+    p = subparsers.add_parser('intervals', help="show the imaging intervals planned on the unflagged data")
+    p.add_argument('vis', help="scan measurement set")
+    p.add_argument('--spws', default=None, help="spectral windows counted, e.g. 0,1, defaults to all")
+    p.add_argument('--interval-sec', type=float, default=2000, help="length of an interval without flags")
+    p.add_argument('--min-fill', type=float, default=0.75,
+                   help="smallest unflagged fraction of an interval_sec interval that is imaged")
+    p.set_defaults(func=cmd_intervals)
+
+    p = subparsers.add_parser('image', help="image a measurement set with wsclean")
+    p.add_argument('vis', help="measurement set")
+    p.add_argument('--spws', required=True, help="spectral windows, e.g. 0,1")
+    p.add_argument('--name', default='eovsa', help="output name prefix")
+    p.add_argument('--size', type=int, default=1024)
+    p.add_argument('--scale', default='2.5asec')
+    p.add_argument('--niter', type=int, default=3000)
+    p.add_argument('--pol', default='xx')
+    p.add_argument('--data-column', default='DATA')
+    p.add_argument('--intervals-out', type=int, default=1)
+    p.add_argument('--threads', type=int, default=None)
+    p.add_argument('--temp-dir', default=None)
+    p.add_argument('--dryrun', action='store_true', help="only print the wsclean command")
+    p.set_defaults(func=cmd_image)
+
+    p = subparsers.add_parser('rotate', help="differentially rotate helioprojective FITS to a reference time")
+    p.add_argument('fits', nargs='+', help="helioprojective FITS files, written to *.rot.fits")
+    p.add_argument('--newtime', required=True, help="reference time, e.g. '2024-12-12 20:00:00'")
+    p.add_argument('--j2000', action='store_true', help="also rotate back to RA-DEC, to *.rot.j2000.fits")
+    p.add_argument('--template', default=None, help="header template of the RA-DEC output")
+    p.add_argument('--sparse', action='store_true', help="inputs are CLEAN models")
+    p.add_argument('--compress', default=None, choices=['RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1'],
+                   help="tile compress the outputs (not readable by wsclean -predict)")
+    p.set_defaults(func=cmd_rotate)
+
+    p = subparsers.add_parser('merge', help="merge split scan measurement sets")
+    p.add_argument('base_name', help="path of the original MS without .ms, e.g. data/UDB20241212")
+    p.add_argument('--mode', default='stream', choices=['stream', 'virtual'])
+    p.add_argument('--max-memory-mb', type=float, default=512)
+    p.set_defaults(func=cmd_merge)
+
+    p = subparsers.add_parser('run-day', help="run the daily self-calibration and imaging loop")
+    p.add_argument('vis', help="full-day measurement set")
+    p.add_argument('--runtime-root', default='./runtime')
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--threads-per-worker', type=int, default=4)
+    p.add_argument('--keep-antennas', type=_antenna_list, default=list(range(13)))
+    p.add_argument('--split-mode', default='copy', choices=['copy', 'single_pass', 'reference'])
+    p.add_argument('--flag-mode', default='flagdata', choices=['flagdata', 'one_pass'])
+    p.add_argument('--joint-spw', action='store_true')
+    p.add_argument('--average', action='store_true', help="work on time/channel averaged scans")
+    p.add_argument('--average-loss', type=float, default=0.02)
+    p.add_argument('--fused', action='store_true', help="rotate models without helioimage2fits")
+    p.add_argument('--solver', default='casa', choices=['casa', 'builtin'])
+    p.add_argument('--model-series', default='hard', choices=['hard', 'symlink', 'copy', 'rotate'])
+    p.add_argument('--image-timeout', type=float, default=None, help="seconds allowed per imaging run")
+    p.add_argument('--stall-cycles', type=int, default=None,
+                   help="stop an imaging run whose peak has not improved over this many major cycles")
+    p.add_argument('--scratch-dir', default=None)
+    p.add_argument('--telemetry-file', default=None)
+    p.add_argument('--no-resume', action='store_true', help="run every stage again")
+    p.set_defaults(func=cmd_run_day)
+
+    p = subparsers.add_parser('batch', help="process many days through a shared work queue")
+    batch_parsers = p.add_subparsers(dest='batch_command', metavar='batch_command')
+    batch_parsers.required = True
+
+    q = batch_parsers.add_parser('enqueue', help="add the (day, scan, spw group) items of some days")
+    q.add_argument('queue', help="queue directory, shared by the workers")
+    q.add_argument('ms', nargs='+', help="full-day measurement sets or glob patterns, e.g. 'data/UDB2024*.ms'")
+    q.add_argument('--runtime-base', default='./runtime', help="parent of the per-day runtime directories")
+    q.add_argument('--threads', type=int, default=4, help="threads per unit")
+    q.add_argument('--keep-antennas', type=_antenna_list, default=list(range(13)))
+    q.add_argument('--split-mode', default='copy', choices=['copy', 'single_pass', 'reference'])
+    q.add_argument('--flag-mode', default='flagdata', choices=['flagdata', 'one_pass'])
+    q.add_argument('--joint-spw', action='store_true')
+    q.add_argument('--average', action='store_true', help="work on time/channel averaged scans")
+    q.add_argument('--average-loss', type=float, default=0.02)
+    q.add_argument('--fused', action='store_true')
+    q.add_argument('--solver', default='casa', choices=['casa', 'builtin'])
+    q.add_argument('--model-series', default='hard', choices=['hard', 'symlink', 'copy', 'rotate'])
+    q.add_argument('--image-timeout', type=float, default=None)
+    q.add_argument('--stall-cycles', type=int, default=None)
+    q.set_defaults(func=cmd_batch_enqueue)
+
+    q = batch_parsers.add_parser('worker', help="claim and run items until the queue is drained")
+    q.add_argument('queue', help="queue directory")
+    q.add_argument('--processes', type=int, default=1, help="workers started on this node")
+    q.add_argument('--threads', type=int, default=4, help="threads per worker")
+    q.add_argument('--heartbeat-sec', type=float, default=60.)
+    q.add_argument('--heartbeat-timeout', type=float, default=900.)
+    q.add_argument('--max-attempts', type=int, default=3)
+    q.add_argument('--poll-sec', type=float, default=30.)
+    q.add_argument('--max-items', type=int, default=None)
+    q.set_defaults(func=cmd_batch_worker)
+
+    q = batch_parsers.add_parser('status', help="show progress, throughput and stragglers")
+    q.add_argument('queue', help="queue directory")
+    q.add_argument('--straggler-factor', type=float, default=3.)
+    q.add_argument('--heartbeat-timeout', type=float, default=900.)
+    q.set_defaults(func=cmd_batch_status)
+
+    q = batch_parsers.add_parser('retry-failed', help="give the failed items new attempts")
+    q.add_argument('queue', help="queue directory")
+    q.set_defaults(func=cmd_batch_retry)
+
+    p = subparsers.add_parser('telemetry', help="summarize the slowest stages of a telemetry file")
+    p.add_argument('file', nargs='?', default='./runtime/telemetry.jsonl')
+    p.add_argument('--top', type=int, default=10)
+    p.add_argument('--key', default='wall_sec')
+    p.set_defaults(func=cmd_telemetry)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # checked here so that a wrong path is a usage error, not a traceback from casatools
+    if getattr(args, 'vis', None) is not None and not os.path.exists(args.vis):
+        parser.error(f"measurement set {args.vis} does not exist")
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import os
+from contextlib import contextmanager
+import numpy as np
+import astropy.units as u
+from astropy.time import Time
+from astropy.utils import iers
+
+from eovsa_synop.rotation_corr_util import solar_ephemeris
+
+# directory the daily ephemeris tables are kept in
+EPHEM_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'eovsa_synop', 'ephem')
+
+# quantities that wrap at 360 deg and are unwrapped before interpolation
+_ANGLES = ('ra', 'l0', 'hgln_obs')
+
+_ephem_cache = {}
+_msinfo_cache = {}
+
+
+class EphemerisCache:
+    """
+    Solar ephemeris of an observing day sampled on a fixed time grid.
+
+    Quantities are those of rotation_corr_util.solar_ephemeris and are
+    linearly interpolated, so any time or time range of the day is served
+    without astropy/sunpy coordinate transforms or network access.
+
+    Parameters
+    ----------
+    table : dict
+        'mjd' (days) and one array per quantity, as built by build
+    """
+
+    def __init__(self, table):
+        self.table = {key: np.asarray(value) for key, value in table.items()}
+        self.mjd = self.table['mjd']
+
+    @classmethod
+    def build(cls, date, step_sec=60., margin_hours=6., location=None):
+        """
+        Compute the ephemeris of a day.
+
+        Parameters
+        ----------
+        date : str or astropy.time.Time
+            Day of the observation, e.g. "2024-12-12"; the grid covers
+            00:00 to 24:00 UT of that day plus margin_hours on both sides
+        step_sec : float, optional
+            Grid step in seconds, defaults to 60
+        margin_hours : float, optional
+            Extension of the grid beyond the day, defaults to 6
+        location : astropy.coordinates.EarthLocation, optional
+            Observer location, defaults to EOVSA
+
+        Returns
+        -------
+        EphemerisCache
+        """
+        day = Time(Time(date).iso[0:10])
+        n_step = int(np.ceil((24 + 2 * margin_hours) * 3600 / step_sec)) + 1
+        times = day - margin_hours * u.hour + np.arange(n_step) * step_sec * u.s
+        # the IERS table shipped with astropy is precise enough at this grid step
+        with iers.conf.set_temp('auto_download', False):
+            table = solar_ephemeris(times, location=location)
+        table['mjd'] = times.mjd
+        return cls(table)
+
+    def save(self, path):
+        """Save the table to a .npz file"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_file = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, **self.table)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a table saved by save"""
+        with np.load(path) as npz:
+            return cls({key: npz[key] for key in npz.files})
+
+    def covers(self, time):
+        """True if all the times are within the grid"""
+        mjd = np.atleast_1d(Time(time).mjd)
+        return bool(np.all((mjd >= self.mjd[0]) & (mjd <= self.mjd[-1])))
+
+    def at(self, time):
+        """
+        Ephemeris at the given time(s), as returned by solar_ephemeris.
+
+        Raises ValueError if a time is outside the grid.
+        """
+        if not self.covers(time):
+            raise ValueError(f"{Time(time).iso} is outside the ephemeris of "
+                             f"{Time(self.mjd[0], format='mjd').iso} - {Time(self.mjd[-1], format='mjd').iso}")
+        mjd = Time(time).mjd
+        ephem = {}
+        for key, values in self.table.items():
+            if key == 'mjd':
+                continue
+            if key in _ANGLES:
+                value = np.interp(mjd, self.mjd, np.rad2deg(np.unwrap(np.deg2rad(values)))) % 360
+            else:
+                value = np.interp(mjd, self.mjd, values)
+            ephem[key] = float(value) if np.ndim(value) == 0 else value
+        return ephem
+
+    def to_horizons(self, trange=None, exact=False):
+        """
+        Grid samples in the layout of helioimage2fits.read_horizons.
+
+        The result can be passed as ephem= to helioimage2fits.imreg, which
+        then interpolates it instead of querying JPL Horizons.
+
+        Parameters
+        ----------
+        trange : tuple of astropy.time.Time, optional
+            Only the samples bracketing this time range, defaults to all
+        exact : bool, optional
+            Interpolate at the two ends of trange instead of returning grid
+            samples, as read_horizons does for a start time and duration
+
+        Returns
+        -------
+        dict
+            'time' (MJD), 'ra', 'dec' (rad), 'p0' (deg) and 'delta' (AU), as lists
+        """
+        if exact:
+            ephem = self.at(Time([Time(trange[0]), Time(trange[1])]))
+            return {
+                'time': Time([Time(trange[0]), Time(trange[1])]).mjd.tolist(),
+                'ra': np.deg2rad(ephem['ra']).tolist(),
+                'dec': np.deg2rad(ephem['dec']).tolist(),
+                'p0': ephem['p_angle'].tolist(),
+                'delta': (ephem['dsun'] * u.m).to_value(u.AU).tolist(),
+            }
+        sel = slice(None)
+        if trange is not None:
+            i0 = max(np.searchsorted(self.mjd, Time(trange[0]).mjd, side='right') - 1, 0)
+            i1 = min(np.searchsorted(self.mjd, Time(trange[1]).mjd, side='left') + 1, len(self.mjd))
+            sel = slice(i0, max(i1, i0 + 2))
+        return {
+            'time': self.mjd[sel].tolist(),
+            'ra': np.deg2rad(self.table['ra'][sel]).tolist(),
+            'dec': np.deg2rad(self.table['dec'][sel]).tolist(),
+            'p0': self.table['p_angle'][sel].tolist(),
+            'delta': (self.table['dsun'][sel] * u.m).to_value(u.AU).tolist(),
+        }
+
+
+def get_ephemeris(date, cache_dir=EPHEM_CACHE_DIR, step_sec=60.):
+    """
+    Ephemeris of an observing day, built once and then read from disk.
+
+    Parameters
+    ----------
+    date : str or astropy.time.Time
+        Day of the observation
+    cache_dir : str, optional
+        Directory of the cached tables, defaults to EPHEM_CACHE_DIR
+    step_sec : float, optional
+        Grid step in seconds of a newly built table, defaults to 60
+
+    Returns
+    -------
+    EphemerisCache
+    """
+    day = Time(date).iso[0:10]
+    path = os.path.join(cache_dir, f"eovsa_ephem_{day.replace('-', '')}.npz")
+    cached = _ephem_cache.get(path)
+    if cached is not None:
+        return cached
+    if os.path.exists(path):
+        try:
+            _ephem_cache[path] = EphemerisCache.load(path)
+            return _ephem_cache[path]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable ephemeris {path}: {str(e)}")
+
+    print(f"Computing the solar ephemeris of {day}")
+    ephem = EphemerisCache.build(day, step_sec=step_sec)
+    ephem.save(path)
+    _ephem_cache[path] = ephem
+    return ephem
+
+
+def get_msinfo(vis):
+    """
+    helioimage2fits.read_msinfo of a measurement set, read once per process.
+
+    The result can be passed as msinfo= to helioimage2fits.imreg so that
+    registering several images of the same MS does not reread it.
+    """
+    from suncasa.utils import helioimage2fits as hf
+
+    key = (os.path.abspath(vis.rstrip('/')), os.stat(vis).st_mtime)
+    if key not in _msinfo_cache:
+        _msinfo_cache[key] = hf.read_msinfo(vis)
+    return _msinfo_cache[key]
+
+
+@contextmanager
+def horizons_from_cache(ephem_cache):
+    """
+    Serve helioimage2fits.read_horizons from an EphemerisCache.
+
+    For EOVSA data imreg ignores its ephem argument and queries JPL Horizons
+    for the P angle of every image; within this context those queries are
+    answered from ephem_cache, without network access.
+    """
+    from suncasa.utils import helioimage2fits as hf
+
+    def read_horizons(t0=None, dur=None, vis=None, observatory=None, verbose=False):
+        t0 = Time(t0)
+        dur = 1. / 60. / 24. if not dur else dur
+        return ephem_cache.to_horizons((t0, t0 + dur * u.day), exact=True)
+
+    original = hf.read_horizons
+    hf.read_horizons = read_horizons
+    try:
+        yield
+    finally:
+        hf.read_horizons = original
@@ -0,0 +1,201 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+
+# headers kept by read_header, the least recently used are dropped first
+HEADER_CACHE_SIZE = 256
+
+_header_cache = OrderedDict()
+
+# keywords of the stored representation, set again by the writer
+_STORAGE_KEYS = ('BSCALE', 'BZERO', 'BLANK', 'CHECKSUM', 'DATASUM')
+
+
+def _data_hdu(hdul):
+    """The image HDU of a file: the first with data axes, e.g. extension 1 of a tile-compressed file."""
+    for hdu in hdul:
+        if hdu.header.get('NAXIS', 0) > 0:
+            return hdu
+    return hdul[0]
+
+
+def _cache_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def _cache_header(key, header):
+    _header_cache[key] = header
+    _header_cache.move_to_end(key)
+    while len(_header_cache) > HEADER_CACHE_SIZE:
+        _header_cache.popitem(last=False)
+
+
+def read_header(path):
+    """
+    Header of the image HDU of a FITS file, parsed once.
+
+    Headers are cached by path, modification time and size, so a template
+    read for every output of a day is parsed a single time and a rewritten
+    file is parsed again.
+
+    Parameters
+    ----------
+    path : str
+        FITS file
+
+    Returns
+    -------
+    astropy.io.fits.Header
+        A copy, free to be modified
+    """
+    key = _cache_key(path)
+    header = _header_cache.get(key)
+    if header is None:
+        with fits.open(path, memmap=True) as hdul:
+            header = _data_hdu(hdul).header.copy()
+        _cache_header(key, header)
+    else:
+        _header_cache.move_to_end(key)
+    return header.copy()
+
+
+def read_fits(path):
+    """
+    Data and header of the image HDU of a FITS file, the data memory-mapped.
+
+    Only the pages that are used are read. The array stays valid after the
+    file is closed, and is mapped copy-on-write: changes to it are never
+    written to the file. Tile-compressed images are decompressed into
+    memory.
+
+    Parameters
+    ----------
+    path : str
+        FITS file
+
+    Returns
+    -------
+    tuple
+        (data, header), the header as read_header gives it
+    """
+    key = _cache_key(path)
+    with fits.open(path, memmap=True) as hdul:
+        hdu = _data_hdu(hdul)
+        data = hdu.data
+        header = _header_cache.get(key)
+        if header is None:
+            header = hdu.header.copy()
+            _cache_header(key, header)
+    return data, header.copy()
+
+
+def image_plane(data):
+    """The 2D image of data with degenerate leading axes, e.g. (1, 1, ny, nx), as a view."""
+    data = np.asarray(data)
+    while data.ndim > 2:
+        data = data[0]
+    return data
+
+
+def read_map(path):
+    """
+    Read a FITS image into a sunpy map through read_fits.
+
+    Equivalent to sunpy.map.Map(path) for the single-image files of the
+    pipeline, without copying the data or parsing a header twice.
+    """
+    import sunpy.map as smap
+
+    data, header = read_fits(path)
+    return smap.Map(image_plane(data), header)
+
+
+class FitsWriter:
+    """
+    Writer of the FITS images of the pipeline.
+
+    Data are converted to dtype through a buffer that is kept between
+    writes of the same shape. When the header describes degenerate axes
+    (e.g. the FREQ and STOKES axes of a wsclean image) the data are written
+    with them, so NAXISn and the WCS keywords of the header agree. With
+    compress, images are tile compressed into extension 1 (read_fits and
+    sunpy read them as usual).
+
+    Parameters
+    ----------
+    dtype : numpy dtype, optional
+        Data type written, defaults to float32
+    compress : str, optional
+        Tile compression, e.g. 'RICE_1' or 'GZIP_2'; None (default) writes
+        a plain primary HDU, as wsclean -predict needs for its models
+    quantize_level : float, optional
+        Quantization of floating point data when compressing, see
+        astropy.io.fits.CompImageHDU; defaults to astropy's (16, lossy)
+    """
+
+    def __init__(self, dtype=np.float32, compress=None, quantize_level=None):
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.quantize_level = quantize_level
+        self._buffer = None
+
+    def _converted(self, data):
+        data = np.asarray(data)
+        if data.dtype == self.dtype:
+            return data
+        if self._buffer is None or self._buffer.shape != data.shape:
+            self._buffer = np.empty(data.shape, dtype=self.dtype)
+        np.copyto(self._buffer, data, casting='unsafe')
+        return self._buffer
+
+    @staticmethod
+    def _header_shape(header):
+        naxis = header.get('NAXIS', 0)
+        return tuple(header.get(f'NAXIS{axis}', 1) for axis in range(naxis, 0, -1))
+
+    def write(self, path, data, header, overwrite=True):
+        """
+        Write an image.
+
+        Parameters
+        ----------
+        path : str
+            Output FITS file
+        data : array
+            Image, 2D or with the axes of header
+        header : astropy.io.fits.Header
+            Header of the output, not modified; its axis and storage
+            keywords are set by the writer
+        overwrite : bool, optional
+            Replace path if it exists, defaults to True
+
+        Returns
+        -------
+        str
+            path
+        """
+        header = header.copy()
+        data = self._converted(data)
+        shape = self._header_shape(header)
+        if len(shape) > data.ndim and shape[-data.ndim:] == data.shape and np.prod(shape) == data.size:
+            data = data.reshape(shape)
+        for key in _STORAGE_KEYS:
+            header.remove(key, ignore_missing=True)
+        if self.compress is None:
+            fits.PrimaryHDU(data, header=header).writeto(path, overwrite=overwrite)
+        else:
+            kwargs = {} if self.quantize_level is None else {'quantize_level': self.quantize_level}
+            hdu = fits.CompImageHDU(data, header=header, compression_type=self.compress, **kwargs)
+            fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=overwrite)
+        return path
+
+
+_default_writer = FitsWriter()
+
+
+def write_fits(path, data, header, writer=None, overwrite=True):
+    """Write an image with writer, defaults to a shared float32 FitsWriter without compression."""
+    return (writer or _default_writer).write(path, data, header, overwrite=overwrite)
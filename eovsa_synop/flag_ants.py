@@ -1,8 +1,8 @@
-from casatasks import flagdata
-from casatools import table, msmetadata
-import numpy as np
+from eovsa_synop.ms_index import get_ms_index
+from eovsa_synop.telemetry import timed
 
-def flag_keep_antennas(vis, keep_antennas=range(13)):
+@timed('flag_ants')
+def flag_keep_antennas(vis, keep_antennas=range(13), raise_errors=False):
     """
     Flag all antennas except the specified ones in the measurement set.
     
@@ -12,16 +12,15 @@ def flag_keep_antennas(vis, keep_antennas=range(13)):
         Input measurement set filename
     keep_antennas : list or range
         List of antenna numbers to keep (default: 0-12)
+    raise_errors : bool, optional
+        Raise errors instead of only printing them, e.g. so that a pipeline
+        stage is not recorded as done (default: False)
     """
-    # Initialize tools
-    msmd = msmetadata()
-    
+    from casatasks import flagdata
+
     try:
-        # Open the measurement set
-        msmd.open(vis)
-        
         # Get all antenna IDs
-        all_antennas = msmd.antennaids()
+        all_antennas = get_ms_index(vis).antenna_ids
         
         # Convert keep_antennas to list if it's a range
         keep_list = list(keep_antennas)
@@ -50,10 +49,8 @@ def flag_keep_antennas(vis, keep_antennas=range(13)):
         
     except Exception as e:
         print(f"Error during flagging: {str(e)}")
-        
-    finally:
-        # Clean up
-        msmd.done()
+        if raise_errors:
+            raise
 
 if __name__ == "__main__":
     # Input measurement set
@@ -0,0 +1,270 @@
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from eovsa_synop.telemetry import timed
+
+# suffix of the bit-packed FLAG backup written next to the measurement set
+BACKUP_SUFFIX = '.flags.npz'
+
+
+def _robust_sigma(resid, axis):
+    """Standard deviation estimated from the median absolute deviation, NaNs ignored."""
+    med = np.nanmedian(resid, axis=axis, keepdims=True)
+    return 1.4826 * np.nanmedian(np.abs(resid - med), axis=axis, keepdims=True)
+
+
+def tfcrop_flags(amp, flags, timecutoff=2.0, freqcutoff=2.0):
+    """
+    tfcrop-style outlier flags of amplitude time-frequency planes.
+
+    Every (baseline, correlation) plane is tested twice, as flagdata tfcrop
+    does: along time, against the median over time of every channel, with
+    timecutoff; then along frequency, against the bandshape scaled to every
+    timestep, with freqcutoff. Deviations are measured in robust (MAD)
+    standard deviations. Statistics ignore points that are already flagged.
+
+    Parameters
+    ----------
+    amp : numpy.ndarray
+        Amplitudes of shape (nbl, ntime, ncorr, nchan)
+    flags : numpy.ndarray
+        Existing flags of the same shape, True where flagged or missing
+    timecutoff : float, optional
+        Cutoff in sigma along time, defaults to 2.0
+    freqcutoff : float, optional
+        Cutoff in sigma along frequency, defaults to 2.0
+
+    Returns
+    -------
+    numpy.ndarray
+        New flags of the same shape, existing flags included
+    """
+    a = np.where(flags, np.nan, amp).astype(np.float64)
+
+    # along time, per channel
+    bandshape = np.nanmedian(a, axis=1, keepdims=True)
+    resid = a - bandshape
+    sigma = _robust_sigma(resid, axis=1)
+    out = flags | (np.abs(resid) > timecutoff * sigma)
+
+    # along frequency, per timestep, against the bandshape scaled to the timestep
+    a[out] = np.nan
+    scale = np.nanmedian(a / bandshape, axis=3, keepdims=True)
+    resid = a - scale * bandshape
+    sigma = _robust_sigma(resid, axis=3)
+    out |= np.abs(resid) > freqcutoff * sigma
+    return out
+
+
+def _flag_chunk(data, flag, ant1, ant2, time, keep, timecutoff, freqcutoff, n_threads):
+    """
+    Flags of one chunk of rows of one spw.
+
+    The rows are laid out as a (baseline, time) grid so that the statistics
+    of all baselines are computed together; baselines are split across
+    n_threads threads.
+    """
+    new_flag = flag.copy()
+    new_flag[:, :, ~(np.isin(ant1, keep) & np.isin(ant2, keep))] = True
+
+    baselines, bl_idx = np.unique(ant1 * 65536 + ant2, return_inverse=True)
+    times, t_idx = np.unique(time, return_inverse=True)
+    ncorr, nchan, _ = data.shape
+    cube_shape = (len(baselines), len(times), ncorr, nchan)
+    amp = np.zeros(cube_shape, dtype=np.float32)
+    cube_flag = np.ones(cube_shape, dtype=bool)
+    amp[bl_idx, t_idx] = np.abs(data).transpose(2, 0, 1)
+    cube_flag[bl_idx, t_idx] = new_flag.transpose(2, 0, 1)
+
+    n_threads = max(1, min(n_threads, len(baselines)))
+    with warnings.catch_warnings():
+        # NaN statistics of fully flagged slices
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if n_threads > 1:
+            blocks = np.array_split(np.arange(len(baselines)), n_threads)
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                block_flags = list(pool.map(
+                    lambda sel: tfcrop_flags(amp[sel], cube_flag[sel], timecutoff, freqcutoff), blocks))
+            cube_flag = np.concatenate(block_flags, axis=0)
+        else:
+            cube_flag = tfcrop_flags(amp, cube_flag, timecutoff, freqcutoff)
+
+    return new_flag | cube_flag[bl_idx, t_idx].transpose(1, 2, 0)
+
+
+def backup_flags(vis, backup_file=None, chunk_rows=100000):
+    """
+    Save the flags of a measurement set in a bit-packed backup, see restore_flags.
+
+    FLAG is read in row chunks per spw and the backup is written to a
+    temporary file that replaces backup_file only when complete. An existing
+    backup is never overwritten, so it keeps the flags from before the first
+    flagging of vis.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    backup_file : str, optional
+        Backup written, defaults to vis + BACKUP_SUFFIX
+    chunk_rows : int, optional
+        Number of rows read at once, defaults to 100000
+
+    Returns
+    -------
+    str
+        Path of the backup
+    """
+    from casatools import table
+
+    if backup_file is None:
+        backup_file = vis.rstrip('/') + BACKUP_SUFFIX
+    if os.path.exists(backup_file):
+        print(f"Keeping the flag backup {backup_file}")
+        return backup_file
+    packed = {}
+    tb = table()
+    tb.open(vis)
+    try:
+        for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+            subtb = tb.query(f'DATA_DESC_ID=={ddid}', sortlist='TIME,ANTENNA1,ANTENNA2')
+            try:
+                ddid_packed = []
+                for start in range(0, subtb.nrows(), chunk_rows):
+                    nrow = min(chunk_rows, subtb.nrows() - start)
+                    flag = subtb.getcol('FLAG', start, nrow)
+                    ddid_packed.append(np.packbits(flag.reshape(-1, nrow).T, axis=1))
+                packed[f'ddid{ddid}'] = np.concatenate(ddid_packed, axis=0)
+                packed[f'ddid{ddid}_shape'] = np.array(flag.shape[:2])
+            finally:
+                subtb.close()
+    finally:
+        tb.close()
+    tmp_file = f"{backup_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **packed)
+    os.replace(tmp_file, backup_file)
+    return backup_file
+
+
+@timed('flag_one_pass')
+def flag_one_pass(vis, keep_antennas=range(13), timecutoff=2.0, freqcutoff=2.0, chunk_times=300,
+                  n_threads=1, backup=True):
+    """
+    Antenna exclusion and tfcrop-style flagging in a single pass over a measurement set.
+
+    Replaces flag_ants.flag_keep_antennas followed by flagdata(mode='tfcrop'):
+    DATA and FLAG of every spw are read once, in chunks of whole timesteps,
+    and FLAG (and FLAG_ROW) written back once. Instead of a flagversions copy
+    the original flags can be kept in a bit-packed backup, see restore_flags.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set, modified in place
+    keep_antennas : list or range, optional
+        Antennas to keep, all others are flagged (default: 0-12)
+    timecutoff : float, optional
+        Cutoff in sigma along time, defaults to 2.0
+    freqcutoff : float, optional
+        Cutoff in sigma along frequency, defaults to 2.0
+    chunk_times : int, optional
+        Number of timesteps per chunk; the statistics are computed per chunk,
+        like the ntime parameter of tfcrop (default: 300)
+    n_threads : int, optional
+        Number of threads the baselines of a chunk are split across (default: 1)
+    backup : bool, optional
+        Save the original flags to vis + BACKUP_SUFFIX with backup_flags,
+        in a read-only pass before any flag is changed (default: True). An
+        existing backup is kept
+
+    Returns
+    -------
+    dict
+        Number of rows and the fraction of flags before and after, over all spws
+    """
+    from casatools import table
+
+    if backup:
+        backup_flags(vis)
+    keep = np.array(list(keep_antennas))
+    tb = table()
+    tb.open(vis, nomodify=False)
+    has_flag_row = 'FLAG_ROW' in tb.colnames()
+    stats = {'rows': 0, 'flagged_before': 0, 'flagged_after': 0, 'total': 0}
+    try:
+        for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+            # time sorted reference table of one spw, FLAG is written through to vis
+            subtb = tb.query(f'DATA_DESC_ID=={ddid}', sortlist='TIME,ANTENNA1,ANTENNA2')
+            try:
+                time_col = subtb.getcol('TIME')
+                _, t_idx = np.unique(time_col, return_inverse=True)
+                # chunk boundaries on whole timesteps
+                starts = np.searchsorted(t_idx, np.arange(0, t_idx.max() + 1, chunk_times))
+                ends = np.append(starts[1:], len(t_idx))
+                for start, end in zip(starts, ends):
+                    nrow = int(end - start)
+                    data = subtb.getcol('DATA', int(start), nrow)
+                    flag = subtb.getcol('FLAG', int(start), nrow)
+                    ant1 = subtb.getcol('ANTENNA1', int(start), nrow)
+                    ant2 = subtb.getcol('ANTENNA2', int(start), nrow)
+                    new_flag = _flag_chunk(data, flag, ant1, ant2, time_col[start:end], keep,
+                                           timecutoff, freqcutoff, n_threads)
+                    subtb.putcol('FLAG', new_flag, int(start), nrow)
+                    if has_flag_row:
+                        subtb.putcol('FLAG_ROW', new_flag.all(axis=(0, 1)), int(start), nrow)
+                    stats['rows'] += nrow
+                    stats['flagged_before'] += int(flag.sum())
+                    stats['flagged_after'] += int(new_flag.sum())
+                    stats['total'] += new_flag.size
+            finally:
+                subtb.close()
+    finally:
+        tb.close()
+
+    total = max(stats['total'], 1)
+    print(f"Flagged {vis}: {100 * stats['flagged_before'] / total:.1f}% -> "
+          f"{100 * stats['flagged_after'] / total:.1f}% of {stats['rows']} rows")
+    return {'rows': stats['rows'],
+            'flag_fraction_before': stats['flagged_before'] / total,
+            'flag_fraction_after': stats['flagged_after'] / total}
+
+
+def restore_flags(vis, backup_file=None):
+    """
+    Restore the flags saved by backup_flags or flag_one_pass.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    backup_file : str, optional
+        Backup to restore, defaults to vis + BACKUP_SUFFIX
+    """
+    from casatools import table
+
+    if backup_file is None:
+        backup_file = vis.rstrip('/') + BACKUP_SUFFIX
+    if not os.path.exists(backup_file):
+        print(f"No flag backup {backup_file}")
+        return
+    packed = np.load(backup_file)
+    tb = table()
+    tb.open(vis, nomodify=False)
+    try:
+        for key in packed.files:
+            if key.endswith('_shape'):
+                continue
+            ncorr, nchan = packed[key + '_shape']
+            subtb = tb.query(f'DATA_DESC_ID=={key[4:]}', sortlist='TIME,ANTENNA1,ANTENNA2')
+            try:
+                flag = np.unpackbits(packed[key], axis=1, count=ncorr * nchan).astype(bool)
+                subtb.putcol('FLAG', flag.T.reshape(ncorr, nchan, -1))
+                if 'FLAG_ROW' in subtb.colnames():
+                    subtb.putcol('FLAG_ROW', flag.all(axis=1))
+            finally:
+                subtb.close()
+    finally:
+        tb.close()
+    print(f"Restored flags of {vis} from {backup_file}")
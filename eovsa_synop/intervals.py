@@ -0,0 +1,238 @@
+import json
+import numpy as np
+
+from eovsa_synop.telemetry import timed
+
+
+@timed('unflagged_counts')
+def unflagged_counts(vis, spws=None, chunk_rows=100000):
+    """
+    Number of unflagged visibilities at every timestamp of a measurement set.
+
+    FLAG is streamed in row chunks per spectral window, so the memory use
+    does not grow with the scan length. The count of a fully unflagged
+    timestep is taken over the baselines with any unflagged visibility in
+    the spw, so baselines of excluded antennas do not lower the fill.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    spws : str or list of int, optional
+        Comma separated spectral windows counted, defaults to all
+    chunk_rows : int, optional
+        Number of rows read at once, defaults to 100000
+
+    Returns
+    -------
+    times : array
+        Sorted unique times of the measurement set in MJD seconds, the
+        timesteps wsclean -interval counts
+    counts : array of int
+        Unflagged visibilities (correlations x channels x baselines) per time
+    full_per_step : int
+        Visibilities of a fully unflagged timestep, summed over the spws
+    """
+    from casatools import table
+    from eovsa_synop.phase_solver import _spw_ddids
+
+    ddids = _spw_ddids(vis, spws)
+    tb = table()
+    tb.open(vis)
+    try:
+        times = np.unique(tb.getcol('TIME'))
+        counts = np.zeros(len(times), dtype=np.int64)
+        full_per_step = 0
+        for ddid in sorted(ddids.values()):
+            subtb = tb.query(f'DATA_DESC_ID=={ddid}')
+            try:
+                baselines = set()
+                ncorr_nchan = 0
+                for row in range(0, subtb.nrows(), chunk_rows):
+                    nrow = min(chunk_rows, subtb.nrows() - row)
+                    flag = subtb.getcol('FLAG', row, nrow)
+                    n_good = flag.shape[0] * flag.shape[1] - flag.sum(axis=(0, 1))
+                    n_good[subtb.getcol('FLAG_ROW', row, nrow)] = 0
+                    ncorr_nchan = flag.shape[0] * flag.shape[1]
+                    baseline = subtb.getcol('ANTENNA1', row, nrow) * 65536 + subtb.getcol('ANTENNA2', row, nrow)
+                    baselines.update(np.unique(baseline[n_good > 0]).tolist())
+                    counts += np.bincount(np.searchsorted(times, subtb.getcol('TIME', row, nrow)),
+                                          weights=n_good, minlength=len(times)).astype(np.int64)
+                full_per_step += len(baselines) * ncorr_nchan
+            finally:
+                subtb.close()
+    finally:
+        tb.close()
+    return times, counts, full_per_step
+
+
+def _trim(counts, i0, i1):
+    """Shrink [i0, i1) to its first and last timestamps with data, None if it has none."""
+    good = np.flatnonzero(counts[i0:i1])
+    if len(good) == 0:
+        return None
+    return i0 + good[0], i0 + good[-1] + 1
+
+
+def _split_equal(counts, i0, i1, n_parts):
+    """Cut [i0, i1) into n_parts trimmed ranges of equal unflagged count, the empty ones left out."""
+    cumulative = np.cumsum(counts[i0:i1])
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, n_parts) / n_parts, side='right') + i0
+    bounds = [i0] + sorted(set(int(cut) for cut in cuts if i0 < cut < i1)) + [i1]
+    parts = [_trim(counts, j0, j1) for j0, j1 in zip(bounds[:-1], bounds[1:])]
+    return [part for part in parts if part is not None]
+
+
+def plan_intervals(times, counts, interval_sec=2000, min_fill=0.75, max_interval_sec=None, full_per_step=None):
+    """
+    Choose imaging intervals that hold similar amounts of unflagged data.
+
+    The number of intervals follows the usable data rather than the scan
+    length: it is the data volume over that of one fully unflagged
+    interval_sec interval, full_per_step visibilities per timestep,
+    rounded, and kept within what fits between min_fill and
+    max_interval_sec. Boundaries are placed at equal steps of the
+    cumulative unflagged count, intervals are trimmed to their first and
+    last timestamps with data, and intervals longer than max_interval_sec
+    (e.g. across a long flagged gap) are cut into equal parts. Intervals
+    whose fill, their count over that of a fully unflagged interval_sec
+    interval, is below min_fill are merged into a neighbour when the merged
+    interval stays within max_interval_sec, or else shared out evenly with
+    a neighbour when both parts then reach min_fill. Of those still below
+    min_fill only the ones whose own timesteps are mostly flagged are
+    dropped, so unflagged data is always imaged unless the whole scan holds
+    less than min_fill of an interval.
+
+    Every interval also gets a predict range: the intervals extended over
+    the timesteps between them, and to the ends of the scan, so that a
+    predict per interval fills MODEL_DATA for every timestep.
+
+    Parameters
+    ----------
+    times : array
+        Sorted times in MJD seconds, as returned by unflagged_counts
+    counts : array of int
+        Unflagged visibilities per time
+    interval_sec : float, optional
+        Length in seconds of a fully unflagged interval, defaults to 2000
+    min_fill : float, optional
+        Smallest fill of an interval that is imaged, defaults to 0.75,
+        i.e. scans without flags shorter than 1500 s are not imaged
+    max_interval_sec : float, optional
+        Longest interval in seconds, defaults to 1.5 * interval_sec
+    full_per_step : int, optional
+        Visibilities of a fully unflagged timestep, as returned by
+        unflagged_counts; the largest count per time is used without it,
+        which overestimates the fill of uniformly flagged data
+
+    Returns
+    -------
+    list of dict
+        Intervals in time order with 'index' and 'predict_index', the
+        [start, end) timestep ranges given to wsclean -interval, 'trange'
+        and 'predict_trange', the corresponding (start, end) in MJD
+        seconds, 'count' and 'fill'
+    """
+    times = np.asarray(times, dtype=float)
+    counts = np.asarray(counts, dtype=np.int64)
+    if max_interval_sec is None:
+        max_interval_sec = 1.5 * interval_sec
+    total = counts.sum()
+    if total == 0:
+        return []
+    dt = np.median(np.diff(times)) if len(times) > 1 else 1.
+    if full_per_step is None:
+        full_per_step = counts.max()
+    full_count = full_per_step * interval_sec / dt
+
+    if total / full_count < min_fill:
+        # too little data for one interval, e.g. a short scan
+        return []
+
+    def span(i0, i1):
+        return times[i1 - 1] - times[i0] + dt
+
+    def fill(i0, i1):
+        return counts[i0:i1].sum() / full_count
+
+    # equal steps of the cumulative unflagged count, as many as keep every
+    # step within max_interval_sec and at or above min_fill when possible
+    n_fewest = int(np.ceil(total / full_count * interval_sec / max_interval_sec))
+    n_most = int(np.floor(total / full_count / min_fill)) if min_fill > 0 else n_fewest
+    n_intervals = max(int(np.floor(total / full_count + 0.5)), n_fewest)
+    n_intervals = max(min(n_intervals, n_most), n_fewest, 1)
+    ranges = _split_equal(counts, 0, len(times), n_intervals)
+
+    # cut the long ones
+    cut_ranges = []
+    for i0, i1 in ranges:
+        n_parts = int(np.ceil(span(i0, i1) / max_interval_sec))
+        part_bounds = np.searchsorted(times[i0:i1], times[i0] + (times[i1 - 1] - times[i0]) *
+                                      np.arange(1, n_parts) / n_parts) + i0
+        for j0, j1 in zip([i0] + list(part_bounds), list(part_bounds) + [i1]):
+            part = _trim(counts, j0, j1) if j1 > j0 else None
+            if part is not None:
+                cut_ranges.append(part)
+
+    # merge the near-empty ones into a neighbour, or share a neighbour's
+    # data out evenly, the emptiest first
+    ranges = cut_ranges
+    while True:
+        fills = [fill(i0, i1) for i0, i1 in ranges]
+        new_ranges = None
+        for k in np.argsort(fills):
+            if fills[k] >= min_fill:
+                break
+            neighbours = [j for j in (k - 1, k + 1) if 0 <= j < len(ranges)]
+            unions = {j: (min(ranges[k][0], ranges[j][0]), max(ranges[k][1], ranges[j][1])) for j in neighbours}
+            mergeable = [j for j in neighbours if span(*unions[j]) <= max_interval_sec]
+            if mergeable:
+                j = min(mergeable, key=lambda j: span(*ranges[j]))
+                new_ranges = [unions[j]]
+            else:
+                for j in neighbours:
+                    parts = _split_equal(counts, *unions[j], 2)
+                    if len(parts) == 2 and all(span(*part) <= max_interval_sec and fill(*part) >= min_fill
+                                               for part in parts):
+                        new_ranges = parts
+                        break
+            if new_ranges is not None:
+                break
+        if new_ranges is None:
+            break
+        ranges = sorted([r for i, r in enumerate(ranges) if i not in (k, j)] + new_ranges)
+
+    # drop what is still near-empty because its timesteps are flagged
+    ranges = [(i0, i1) for i0, i1 in ranges
+              if fill(i0, i1) >= min_fill or counts[i0:i1].sum() >= min_fill * full_per_step * (i1 - i0)]
+
+    # predict ranges meet halfway in the gaps
+    plan = []
+    for k, (i0, i1) in enumerate(ranges):
+        p0 = 0 if k == 0 else (ranges[k - 1][1] + i0) // 2
+        p1 = len(times) if k == len(ranges) - 1 else (i1 + ranges[k + 1][0]) // 2
+        plan.append({
+            'index': (int(i0), int(i1)),
+            'predict_index': (int(p0), int(p1)),
+            'trange': (float(times[i0] - dt / 2), float(times[i1 - 1] + dt / 2)),
+            'predict_trange': (float(times[p0] - dt / 2), float(times[p1 - 1] + dt / 2)),
+            'count': int(counts[i0:i1].sum()),
+            'fill': float(counts[i0:i1].sum() / full_count),
+        })
+    return plan
+
+
+def save_plan(plan, path):
+    """Write an interval plan to a JSON file."""
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=1)
+
+
+def load_plan(path):
+    """Read an interval plan written by save_plan."""
+    with open(path) as f:
+        plan = json.load(f)
+    for interval in plan:
+        for key in ('index', 'predict_index', 'trange', 'predict_trange'):
+            interval[key] = tuple(interval[key])
+    return plan
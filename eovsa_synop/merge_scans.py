@@ -1,77 +1,148 @@
 import os
-from casatools import table
+import time
+import shutil
+import resource
+import numpy as np
+from eovsa_synop.telemetry import timed
 
-def merge_split_scans(base_ms_name):
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _bytes_per_row(tb, colnames):
+    """Estimate the in-memory size of one row of the given columns."""
+    nbytes = 0
+    for colname in colnames:
+        try:
+            nbytes += np.asarray(tb.getcol(colname, 0, 1)).nbytes
+        except Exception:
+            pass
+    return max(nbytes, 1)
+
+
+@timed('merge')
+def merge_split_scans(base_ms_name, mode='stream', max_memory_mb=512):
     """
     Merge previously split measurement sets back into a single MS file.
-    
+
     Parameters:
     -----------
     base_ms_name : str
         Base name of the original measurement set (without .ms extension)
         The function will look for files matching pattern: base_name_scanX.ms
+    mode : str, optional
+        'stream' copies the rows of every scan in bounded chunks (default).
+        'virtual' builds a concatenated table that references the scan
+        files without copying any visibility data; the scan files must
+        be kept next to it.
+    max_memory_mb : float, optional
+        Memory ceiling of one chunk of rows in 'stream' mode (default: 512)
+
+    Returns:
+    --------
+    dict or None
+        Merge statistics (rows, seconds, rows_per_sec, peak_rss_mb), or None
+        if nothing was merged
     """
+    from casatools import table
+
     # Initialize table tool
     tb = table()
-    
+    stats = None
+
     try:
         # Get list of all split MS files in the current directory
         all_files = os.listdir('.')
-        split_files = [f for f in all_files if f.startswith(base_ms_name) and 
+        split_files = [f for f in all_files if f.startswith(base_ms_name) and
                       '_scan' in f and f.endswith('.ms')]
-        
+
         if not split_files:
             print(f"No split scan files found for {base_ms_name}")
             return
-            
+
         # Sort files to ensure consistent ordering
         split_files.sort()
         print(f"Found {len(split_files)} split scan files to merge")
-        
+
         # Define output merged MS name
         merged_ms = f"{base_ms_name}_merged.ms"
-        
+
         if os.path.exists(merged_ms):
             print(f"Output file {merged_ms} already exists. Please remove it first.")
             return
-            
-        # Use the first file as the base and append others to it
-        print(f"Using {split_files[0]} as base file")
-        os.system(f"cp -r {split_files[0]} {merged_ms}")
-        
-        # Open the merged MS
-        tb.open(merged_ms, nomodify=False)
-        
-        # Append each remaining file
-        for ms_file in split_files[1:]:
-            print(f"Appending {ms_file}")
-            
-            # Open the MS file to append
-            tb_append = table(ms_file)
-            
-            # Add rows from this MS to the merged MS
-            tb.addrows(tb_append.nrows())
-            
-            # Copy data from the append MS to the merged MS
-            for colname in tb.colnames():
-                try:
-                    col_data = tb_append.getcol(colname)
-                    tb.putcol(colname, col_data, startrow=tb.nrows() - tb_append.nrows())
-                except Exception as e:
-                    print(f"Warning: Error copying column {colname}: {str(e)}")
-            
-            # Close the append MS
-            tb_append.close()
-            
+
+        t_start = time.time()
+
+        if mode == 'virtual':
+            # Concatenate by reference, subtables are taken from the first file
+            tb.createmultitable(merged_ms, split_files, '')
+            tb.open(merged_ms)
+            nrows = tb.nrows()
+        else:
+            # Use the first file as the base and append others to it
+            print(f"Using {split_files[0]} as base file")
+            shutil.copytree(split_files[0], merged_ms)
+
+            # Open the merged MS
+            tb.open(merged_ms, nomodify=False)
+            nrows = tb.nrows()
+
+            # Append each remaining file
+            for ms_file in split_files[1:]:
+                print(f"Appending {ms_file}")
+
+                # Open the MS file to append
+                tb_append = table(ms_file)
+                nrow_append = tb_append.nrows()
+                if nrow_append == 0:
+                    tb_append.close()
+                    continue
+
+                # Add rows from this MS to the merged MS
+                startrow = tb.nrows()
+                tb.addrows(nrow_append)
+
+                # Copy data from the append MS in chunks that fit the memory ceiling
+                colnames = tb.colnames()
+                chunk_rows = max(1, int(max_memory_mb * 1024**2 // _bytes_per_row(tb_append, colnames)))
+                failed = set()
+                for row in range(0, nrow_append, chunk_rows):
+                    nrow = min(chunk_rows, nrow_append - row)
+                    for colname in colnames:
+                        if colname in failed:
+                            continue
+                        try:
+                            col_data = tb_append.getcol(colname, row, nrow)
+                            tb.putcol(colname, col_data, startrow=startrow + row)
+                        except Exception as e:
+                            print(f"Warning: Error copying column {colname}: {str(e)}")
+                            failed.add(colname)
+                nrows += nrow_append
+
+                # Close the append MS
+                tb_append.close()
+
+        elapsed = time.time() - t_start
+        stats = {'rows': nrows, 'seconds': elapsed, 'rows_per_sec': nrows / max(elapsed, 1e-9),
+                 'peak_rss_mb': _peak_rss_mb()}
         print(f"Successfully created merged MS: {merged_ms}")
-        
+        print(f"Merged {nrows} rows in {elapsed:.1f} s ({stats['rows_per_sec']:.0f} rows/s), "
+              f"peak memory {stats['peak_rss_mb']:.0f} MB")
+
     except Exception as e:
         print(f"Error merging measurement sets: {str(e)}")
-        
+
     finally:
         # Clean up
         tb.close()
 
-# Example usage:
-base_name = "UDB20241212"  # Without .ms extension
-merge_split_scans(base_name)
\ No newline at end of file
+    return stats
+
+
+if __name__ == "__main__":
+    # Example usage:
+    base_name = "UDB20241212"  # Without .ms extension
+    merge_split_scans(base_name)
+
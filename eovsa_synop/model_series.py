@@ -0,0 +1,143 @@
+import os
+import shutil
+import numpy as np
+
+from eovsa_synop import rotation_corr_util
+from eovsa_synop.fits_io import read_fits
+from eovsa_synop.wrap_wsclean import WSClean
+
+
+def link_or_copy(src, dst, link='hard'):
+    """
+    Make dst refer to the content of src without copying it if possible.
+
+    Parameters
+    ----------
+    src : str
+        Existing file
+    dst : str
+        Path to create, replaced if it exists
+    link : str, optional
+        'hard' (default), 'symlink' or 'copy'. Links fall back to copying on
+        filesystems that do not support them.
+
+    Returns
+    -------
+    str
+        The method that was used: 'hard', 'symlink' or 'copy'
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if link == 'hard':
+            os.link(src, dst)
+            return link
+        if link == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return link
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+def interval_name(out_name, interval, n_intervals):
+    """
+    Name prefix of the wsclean runs of one interval of an interval plan.
+
+    Every planned interval is imaged and predicted in its own run with
+    -interval, so its images are named as interval `interval` of a run
+    with n_intervals intervals would name them.
+    """
+    return WSClean.output_name(out_name, interval, 0, n_intervals, 1)
+
+
+def build_model_series(model_files, out_name, n_sub, n_chan=1, link='hard', n_intervals=None):
+    """
+    Lay out the model images of a predict with n_sub intervals per model.
+
+    Every model is referenced n_sub times under the names wsclean -predict
+    expects for n_sub intervals under the interval_name of its interval,
+    as links to the one file.
+
+    Parameters
+    ----------
+    model_files : dict
+        Model image per (interval, channel)
+    out_name : str
+        Name prefix of the predicts, e.g. "runtime/modelrot/eovsa"
+    n_sub : int
+        Number of sub-intervals per model interval
+    n_chan : int, optional
+        Number of output channels, defaults to 1
+    link : str, optional
+        'hard' (default), 'symlink' or 'copy', see link_or_copy
+    n_intervals : int, optional
+        Number of intervals of the plan, defaults to the last interval of
+        model_files plus one
+
+    Returns
+    -------
+    list of str
+        The model image names that were created
+    """
+    if n_intervals is None:
+        n_intervals = max(idx for idx, _ in model_files) + 1
+    created = []
+    for (idx, chan), model_file in sorted(model_files.items()):
+        for j in range(n_sub):
+            dst = WSClean.output_name(interval_name(out_name, idx, n_intervals), j, chan, n_sub, n_chan) + \
+                "-model.fits"
+            link_or_copy(model_file, dst, link=link)
+            created.append(dst)
+    return created
+
+
+def build_rotated_model_series(model_files, t_ranges, n_sub, newtime, out_name, n_chan=1, n_intervals=None,
+                               **kwargs):
+    """
+    Generate a distinct rotated model for every predict sub-interval.
+
+    Instead of repeating the model of an interval, the model is registered
+    at each sub-interval and rotated from the sub-interval midpoint to
+    newtime with rotation_corr_util.model_to_j2000, so the rotation follows
+    the sub-interval times. Rotation plans and the sparse component path
+    keep this cheap.
+
+    Parameters
+    ----------
+    model_files : dict
+        Unrotated (RA-DEC) model image per (interval, channel)
+    t_ranges : list of (astropy.time.Time, astropy.time.Time)
+        (begin, end) of the predict range of every interval
+    n_sub : int
+        Number of sub-intervals per model interval
+    newtime : astropy.time.Time
+        The time the models are rotated to
+    out_name : str
+        Name prefix of the predicts
+    n_chan : int, optional
+        Number of output channels, defaults to 1
+    n_intervals : int, optional
+        Number of intervals of the plan, defaults to len(t_ranges)
+    **kwargs
+        Passed on to rotation_corr_util.model_to_j2000
+
+    Returns
+    -------
+    list of str
+        The model image names that were created
+    """
+    if n_intervals is None:
+        n_intervals = len(t_ranges)
+    created = []
+    for (idx, chan), model_file in sorted(model_files.items()):
+        model_data, model_header = read_fits(model_file)
+        sub_bins = np.linspace(t_ranges[idx][0], t_ranges[idx][1], n_sub + 1)
+        for j in range(n_sub):
+            dst = WSClean.output_name(interval_name(out_name, idx, n_intervals), j, chan, n_sub, n_chan) + \
+                "-model.fits"
+            rotation_corr_util.model_to_j2000(model_data, model_header, (sub_bins[j], sub_bins[j + 1]),
+                                              newtime, dst, **kwargs)
+            created.append(dst)
+    return created
@@ -0,0 +1,161 @@
+import os
+import json
+import numpy as np
+
+# sidecar file written next to the measurement set
+INDEX_SUFFIX = '.synop_index.json'
+
+_index_cache = {}
+
+
+def _ms_mtime(vis):
+    """
+    Modification time of the measurement set directory.
+
+    It changes when table files are added or removed (new rows layout, new
+    columns), not when existing columns such as FLAG are rewritten.
+    """
+    return os.stat(vis).st_mtime
+
+
+class MSIndex:
+    """
+    Metadata of a measurement set extracted in one pass with msmetadata.
+
+    Parameters
+    ----------
+    meta : dict
+        Content of the index, as built by build_ms_index
+    """
+
+    def __init__(self, meta):
+        self.meta = meta
+
+    @property
+    def scans(self):
+        """Scan numbers in the measurement set."""
+        return self.meta['scans']
+
+    @property
+    def antenna_ids(self):
+        """Antenna IDs in the measurement set."""
+        return self.meta['antenna_ids']
+
+    @property
+    def antenna_names(self):
+        """Antenna names in the measurement set."""
+        return self.meta['antenna_names']
+
+    @property
+    def field_names(self):
+        """Field names in the measurement set."""
+        return self.meta['field_names']
+
+    @property
+    def nspw(self):
+        """Number of spectral windows."""
+        return len(self.meta['spw_freqs'])
+
+    def timerange(self):
+        """(begin, end) of observation 0 in MJD days, as msmd.timerangeforobs(0)."""
+        return self.meta['timerange']['begin'], self.meta['timerange']['end']
+
+    def times_for_scan(self, scan):
+        """Times of a scan in MJD seconds, as msmd.timesforscans(scan)."""
+        return np.array(self.meta['times_for_scan'][str(scan)])
+
+    def times_for_field(self, field=0):
+        """Times of a field in MJD seconds, as msmd.timesforfield(field)."""
+        return np.array(self.meta['times_for_field'][str(field)])
+
+    def chan_freqs(self, spw):
+        """Channel frequencies of a spectral window in Hz."""
+        return np.array(self.meta['spw_freqs'][spw])
+
+
+def build_ms_index(vis):
+    """
+    Extract the metadata used by the pipeline from a measurement set.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+
+    Returns
+    -------
+    dict
+        Scans, per-scan and per-field times, spw frequencies, antennas and
+        fields, plus the path and modification time it was built from
+    """
+    from casatools import msmetadata
+
+    msmd = msmetadata()
+    msmd.open(vis)
+    try:
+        t_range = msmd.timerangeforobs(0)
+        scans = [int(scan) for scan in msmd.scannumbers()]
+        meta = {
+            'path': os.path.abspath(vis),
+            'mtime': _ms_mtime(vis),
+            'timerange': {'begin': t_range['begin']['m0']['value'],
+                          'end': t_range['end']['m0']['value']},
+            'scans': scans,
+            'times_for_scan': {str(scan): msmd.timesforscans(scan).tolist() for scan in scans},
+            'times_for_field': {str(field): msmd.timesforfield(field).tolist()
+                                for field in range(msmd.nfields())},
+            'spw_freqs': [msmd.chanfreqs(spw).tolist() for spw in range(msmd.nspw())],
+            'antenna_ids': [int(ant) for ant in msmd.antennaids()],
+            'antenna_names': list(msmd.antennanames()),
+            'field_names': list(msmd.fieldnames()),
+        }
+    finally:
+        msmd.done()
+    return meta
+
+
+def get_ms_index(vis, refresh=False):
+    """
+    Get the metadata index of a measurement set, building it if needed.
+
+    The index is kept in memory and in a JSON sidecar (vis + INDEX_SUFFIX),
+    and is rebuilt when the path or modification time of the MS changes.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    refresh : bool, optional
+        Rebuild the index even if a valid one exists, defaults to False
+
+    Returns
+    -------
+    MSIndex
+        Index of the measurement set
+    """
+    vis = vis.rstrip('/')
+    path = os.path.abspath(vis)
+    mtime = _ms_mtime(vis)
+    sidecar = vis + INDEX_SUFFIX
+
+    if not refresh:
+        cached = _index_cache.get(path)
+        if cached is not None and cached.meta['mtime'] == mtime:
+            return cached
+        if os.path.exists(sidecar):
+            try:
+                with open(sidecar) as f:
+                    meta = json.load(f)
+                if meta['path'] == path and meta['mtime'] == mtime:
+                    _index_cache[path] = MSIndex(meta)
+                    return _index_cache[path]
+            except (ValueError, KeyError) as e:
+                print(f"Ignoring unreadable index {sidecar}: {str(e)}")
+
+    meta = build_ms_index(vis)
+    tmp_file = f"{sidecar}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, sidecar)
+    _index_cache[path] = MSIndex(meta)
+    return _index_cache[path]
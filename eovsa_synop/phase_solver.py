@@ -0,0 +1,360 @@
+import os
+import time
+import shutil
+import numpy as np
+from eovsa_synop.telemetry import timed
+
+# (pol of antenna1, pol of antenna2) of the CORR_TYPE values (casacore Stokes types) of
+# circular and linear feeds, pol 0 being R or X and pol 1 L or Y
+CORR_TYPE_POLS = {
+    5: (0, 0), 6: (0, 1), 7: (1, 0), 8: (1, 1),      # RR, RL, LR, LL
+    9: (0, 0), 10: (0, 1), 11: (1, 0), 12: (1, 1),   # XX, XY, YX, YY
+}
+
+
+def _parallel_hands(corr_pols):
+    """Indices of the parallel hand correlations and their polarization."""
+    return [(corr, p1) for corr, (p1, p2) in enumerate(corr_pols) if p1 == p2]
+
+
+def _spw_ddids(vis, spws):
+    """Data description IDs of the requested spectral windows, as {spw: ddid}."""
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    try:
+        spw_of_ddid = tb.getcol('SPECTRAL_WINDOW_ID')
+    finally:
+        tb.close()
+    ddids = {int(spw): ddid for ddid, spw in enumerate(spw_of_ddid)}
+    if spws is None or spws == '':
+        return ddids
+    if isinstance(spws, str):
+        spws = [int(spw) for spw in spws.split(',')]
+    return {int(spw): ddids[int(spw)] for spw in spws}
+
+
+def _corr_pols(vis, ddids):
+    """
+    Polarization pairs of the correlations of data descriptions, as {ddid: [(pol1, pol2), ...]}.
+
+    Read from the CORR_TYPE of the POLARIZATION row of every data
+    description, in the order of the correlation axis of DATA; EOVSA
+    measurement sets store XX, YY, XY, YX.
+    """
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    try:
+        pol_of_ddid = tb.getcol('POLARIZATION_ID')
+    finally:
+        tb.close()
+    tb.open(os.path.join(vis, 'POLARIZATION'))
+    try:
+        corr_types = {int(pol_id): tb.getcell('CORR_TYPE', int(pol_id)) for pol_id in np.unique(pol_of_ddid)}
+    finally:
+        tb.close()
+    corr_pols = {}
+    for ddid in ddids:
+        corr_type = corr_types[int(pol_of_ddid[ddid])]
+        unknown = [int(c) for c in corr_type if int(c) not in CORR_TYPE_POLS]
+        if unknown:
+            raise ValueError(f"correlation types {unknown} of {vis} are not feed correlations")
+        corr_pols[ddid] = [CORR_TYPE_POLS[int(c)] for c in corr_type]
+    return corr_pols
+
+
+def accumulate_normal_matrix(acc, data, model, flag, weight, ant1, ant2, corr_pols):
+    """
+    Add a chunk of visibilities to the normal matrices of a phase-only solve.
+
+    For gains g with |g| = 1 and a single solution interval, minimizing
+    sum w |V_ij - g_i conj(g_j) M_ij|^2 only depends on
+    C_ij = sum w V_ij conj(M_ij) over time and channel (C_ji = conj(C_ij)),
+    so one pass over the data reduces it to one nant x nant matrix per
+    spw and polarization.
+
+    Parameters
+    ----------
+    acc : numpy.ndarray
+        Complex matrices of shape (npol, nant, nant), updated in place
+    data, model : numpy.ndarray
+        DATA and MODEL_DATA of shape (ncorr, nchan, nrow)
+    flag : numpy.ndarray
+        FLAG of shape (ncorr, nchan, nrow)
+    weight : numpy.ndarray
+        WEIGHT of shape (ncorr, nrow)
+    ant1, ant2 : numpy.ndarray
+        Antennas of every row
+    corr_pols : list of (int, int)
+        Polarizations of antenna1 and antenna2 of every correlation, see
+        _corr_pols; parallel hands of polarizations beyond npol are ignored
+    """
+    npol, nant, _ = acc.shape
+    cross = ant1 != ant2
+    bl = ant1[cross] * nant + ant2[cross]
+    bl_t = ant2[cross] * nant + ant1[cross]
+    for corr, pol in _parallel_hands(corr_pols):
+        if pol >= npol:
+            continue
+        w = np.where(flag[corr][:, cross], 0., weight[corr][cross])
+        s = (w * data[corr][:, cross] * np.conj(model[corr][:, cross])).sum(axis=0)
+        acc_pol = acc[pol].reshape(-1)
+        for idx, values in ((bl, s), (bl_t, np.conj(s))):
+            acc_pol += np.bincount(idx, values.real, minlength=nant * nant) \
+                + 1j * np.bincount(idx, values.imag, minlength=nant * nant)
+
+
+def solve_phases(acc, refant=0, maxiter=100, tol=1e-8):
+    """
+    Phase-only gains from the normal matrices of accumulate_normal_matrix.
+
+    The gains are found by the alternating update g_i = phase(sum_j C_ij g_j),
+    averaged with the previous iterate, and referenced to refant; if refant
+    has no data the first antenna with data is used, as refantmode='flex'.
+
+    Parameters
+    ----------
+    acc : numpy.ndarray
+        Complex matrices of shape (npol, nant, nant)
+    refant : int, optional
+        Reference antenna, defaults to 0
+    maxiter : int, optional
+        Maximum number of iterations, defaults to 100
+    tol : float, optional
+        Convergence threshold on the gain change, defaults to 1e-8
+
+    Returns
+    -------
+    gains : numpy.ndarray
+        Complex gains of shape (npol, nant), 1 where not solved
+    solved : numpy.ndarray
+        Boolean array of shape (npol, nant), False for antennas without data
+    """
+    npol, nant, _ = acc.shape
+    gains = np.ones((npol, nant), dtype=complex)
+    solved = np.abs(acc).sum(axis=2) > 0
+    for pol in range(npol):
+        g = gains[pol]
+        for _ in range(maxiter):
+            g_new = acc[pol] @ g
+            amp = np.abs(g_new)
+            g_new = np.where(amp > 0, g_new / np.where(amp > 0, amp, 1), 1)
+            g_new = (g + g_new) / 2
+            g_new /= np.maximum(np.abs(g_new), 1e-30)
+            converged = np.max(np.abs(g_new - g)) < tol
+            g = g_new
+            if converged:
+                break
+        ref = refant if solved[pol, refant] else (np.argmax(solved[pol]) if solved[pol].any() else refant)
+        g = g * np.conj(g[ref])
+        gains[pol] = np.where(solved[pol], g, 1)
+    return gains, solved
+
+
+def apply_gains(data, flag, gains, solved, ant1, ant2, corr_pols):
+    """
+    Correct a chunk of visibilities with phase-only gains.
+
+    Returns the corrected data, V_ij / (g_i conj(g_j)), and the flags with
+    the correlations of unsolved antennas flagged, as applycal does. Every
+    correlation is corrected with the gains of its polarizations in
+    corr_pols, see _corr_pols.
+    """
+    corrected = np.empty_like(data)
+    new_flag = flag.copy()
+    for corr, (p1, p2) in enumerate(corr_pols):
+        p1, p2 = min(p1, gains.shape[0] - 1), min(p2, gains.shape[0] - 1)
+        corrected[corr] = data[corr] * np.conj(gains[p1, ant1]) * gains[p2, ant2]
+        new_flag[corr] |= ~(solved[p1, ant1] & solved[p2, ant2])
+    return corrected, new_flag
+
+
+def _ensure_corrected_column(tb):
+    """Add a CORRECTED_DATA column like DATA if the table has none."""
+    if 'CORRECTED_DATA' in tb.colnames():
+        return
+    desc = tb.getcoldesc('DATA')
+    dminfo = tb.getdminfo('DATA')
+    dminfo['NAME'] = 'CorrectedData'
+    tb.addcols({'CORRECTED_DATA': desc}, dminfo)
+
+
+@timed('selfcal_phase')
+def selfcal_phase(vis, spws=None, refant=0, apply=True, gain_file=None, chunk_rows=20000, npol=2):
+    """
+    Phase-only self-calibration of a measurement set without gaincal/applycal.
+
+    Equivalent to gaincal(solint='inf', combine='scan', gaintype='G',
+    calmode='p', refantmode='flex') followed by applycal for every requested
+    spw: DATA, MODEL_DATA, FLAG and WEIGHT are streamed once in row chunks
+    and reduced to per-antenna normal matrices for all spws together, the
+    gains are solved, and with apply a second sweep writes CORRECTED_DATA
+    (and the flags of unsolved antennas). Gains of all spws are saved
+    together, so a scan with several spw groups is calibrated in the same
+    two sweeps.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set, with MODEL_DATA filled by a predict
+    spws : str or list of int, optional
+        Comma separated spectral windows, defaults to all
+    refant : int, optional
+        Reference antenna, defaults to 0
+    apply : bool, optional
+        Write CORRECTED_DATA, defaults to True
+    gain_file : str, optional
+        Save the gains to this .npz file (spw, gains, solved)
+    chunk_rows : int, optional
+        Number of rows read at once, defaults to 20000
+    npol : int, optional
+        Number of polarizations solved, defaults to 2
+
+    Returns
+    -------
+    dict
+        Gains and solved masks per spw, as {spw: (gains, solved)}
+    """
+    from casatools import table
+
+    ddids = _spw_ddids(vis, spws)
+    corr_pols = _corr_pols(vis, ddids.values())
+    tb = table()
+    tb.open(vis, nomodify=not apply)
+    try:
+        nant = int(max(tb.getcol('ANTENNA1').max(), tb.getcol('ANTENNA2').max())) + 1
+        if apply:
+            _ensure_corrected_column(tb)
+        subtables = {spw: tb.query(f'DATA_DESC_ID=={ddid}') for spw, ddid in ddids.items()}
+        try:
+            # sweep 1 : normal matrices of all spws
+            acc = {spw: np.zeros((npol, nant, nant), dtype=complex) for spw in subtables}
+            for spw, subtb in subtables.items():
+                for row in range(0, subtb.nrows(), chunk_rows):
+                    nrow = min(chunk_rows, subtb.nrows() - row)
+                    accumulate_normal_matrix(acc[spw], subtb.getcol('DATA', row, nrow),
+                                             subtb.getcol('MODEL_DATA', row, nrow),
+                                             subtb.getcol('FLAG', row, nrow),
+                                             subtb.getcol('WEIGHT', row, nrow),
+                                             subtb.getcol('ANTENNA1', row, nrow),
+                                             subtb.getcol('ANTENNA2', row, nrow),
+                                             corr_pols[ddids[spw]])
+            solutions = {spw: solve_phases(acc[spw], refant=refant) for spw in subtables}
+
+            # sweep 2 : apply
+            if apply:
+                for spw, subtb in subtables.items():
+                    gains, solved = solutions[spw]
+                    for row in range(0, subtb.nrows(), chunk_rows):
+                        nrow = min(chunk_rows, subtb.nrows() - row)
+                        flag = subtb.getcol('FLAG', row, nrow)
+                        corrected, new_flag = apply_gains(subtb.getcol('DATA', row, nrow), flag, gains, solved,
+                                                          subtb.getcol('ANTENNA1', row, nrow),
+                                                          subtb.getcol('ANTENNA2', row, nrow),
+                                                          corr_pols[ddids[spw]])
+                        subtb.putcol('CORRECTED_DATA', corrected, row, nrow)
+                        if (new_flag != flag).any():
+                            subtb.putcol('FLAG', new_flag, row, nrow)
+        finally:
+            for subtb in subtables.values():
+                subtb.close()
+    finally:
+        tb.close()
+
+    if gain_file is not None:
+        spw_list = sorted(solutions)
+        np.savez(gain_file, spw=np.array(spw_list),
+                 gains=np.array([solutions[spw][0] for spw in spw_list]),
+                 solved=np.array([solutions[spw][1] for spw in spw_list]))
+    return solutions
+
+
+def read_casa_gains(caltable):
+    """
+    Read the gains of a single-interval gaincal table.
+
+    Returns
+    -------
+    dict
+        Gains and solved masks per spw, as {spw: (gains, solved)} with
+        arrays of shape (npol, nant) like selfcal_phase
+    """
+    from casatools import table
+
+    tb = table()
+    tb.open(caltable)
+    try:
+        cparam = tb.getcol('CPARAM')[:, 0, :]
+        cflag = tb.getcol('FLAG')[:, 0, :]
+        ant = tb.getcol('ANTENNA1')
+        spw_col = tb.getcol('SPECTRAL_WINDOW_ID')
+    finally:
+        tb.close()
+    nant = int(ant.max()) + 1
+    solutions = {}
+    for spw in np.unique(spw_col):
+        sel = spw_col == spw
+        gains = np.ones((cparam.shape[0], nant), dtype=complex)
+        solved = np.zeros((cparam.shape[0], nant), dtype=bool)
+        gains[:, ant[sel]] = cparam[:, sel]
+        solved[:, ant[sel]] = ~cflag[:, sel]
+        solutions[int(spw)] = (gains, solved)
+    return solutions
+
+
+def benchmark_against_casa(vis, spws, caltable, refant=0):
+    """
+    Time selfcal_phase against gaincal + applycal and compare the phases.
+
+    Both paths are run on vis, which needs MODEL_DATA; the CASA path runs
+    last, so CORRECTED_DATA is left as applycal wrote it.
+
+    Parameters
+    ----------
+    vis : str
+        Path to the measurement set
+    spws : str
+        Comma separated spectral windows
+    caltable : str
+        Gain table written by gaincal, replaced if it exists
+    refant : int, optional
+        Reference antenna, defaults to 0
+
+    Returns
+    -------
+    dict
+        Wall times of both paths (seconds) and the largest phase difference
+        (degrees) over the antennas solved by both
+    """
+    from casatasks import gaincal, applycal
+
+    t_start = time.time()
+    ours = selfcal_phase(vis, spws=spws, refant=refant, apply=True)
+    t_ours = time.time() - t_start
+
+    if os.path.exists(caltable):
+        shutil.rmtree(caltable)
+    t_start = time.time()
+    gaincal(vis=vis, caltable=caltable, spw=spws, solint='inf', combine='scan', refant=str(refant),
+            gaintype='G', calmode='p', refantmode='flex', minsnr=1.0)
+    applycal(vis=vis, spw=spws, gaintable=caltable, interp='linear', calwt=False)
+    t_casa = time.time() - t_start
+
+    theirs = read_casa_gains(caltable)
+    max_diff = 0.
+    for spw, (gains, solved) in ours.items():
+        if spw not in theirs:
+            continue
+        casa_gains, casa_solved = theirs[spw]
+        npol = min(gains.shape[0], casa_gains.shape[0])
+        nant = min(gains.shape[1], casa_gains.shape[1])
+        both = solved[:npol, :nant] & casa_solved[:npol, :nant]
+        diff = np.angle(gains[:npol, :nant] * np.conj(casa_gains[:npol, :nant]), deg=True)
+        if both.any():
+            max_diff = max(max_diff, float(np.abs(diff[both]).max()))
+    print(f"selfcal_phase {t_ours:.1f} s, gaincal+applycal {t_casa:.1f} s, "
+          f"max phase difference {max_diff:.3f} deg")
+    return {'selfcal_phase_sec': t_ours, 'casa_sec': t_casa, 'max_phase_diff_deg': max_diff}
@@ -0,0 +1,637 @@
+import os
+import re
+import shutil
+import fcntl
+from glob import glob
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from astropy.time import Time
+
+from eovsa_synop import (wrap_wsclean, rotation_corr_util, split_by_scan, flag_ants, flagging, phase_solver,
+                         averaging, intervals, telemetry)
+from eovsa_synop.model_series import build_model_series, build_rotated_model_series, interval_name
+from eovsa_synop.ms_index import get_ms_index
+from eovsa_synop.checkpoint import CheckpointStore
+from eovsa_synop.fits_io import read_fits
+from eovsa_synop.telemetry import stage
+from eovsa_synop.ephemeris import get_ephemeris, get_msinfo, horizons_from_cache
+
+# spectral window groups imaged together in the daily synoptic run
+SPWS_ALL = [
+    '0,1',
+    '2,3,4',
+    '5,6,7,8,9,10',
+    '11,12,13,14,15,16,17,18,19,20',
+    '21,22,23,24,25,26,27,28,29,30',
+    '31,32,33,34,35,36,37,38,39,40',
+    '41,42,43,44,45,46,47,48,49'
+]
+
+_THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def _init_worker(threads_per_worker, run_labels=None):
+    """Limit the thread pools of a worker process to its share of the node."""
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(threads_per_worker)
+    if run_labels:
+        telemetry.set_labels(**run_labels)
+
+
+@contextmanager
+def _ms_lock(msfile):
+    """
+    Hold an exclusive lock on a measurement set while writing to it.
+
+    Units of the same scan write disjoint spectral windows, but the column
+    creation done by wsclean predict and gaincal/applycal is not safe to run
+    from two processes at once.
+    """
+    with open(msfile.rstrip('/') + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_scan_files(fname_root):
+    """
+    Find the per-scan measurement sets written by split_ms_by_scan.
+
+    Parameters
+    ----------
+    fname_root : str
+        Path to the full-day measurement set
+
+    Returns
+    -------
+    list of (int, str)
+        (scan number, path) pairs sorted by scan number
+    """
+    base_name = fname_root.split('.ms')[0]
+    scan_files = []
+    for msfile in glob(base_name + "_scan*.ms"):
+        match = re.search(r'_scan(\d+)\.ms$', msfile)
+        if match:
+            scan_files.append((int(match.group(1)), msfile))
+    return sorted(scan_files)
+
+
+def flag_scan(msfile, one_pass=False, keep_antennas=range(13), n_threads=1, lock_ms=None):
+    """
+    Run tfcrop flagging on a scan measurement set, once.
+
+    Parameters
+    ----------
+    msfile : str
+        Path to the scan measurement set
+    one_pass : bool, optional
+        Flag the antennas not in keep_antennas and tfcrop outliers together
+        with flagging.flag_one_pass instead of flagdata (default: False).
+        Flags saved by an earlier run are restored first, so flagging again
+        starts from the original flags
+    keep_antennas : list or range, optional
+        Antennas kept in one_pass mode
+    n_threads : int, optional
+        Threads used by flag_one_pass
+    lock_ms : str, optional
+        Measurement set whose lock is held while flagging, when msfile
+        writes into it
+    """
+    from casatasks import flagdata
+
+    with _ms_lock(lock_ms or msfile):
+        if one_pass:
+            if os.path.exists(msfile.rstrip('/') + flagging.BACKUP_SUFFIX):
+                flagging.restore_flags(msfile)
+            flagging.flag_one_pass(msfile, keep_antennas=keep_antennas, timecutoff=2.0, freqcutoff=2.0,
+                                   n_threads=n_threads)
+        elif not os.path.exists(msfile + ".flagversions"):
+            with stage('tfcrop', ms=os.path.basename(msfile)):
+                flagdata(vis=msfile, mode="tfcrop", spw='', action='apply', display='',
+                         timecutoff=2.0, freqcutoff=2.0, maxnpieces=2, flagbackup=False)
+    return msfile
+
+
+def process_unit(msfile, scan_num, spws_this, runtime_dir, threads=None,
+                 interval_sec=2000, split_N2=8, min_fill=0.75, fused=False, lock_ms=None,
+                 scratch_dir=None, predict_pol=None, model_series='hard', solver='casa', resume=True,
+                 upstream=None, image_timeout=None, stall_cycles=None, plan_cache_dir=None):
+    """
+    Run one round of self-calibration for a (scan, spw group) unit.
+
+    The unit plans imaging intervals from the unflagged data of the scan
+    (see intervals.plan_intervals), images every interval, rotates the
+    model images to 20:00 UT of the observing day, predicts the rotated
+    models into MODEL_DATA and solves and applies phase-only gains for the
+    spw group. Intervals are imaged and predicted in a wsclean run each,
+    selected with -interval, so empty and flagged stretches of the scan
+    cost no imaging. Every run reorders the timesteps of its own interval,
+    so the scan is reordered about once for imaging and once for the
+    predicts, as by one -intervals-out run of each, but every run adds its
+    own start-up and row range lookup; the reordered files of an interval
+    are reused by its predict only in the case described under
+    predict_pol. Given a list of spw groups, all groups are imaged and
+    predicted in the same runs, one output channel per group.
+
+    Parameters
+    ----------
+    msfile : str
+        Path to the scan measurement set
+    scan_num : int
+        Scan number of the measurement set
+    spws_this : str or list of str
+        Comma separated spectral windows of the group, or a list of groups
+    runtime_dir : str
+        Working directory of this unit, holding its checkpoints
+    threads : int, optional
+        Number of threads given to wsclean, defaults to all cores
+    interval_sec : float, optional
+        Length in seconds of an imaging interval without flags, intervals
+        with flagged data are longer, up to 1.5 times this
+    split_N2 : int, optional
+        Number of predict sub-intervals per imaging interval
+    min_fill : float, optional
+        Intervals holding less unflagged data than this fraction of an
+        unflagged interval_sec interval are merged or dropped; a scan left
+        without intervals is skipped
+    fused : bool, optional
+        Register and rotate the models in memory with
+        rotation_corr_util.model_to_j2000 instead of imreg and the two
+        file-based rotation steps
+    lock_ms : str, optional
+        Measurement set whose lock guards the writes of this unit, defaults
+        to msfile; the parent MS when msfile is a reference table
+    scratch_dir : str, optional
+        Directory (e.g. local disk or tmpfs) for the wsclean temp and
+        reordered files of this unit, defaults to the runtime directory
+    predict_pol : str, optional
+        Polarization of the predict, defaults to wsclean's default. The
+        reordered files of an interval's imaging run are reused by its
+        predict when that selects the same data: predict_pol "xx" (the
+        imaging polarization), split_N2 1 and no timesteps dropped around
+        the interval
+    model_series : str, optional
+        How the N1*N2 predict models are made: 'hard' (default) or 'symlink'
+        links to one rotated model per interval, 'copy' copies it, and
+        'rotate' rotates every sub-interval's model from its own midpoint
+    solver : str, optional
+        'casa' (default) solves with gaincal and applies with applycal,
+        'builtin' uses phase_solver.selfcal_phase, which solves all spws of
+        the unit in one sweep over the visibilities and applies in a second
+    resume : bool, optional
+        Keep the runtime directory and skip the stages whose checkpoint is
+        still valid (default). If False the runtime directory is wiped first
+    upstream : str, optional
+        Digest of the stage that produced msfile (e.g. its flagging), so a
+        change upstream invalidates every stage of the unit
+    image_timeout : float, optional
+        Wall-clock seconds after which the imaging run of an interval is
+        stopped; the interval then has no model, and a resume does not
+        image it again unless the imaging parameters change
+    stall_cycles : int, optional
+        Stop the imaging run of an interval when its residual peak has not
+        improved over this many major cycles, e.g. 3
+    plan_cache_dir : str, optional
+        Directory the rotation plans are saved to and loaded from, see
+        rotation_corr_util.get_rotation_plan; run_day shares one per day so
+        that the spw groups of a scan, in other worker processes, reuse them
+
+    Returns
+    -------
+    dict
+        Summary of the unit with keys 'scan', 'spws' and 'status', and
+        'stopped', the reason per interval whose imaging run was stopped
+    """
+    from casatasks import gaincal, applycal
+    from suncasa.eovsa.eovsa_synoptic_imaging_pipeline import trange2timerange
+    from suncasa.utils import helioimage2fits as hf
+
+    result = {'scan': scan_num, 'spws': spws_this, 'status': 'done'}
+    runtime_dir = os.path.join(runtime_dir, '')
+
+    ms_index = get_ms_index(msfile)
+    date_mjd = ms_index.timerange()[0]
+
+    # use the date and 20:00 as reference time
+    date_withouttime = Time(date_mjd, format='mjd').iso[0:10]
+    ref_time = Time(date_withouttime + " 20:00:00", format='iso')
+
+    if not resume and os.path.exists(runtime_dir):
+        shutil.rmtree(runtime_dir)
+    os.makedirs(runtime_dir, exist_ok=True)
+    ckpt = CheckpointStore(runtime_dir + "checkpoints.json")
+
+    # several spw groups are imaged in one run as separate output channels
+    spw_groups = [spws_this] if isinstance(spws_this, str) else list(spws_this)
+    n_chan = len(spw_groups)
+    spws_sel = ','.join(spw_groups)
+
+    # step 0 : plan the intervals on the unflagged data
+    plan_file = runtime_dir + "intervals.json"
+
+    def plan_scan():
+        times, counts, full_per_step = intervals.unflagged_counts(msfile, spws=spws_sel)
+        intervals.save_plan(intervals.plan_intervals(times, counts, interval_sec=interval_sec, min_fill=min_fill,
+                                                     full_per_step=full_per_step), plan_file)
+
+    ckpt.run('plan', plan_scan,
+             params={'spws': spws_sel, 'interval_sec': interval_sec, 'min_fill': min_fill, 'upstream': upstream},
+             outputs=[plan_file])
+    plan = intervals.load_plan(plan_file)
+    if len(plan) == 0:
+        print(f"skip scan {scan_num}, no interval with enough unflagged data")
+        result['status'] = 'skipped'
+        return result
+    n_intervals = len(plan)
+    t_ranges = [tuple(Time(t / 3600 / 24, format='mjd') for t in interval['trange']) for interval in plan]
+    predict_t_ranges = [tuple(Time(t / 3600 / 24, format='mjd') for t in interval['predict_trange'])
+                        for interval in plan]
+    ephem_cache = get_ephemeris(date_withouttime)
+
+    if scratch_dir is None:
+        temp_dir = runtime_dir + "tmp"
+    else:
+        temp_dir = os.path.join(scratch_dir, os.path.basename(os.path.normpath(runtime_dir)))
+    os.makedirs(temp_dir, exist_ok=True)
+
+    # step 1 : make round1 image of every interval
+    clean_obj = wrap_wsclean.WSClean(vis=msfile)
+    clean_obj.setup(size=1024, scale="2.5asec", weight_briggs=0.0, pol="xx",
+                    niter=3000, mgain=0.85, data_column="DATA",
+                    name=runtime_dir + "eovsa", multiscale=True,
+                    auto_mask=6, auto_threshold=3,
+                    no_update_model=True,
+                    no_negative=True, quiet=True,
+                    spws=spws_sel)
+    if n_chan > 1:
+        clean_obj.setup_spw_groups(spw_groups, [ms_index.chan_freqs(spw) for spw in range(ms_index.nspw)])
+    if threads is not None:
+        clean_obj.setup(threads=threads)
+    if image_timeout is not None:
+        clean_obj.setup(timeout=image_timeout)
+    if stall_cycles is not None:
+        clean_obj.setup(stall_cycles=stall_cycles)
+
+    # every interval keeps its reordered files in its own temp dir, saved only when
+    # its predict selects the same data
+    def interval_temp_dir(idx):
+        return os.path.join(temp_dir, f"t{idx:04d}")
+
+    model_files = {}
+    for idx, interval in enumerate(plan):
+        os.makedirs(interval_temp_dir(idx), exist_ok=True)
+        clean_obj.setup(name=interval_name(runtime_dir + "eovsa", idx, n_intervals), interval=interval['index'],
+                        temp_dir=interval_temp_dir(idx),
+                        save_reordered=(predict_pol == "xx" and split_N2 == 1 and
+                                        interval['predict_index'] == interval['index']))
+        image_params = {key: value for key, value in clean_obj.params.items()
+                        if key not in ('threads', 'temp_dir', 'abs_mem', 'save_reordered', 'quiet')}
+        image_stage = f'image:{idx}'
+        image_stage_params = {'wsclean': image_params, 'upstream': upstream}
+        # a failed run raises and is not recorded; a stopped one leaves the interval without
+        # a model and is recorded with its reason, so a resume skips it until the parameters
+        # (e.g. image_timeout) change
+        try:
+            with telemetry.labels(interval=idx):
+                image_outputs = ckpt.run(image_stage, lambda: clean_obj.run(dryrun=False, check=True),
+                                         params=image_stage_params, deps=['plan'],
+                                         outputs=lambda: [f for f in clean_obj.output_files()
+                                                          if f.endswith('-model.fits')])
+        except wrap_wsclean.WSCleanError as e:
+            if e.stop_reason is None:
+                raise
+            ckpt.record(image_stage, params=image_stage_params, deps=['plan'], stopped=e.stop_reason)
+        if ckpt.stop_reason(image_stage) is not None:
+            result.setdefault('stopped', {})[idx] = ckpt.stop_reason(image_stage)
+            continue
+        for chan in range(n_chan):
+            fitsname = wrap_wsclean.WSClean.output_name(runtime_dir + "eovsa", idx, chan,
+                                                        n_intervals, n_chan) + "-model.fits"
+            if fitsname in image_outputs:
+                model_files[(idx, chan)] = fitsname
+
+    if len(model_files) == 0:
+        print("no model images at scan", scan_num)
+        result['status'] = 'no_model'
+        return result
+
+    model_dir = runtime_dir + "modelrot/"
+    os.makedirs(model_dir, exist_ok=True)
+
+    if model_series == 'rotate':
+        # step 2 : rotate every sub-interval's model to reftime
+        series_name = model_dir + "eovsa"
+        ckpt.run('series', lambda: build_rotated_model_series(model_files, predict_t_ranges, split_N2, ref_time,
+                                                              series_name, n_chan=n_chan, n_intervals=n_intervals,
+                                                              ephem_cache=ephem_cache,
+                                                              plan_cache_dir=plan_cache_dir),
+                 inputs=sorted(model_files.values()),
+                 params={'ref_time': ref_time.iso, 'split_N2': split_N2, 'mode': model_series,
+                         't_ranges': [(t0.iso, t1.iso) for t0, t1 in predict_t_ranges]},
+                 outputs=lambda: sorted(glob(series_name + "*-model.fits")))
+    else:
+        # step 2.1 : rotate the model images of every interval and group to reftime
+        rotated_model_files = {}
+        for (idx, chan), fitsname in model_files.items():
+            rotated_name = fitsname.replace("model.fits", "model.helio.rot.j2000.fits")
+
+            def rotate_model(idx=idx, fitsname=fitsname, rotated_name=rotated_name):
+                if fused:
+                    model_data, model_header = read_fits(fitsname)
+                    rotation_corr_util.model_to_j2000(
+                        model_data, model_header, t_ranges[idx], ref_time,
+                        rotated_name, ephem_cache=ephem_cache, plan_cache_dir=plan_cache_dir)
+                else:
+                    timerangethis = trange2timerange(list(t_ranges[idx]))
+                    heliofitsname = fitsname.replace("model.fits", "model.helio.fits")
+                    with horizons_from_cache(ephem_cache), stage('imreg'):
+                        hf.imreg(vis=msfile, imagefile=fitsname, fitsfile=heliofitsname,
+                                 timerange=timerangethis, msinfo=get_msinfo(msfile),
+                                 ephem=ephem_cache.to_horizons(t_ranges[idx]))
+                    heliorotname = heliofitsname.replace("model.helio.fits", "model.helio.rot.fits")
+                    rotation_corr_util.solar_diff_rot_heliofits(heliofitsname, ref_time, heliorotname,
+                                                                plan_cache_dir=plan_cache_dir)
+                    rotation_corr_util.sunpyfits_to_j2000fits(heliorotname, rotated_name,
+                                                              template_fits=fitsname, overwrite_prev=True)
+
+            with telemetry.labels(interval=idx, channel=chan):
+                ckpt.run(f'rotate:{idx}:{chan}', rotate_model, inputs=[fitsname],
+                         params={'ref_time': ref_time.iso, 'fused': fused,
+                                 'trange': [t_ranges[idx][0].iso, t_ranges[idx][1].iso]},
+                         outputs=[rotated_name])
+            rotated_model_files[(idx, chan)] = rotated_name
+
+        # step 2.2 : reference the model image of every interval split_N2 times
+        series_outputs = []
+        ckpt.run('series', lambda: series_outputs.extend(
+                     build_model_series(rotated_model_files, model_dir + "eovsa", split_N2,
+                                        n_chan=n_chan, link=model_series, n_intervals=n_intervals)),
+                 params={'split_N2': split_N2, 'mode': model_series},
+                 deps=[f'rotate:{idx}:{chan}' for idx, chan in sorted(rotated_model_files)],
+                 outputs=lambda: series_outputs)
+
+    with _ms_lock(lock_ms or msfile):
+        # step 3 : predict visibilities for each model image, over the timesteps of every
+        # interval and its share of the dropped ones
+        predict_stages = []
+        # the imaging budget does not apply to the predicts
+        clean_obj.setup(timeout=None, stall_cycles=None)
+        for idx in sorted(set(idx for idx, _ in model_files)):
+            predict_index = plan[idx]['predict_index']
+            clean_obj.setup(temp_dir=interval_temp_dir(idx))
+            with telemetry.labels(interval=idx):
+                ckpt.run(f'predict:{idx}', lambda: clean_obj.predict(
+                             name=interval_name(model_dir + 'eovsa', idx, n_intervals), intervals_out=split_N2,
+                             spws=spws_sel, pol=predict_pol, interval=predict_index, check=True),
+                         params={'spws': spws_sel, 'pol': predict_pol, 'intervals_out': split_N2,
+                                 'interval': predict_index},
+                         deps=['series'])
+            predict_stages.append(f'predict:{idx}')
+
+        # step 4 : gaincal and applycal, solutions are per spw so groups can be solved together
+        if solver == 'builtin':
+            gain_file = runtime_dir + "gains.npz"
+            ckpt.run('selfcal', lambda: phase_solver.selfcal_phase(msfile, spws=spws_sel, refant=0, apply=True,
+                                                                   gain_file=gain_file),
+                     params={'spws': spws_sel}, deps=predict_stages, outputs=[gain_file])
+        else:
+            caltable = runtime_dir + "caltable"
+
+            def solve_gains():
+                with stage('gaincal'):
+                    gaincal(vis=msfile, caltable=caltable, spw=spws_sel, solint='inf', combine='scan',
+                            refant='0', gaintype='G', calmode='p', refantmode='flex', minsnr=1.0)
+
+            def apply_gains():
+                with stage('applycal'):
+                    applycal(vis=msfile, spw=spws_sel, gaintable=caltable, interp='linear', calwt=False)
+
+            ckpt.run('gaincal', solve_gains, params={'spws': spws_sel}, deps=predict_stages, outputs=[caltable])
+            ckpt.run('applycal', apply_gains, params={'spws': spws_sel}, deps=['gaincal'])
+
+    if scratch_dir is not None:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return result
+
+
+def _run_unit(args, kwargs):
+    """Pool entry point, reports failures instead of raising them."""
+    msfile, scan_num, spws_this, runtime_dir = args
+    try:
+        with telemetry.labels(scan=scan_num, spws=spws_this):
+            return process_unit(msfile, scan_num, spws_this, runtime_dir, **kwargs)
+    except Exception as e:
+        print(f"Error processing scan {scan_num} spws {spws_this}: {str(e)}")
+        return {'scan': scan_num, 'spws': spws_this, 'status': 'failed', 'error': str(e)}
+
+
+def run_day(fname_root, spws_all=SPWS_ALL, runtime_root="./runtime", n_workers=None,
+            threads_per_worker=4, keep_antennas=range(13), split_mode='copy', joint_spw=False,
+            flag_mode='flagdata', average=False, average_loss=0.02, resume=True, telemetry_file=None,
+            **unit_kwargs):
+    """
+    Run the daily self-calibration and imaging loop in parallel.
+
+    Every (scan, spw group) pair is processed as an independent unit in a
+    process pool, each unit in its own runtime directory
+    ``runtime_root/scan<N>_spw<first>-<last>/``. With joint_spw, a unit is a
+    whole scan whose spw groups share one imaging and one predict run.
+
+    Parameters
+    ----------
+    fname_root : str
+        Path to the full-day measurement set, e.g. "UDB20241212.ms"
+    spws_all : list of str, optional
+        Spectral window groups, defaults to SPWS_ALL
+    runtime_root : str, optional
+        Parent directory of the per-unit runtime directories
+    n_workers : int, optional
+        Number of worker processes, defaults to cpu_count // threads_per_worker
+    threads_per_worker : int, optional
+        Number of threads each worker and its wsclean runs may use
+    keep_antennas : list or range, optional
+        Antennas kept by the antenna flagging step
+    split_mode : str, optional
+        Mode of split_ms_by_scan; with 'reference' all scans write into
+        fname_root and their writes are serialized on it
+    joint_spw : bool, optional
+        Process all spw groups of a scan together, reading its
+        visibilities once per stage instead of once per group
+    flag_mode : str, optional
+        'flagdata' flags the antennas on fname_root and runs flagdata tfcrop
+        on every scan (default); 'one_pass' does both on every scan in a
+        single pass with flagging.flag_one_pass
+    average : bool, optional
+        Image and calibrate time and channel averaged copies of the scans,
+        see averaging.average_ms (default: False)
+    average_loss : float, optional
+        Peak loss tolerated from each of time and bandwidth smearing at the
+        image edge when averaging, defaults to 0.02
+    resume : bool, optional
+        Skip the stages, day-level and per unit, whose checkpoint is still
+        valid (default). If False everything is run again
+    telemetry_file : str, optional
+        JSON-lines file the stage timings are appended to, defaults to
+        runtime_root/telemetry.jsonl; see telemetry.summarize
+    **unit_kwargs
+        Passed on to process_unit, e.g. fused=True; plan_cache_dir defaults
+        to runtime_root/rotplans
+
+    Returns
+    -------
+    list of dict
+        One summary per unit, as returned by process_unit
+    """
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    # every record of the day, in this process and the workers, is labelled with its date
+    day = Time(get_ms_index(fname_root).timerange()[0], format='mjd').iso[0:10]
+    telemetry.configure(telemetry_file or os.path.join(runtime_root, "telemetry.jsonl"))
+    with telemetry.labels(day=day):
+        unit_kwargs.setdefault('threads', threads_per_worker)
+        unit_kwargs.setdefault('resume', resume)
+        unit_kwargs.setdefault('plan_cache_dir', os.path.join(runtime_root, "rotplans"))
+        if split_mode == 'reference' and not average:
+            unit_kwargs.setdefault('lock_ms', fname_root)
+        results = []
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(threads_per_worker, {'day': day})) as pool:
+            ckpt, scan_files = prepare_day(fname_root, runtime_root=runtime_root, keep_antennas=keep_antennas,
+                                           split_mode=split_mode, flag_mode=flag_mode, average=average,
+                                           average_loss=average_loss, resume=resume,
+                                           n_threads=threads_per_worker, pool=pool)
+            units = day_units(scan_files, spws_all, runtime_root, joint_spw=joint_spw)
+            print(f"Processing {len(scan_files)} scans x {len(spws_all)} spw groups with {n_workers} workers")
+
+            # a unit is invalidated when the flagging of its scan changes
+            futures = []
+            for unit in units:
+                upstream = unit_upstream(ckpt, unit[0])
+                futures.append(pool.submit(_run_unit, unit, dict(unit_kwargs, upstream=upstream)))
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"scan {result['scan']} spws {result['spws']}: {result['status']}")
+                results.append(result)
+
+        return sorted(results, key=lambda r: (r['scan'], str(r['spws'])))
+
+
+def prepare_day(fname_root, runtime_root="./runtime", keep_antennas=range(13), split_mode='copy',
+                flag_mode='flagdata', average=False, average_loss=0.02, resume=True, n_threads=1, pool=None):
+    """
+    Flag and split a day by scan, then flag (and average) every scan, before any unit runs.
+
+    The stages are checkpointed in runtime_root/checkpoints.json, chained by
+    dependency since later stages write into the same measurement sets.
+
+    Parameters
+    ----------
+    fname_root : str
+        Path to the full-day measurement set
+    runtime_root : str, optional
+        Directory of the day-level checkpoints
+    keep_antennas, split_mode, flag_mode, average, average_loss, resume
+        See run_day
+    n_threads : int, optional
+        Threads used by the flagging of a scan
+    pool : concurrent.futures.Executor, optional
+        Executor the scans are flagged in, in this process by default
+
+    Returns
+    -------
+    (CheckpointStore, list of (int, str))
+        The day-level checkpoints, whose 'flag_scan:<ms>' or 'average:<ms>'
+        records give the upstream digest of the units (see unit_upstream),
+        and the scan files as get_scan_files, or their averaged copies in
+        runtime_root/averaged/
+    """
+    ckpt = CheckpointStore(os.path.join(runtime_root, "checkpoints.json"))
+    if not resume:
+        for stage_name in list(ckpt.records):
+            ckpt.invalidate(stage_name)
+    if flag_mode != 'one_pass':
+        ckpt.run('flag_ants', lambda: flag_ants.flag_keep_antennas(fname_root, keep_antennas=keep_antennas,
+                                                                    raise_errors=True),
+                 params={'vis': os.path.abspath(fname_root), 'keep_antennas': list(keep_antennas)},
+                 outputs=[fname_root])
+    ckpt.run('split', lambda: split_by_scan.split_ms_by_scan(fname_root, mode=split_mode, raise_errors=True),
+             params={'mode': split_mode, 'flag_mode': flag_mode}, deps=['flag_ants'],
+             outputs=lambda: [msfile for _, msfile in get_scan_files(fname_root)])
+    scan_files = get_scan_files(fname_root)
+    # computed once here, the workers read it from the cache
+    get_ephemeris(Time(get_ms_index(fname_root).timerange()[0], format='mjd').iso[0:10])
+
+    # tfcrop flagging, once per scan before any unit reads it
+    flag_params = {'flag_mode': flag_mode, 'keep_antennas': list(keep_antennas)}
+    flag_kwargs = {'one_pass': (flag_mode == 'one_pass'), 'keep_antennas': list(keep_antennas),
+                   'n_threads': n_threads, 'lock_ms': fname_root if split_mode == 'reference' else None}
+    flag_futures = {}
+    for _, msfile in scan_files:
+        stage_name = f'flag_scan:{os.path.basename(msfile)}'
+        if ckpt.is_valid(stage_name, params=flag_params, deps=['split']):
+            print(f"Skipping {stage_name}, checkpoint is valid")
+        elif pool is None:
+            ckpt.record(stage_name, params=flag_params, deps=['split'],
+                        outputs=[flag_scan(msfile, **flag_kwargs)])
+        else:
+            flag_futures[pool.submit(flag_scan, msfile, **flag_kwargs)] = stage_name
+    for future in as_completed(flag_futures):
+        msfile = future.result()
+        ckpt.record(flag_futures[future], params=flag_params, deps=['split'], outputs=[msfile])
+    if not average:
+        return ckpt, scan_files
+
+    # averaged copies of the flagged scans, read by every later stage instead of the scans
+    average_params = {'max_loss': average_loss, 'keep_antennas': list(keep_antennas)}
+    averaged_files = []
+    for scan_num, msfile in scan_files:
+        name = os.path.basename(msfile)
+        outputvis = os.path.join(runtime_root, "averaged", name)
+        os.makedirs(os.path.dirname(outputvis), exist_ok=True)
+        ckpt.run(f'average:{name}', lambda msfile=msfile, outputvis=outputvis: averaging.average_ms(
+                     msfile, outputvis, max_loss=average_loss, antennas=list(keep_antennas)),
+                 params=average_params, deps=[f'flag_scan:{name}'], outputs=[outputvis])
+        averaged_files.append((scan_num, outputvis))
+    return ckpt, averaged_files
+
+
+def day_units(scan_files, spws_all=SPWS_ALL, runtime_root="./runtime", joint_spw=False):
+    """
+    The (msfile, scan, spws, runtime_dir) units of a day, as run by run_day.
+
+    Parameters
+    ----------
+    scan_files : list of (int, str)
+        (scan number, path) of the scan measurement sets
+    spws_all : list of str, optional
+        Spectral window groups, defaults to SPWS_ALL
+    runtime_root : str, optional
+        Parent directory of the per-unit runtime directories
+    joint_spw : bool, optional
+        One unit per scan holding all spw groups
+    """
+    units = []
+    if joint_spw:
+        for scan_num, msfile in scan_files:
+            units.append((msfile, scan_num, list(spws_all), os.path.join(runtime_root, f"scan{scan_num}_joint")))
+    else:
+        for spws_this in spws_all:
+            spw_ids = spws_this.split(',')
+            for scan_num, msfile in scan_files:
+                runtime_dir = os.path.join(runtime_root, f"scan{scan_num}_spw{spw_ids[0]}-{spw_ids[-1]}")
+                units.append((msfile, scan_num, spws_this, runtime_dir))
+    return units
+
+
+def unit_upstream(ckpt, msfile):
+    """Digest of the stage that wrote a scan file (its flagging or averaging), passed to process_unit as upstream."""
+    name = os.path.basename(msfile)
+    average_record = ckpt.records.get(f'average:{name}')
+    if average_record is not None and msfile in average_record['outputs']:
+        return average_record['digest']
+    return ckpt.records[f'flag_scan:{name}']['digest']
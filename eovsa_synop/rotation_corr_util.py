@@ -1,17 +1,28 @@
+import os
+import hashlib
+import functools
+from collections import OrderedDict
 
-from casatools import msmetadata 
-from astropy.time import Time
+import numpy as np
 import astropy.units as u
-from astropy.coordinates import SkyCoord
-from astropy.wcs import WCS
-import sunpy.map as smap
-from sunpy.coordinates import Helioprojective, propagate_with_solar_surface
 from astropy.time import Time
-import matplotlib.pyplot as plt
-import  numpy as np
 
-from scipy import ndimage
-from tqdm import tqdm
+from eovsa_synop.ms_index import get_ms_index
+from eovsa_synop.telemetry import timed
+from eovsa_synop.fits_io import read_map, read_header, write_fits
+
+# sunpy, astropy.coordinates, astropy.wcs, scipy and matplotlib are imported by
+# the functions using them, so that importing this module stays cheap for pool
+# workers and the command line
+
+
+@functools.lru_cache(maxsize=None)
+def eovsa_location():
+    """Approximate EOVSA array center at OVRO, as an astropy EarthLocation."""
+    from astropy.coordinates import EarthLocation
+
+    return EarthLocation.from_geodetic(lon=-118.2864 * u.deg, lat=37.2332 * u.deg, height=1207 * u.m)
+
 
 def get_N_time_from_ms(msname):
     """
@@ -27,11 +38,7 @@ def get_N_time_from_ms(msname):
     int
         Number of time steps
     """
-    msmd = msmetadata()
-    msmd.open(msname)
-    n_times = msmd.timesforfield(0)
-    msmd.close()
-    return n_times
+    return get_ms_index(msname).times_for_field(0)
 
 
 def get_begin_end_time_from_ms(msname):
@@ -48,14 +55,8 @@ def get_begin_end_time_from_ms(msname):
     tuple
         (begin_time, end_time) as datetime objects
     """
-    msmd = msmetadata()
-    msmd.open(msname)
-    t_range_msmd = msmd.timerangeforobs(0)
-    msmd.close()
-    
     # Extract MJD values
-    begin_mjd = t_range_msmd['begin']['m0']['value']
-    end_mjd = t_range_msmd['end']['m0']['value']
+    begin_mjd, end_mjd = get_ms_index(msname).timerange()
     
     # Convert MJD to datetime using astropy Time
     begin_time = Time(begin_mjd, format='mjd').datetime
@@ -64,7 +65,139 @@ def get_begin_end_time_from_ms(msname):
     return begin_time, end_time
 
 
-def solar_diff_rot_heliofits(in_fits, newtime, out_fits, template_fits=None, showplt=False, overwrite_prev=True):
+# number of differential rotation plans kept in memory
+ROTATION_PLAN_CACHE_SIZE = 8
+_rotation_plan_cache = OrderedDict()
+
+
+class RotationPlan:
+    """
+    Precomputed pixel to pixel mapping of a differential rotation.
+
+    For every output pixel the plan stores the (fractional) input pixel it
+    samples, reduced to a base index and bilinear weights, so applying the
+    plan to a new image of the same geometry is a few vectorized gathers.
+
+    Parameters
+    ----------
+    x_in, y_in : numpy.ndarray
+        Input pixel coordinates of every output pixel, NaN where the output
+        pixel has no counterpart on the input map (e.g. off the solar disk)
+    """
+
+    def __init__(self, x_in, y_in):
+        ny, nx = x_in.shape
+        self.shape = (ny, nx)
+        self.valid = (np.isfinite(x_in) & np.isfinite(y_in) &
+                      (x_in >= -0.5) & (x_in <= nx - 0.5) &
+                      (y_in >= -0.5) & (y_in <= ny - 0.5))
+        xc = np.clip(np.where(self.valid, x_in, 0), 0, nx - 1)
+        yc = np.clip(np.where(self.valid, y_in, 0), 0, ny - 1)
+        x0 = np.minimum(np.floor(xc), max(nx - 2, 0)).astype(np.int32)
+        y0 = np.minimum(np.floor(yc), max(ny - 2, 0)).astype(np.int32)
+        self.fx = (xc - x0).astype(np.float32)
+        self.fy = (yc - y0).astype(np.float32)
+        self.i00 = y0 * nx + x0
+
+    def apply(self, data):
+        """
+        Resample an image with the plan.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            2-D image with the shape the plan was built for
+
+        Returns
+        -------
+        numpy.ndarray
+            Rotated image; pixels outside the footprint keep the input values
+        """
+        nx = self.shape[1]
+        flat = np.asarray(data).ravel()
+        top = flat[self.i00]
+        top = top + self.fx * (flat[self.i00 + 1] - top)
+        bottom = flat[self.i00 + nx]
+        bottom = bottom + self.fx * (flat[self.i00 + nx + 1] - bottom)
+        out = top + self.fy * (bottom - top)
+        return np.where(self.valid, out, data)
+
+    def save(self, filename):
+        """Save the plan as a .npy file of the input pixel coordinates."""
+        ny, nx = self.shape
+        x_in = (self.i00 % nx + self.fx).astype(np.float32)
+        y_in = (self.i00 // nx + self.fy).astype(np.float32)
+        x_in[~self.valid] = np.nan
+        y_in[~self.valid] = np.nan
+        # written aside and renamed, processes sharing a cache directory never read a partial plan
+        tmp_file = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.stack([x_in, y_in]))
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a plan saved with RotationPlan.save."""
+        x_in, y_in = np.load(filename)
+        return cls(x_in, y_in)
+
+
+def get_rotation_plan(in_map, out_wcs, cache_dir=None):
+    """
+    Get the differential rotation plan from in_map's frame to out_wcs.
+
+    Plans are keyed by the image shape and both WCS headers (which carry the
+    observer and the observation and target times), kept in an LRU cache of
+    ROTATION_PLAN_CACHE_SIZE entries and optionally persisted to cache_dir.
+
+    Parameters
+    ----------
+    in_map : sunpy.map.GenericMap
+        Input helioprojective map
+    out_wcs : astropy.wcs.WCS
+        WCS of the output frame at the target time
+    cache_dir : str, optional
+        Directory where plans are stored as .npy files
+
+    Returns
+    -------
+    RotationPlan
+        The (possibly cached) rotation plan
+    """
+    key_str = '\n'.join([str(in_map.data.shape),
+                         in_map.wcs.to_header_string(),
+                         out_wcs.to_header_string()])
+    key = hashlib.sha1(key_str.encode()).hexdigest()
+
+    if key in _rotation_plan_cache:
+        _rotation_plan_cache.move_to_end(key)
+        return _rotation_plan_cache[key]
+
+    plan_file = None if cache_dir is None else os.path.join(cache_dir, f"rotplan_{key}.npy")
+    if plan_file is not None and os.path.exists(plan_file):
+        plan = RotationPlan.load(plan_file)
+    else:
+        from sunpy.coordinates import propagate_with_solar_surface
+
+        ny, nx = in_map.data.shape
+        yy, xx = np.mgrid[0:ny, 0:nx]
+        with propagate_with_solar_surface():
+            out_coords = out_wcs.pixel_to_world(xx, yy)
+            x_in, y_in = in_map.wcs.world_to_pixel(out_coords)
+        plan = RotationPlan(np.asarray(x_in), np.asarray(y_in))
+        if plan_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            plan.save(plan_file)
+
+    _rotation_plan_cache[key] = plan
+    while len(_rotation_plan_cache) > ROTATION_PLAN_CACHE_SIZE:
+        _rotation_plan_cache.popitem(last=False)
+    return plan
+
+
+@timed('diff_rot')
+def solar_diff_rot_heliofits(in_fits, newtime, out_fits, template_fits=None, showplt=False, overwrite_prev=True,
+                             use_plan=True, plan_cache_dir=None, sparse=False, writer=None):
     """
     Reproject a FITS file to account for solar differential rotation to a new observation time.
 
@@ -80,16 +213,62 @@ def solar_diff_rot_heliofits(in_fits, newtime, out_fits, template_fits=None, sho
         Path to template FITS file for output. If None, uses in_fits as template
     showplt : bool, optional
         Show plots of the original and reprojected maps, defaults to False
+    use_plan : bool, optional
+        Resample with a cached RotationPlan instead of a full reprojection,
+        defaults to True
+    plan_cache_dir : str, optional
+        Directory to persist rotation plans in, see get_rotation_plan
+    sparse : bool, optional
+        Treat the input as a CLEAN model and move only its nonzero
+        components, defaults to False
+    writer : eovsa_synop.fits_io.FitsWriter, optional
+        Writer of the output, defaults to float32 without compression
 
     Returns
     -------
     str
         Path to the output FITS file
     """
+    # Read the input memory-mapped, the template header from the cache
+    in_map = read_map(in_fits)
+    if template_fits is None:
+        template_fits = in_fits
+    template_header = read_header(template_fits)
+
+    final_map = diff_rot_map(in_map, newtime, template_header, showplt=showplt, use_plan=use_plan,
+                             plan_cache_dir=plan_cache_dir, sparse=sparse)
+    write_fits(out_fits, final_map.data, template_header, writer=writer, overwrite=overwrite_prev)
     
-    # Convert FITS to SunPy Map
-    in_map = smap.Map(in_fits)
-    
+    return out_fits
+
+
+def diff_rot_map(in_map, newtime, template_header, showplt=False, use_plan=True, plan_cache_dir=None,
+                 sparse=False):
+    """
+    Differentially rotate a helioprojective map to a new observation time, in memory.
+
+    This is the computation behind solar_diff_rot_heliofits, see there for
+    the parameters.
+
+    Parameters
+    ----------
+    in_map : sunpy.map.GenericMap
+        Input helioprojective map
+    newtime : astropy.time.Time
+        The new time to which the map is reprojected
+    template_header : dict or astropy.io.fits.Header
+        Header the output map is built from, updated in place with the new WCS
+
+    Returns
+    -------
+    sunpy.map.GenericMap
+        The rotated map with the updated template header
+    """
+    import sunpy.map as smap
+    from sunpy.coordinates import Helioprojective, propagate_with_solar_surface
+    from astropy.coordinates import SkyCoord
+    from astropy.wcs import WCS
+
     # Calculate reference time and output time
     reftime = in_map.date + in_map.exposure_time / 2
     out_time = in_map.date - (reftime - Time(newtime))
@@ -111,20 +290,40 @@ def solar_diff_rot_heliofits(in_fits, newtime, out_fits, template_fits=None, sho
                                         scale=u.Quantity(in_map.scale))
     out_wcs = WCS(out_header)
     
-    # Perform reprojection
-    with propagate_with_solar_surface():
-        out_map, footprint = in_map.reproject_to(out_wcs, return_footprint=True)
-    
-    # Fill missing data from original map
-    out_data = out_map.data
-    out_data[footprint == 0] = in_map.data[footprint == 0]
-    
-    # Create new map with reprojected data
-    out_map = smap.Map(out_data, out_map.meta)
+    if sparse:
+        # Move the components; those without a counterpart stay in place
+        y, x, flux = extract_clean_components(in_map.data)
+        with propagate_with_solar_surface():
+            comp_coords = in_map.wcs.pixel_to_world(x, y)
+            x_out, y_out = out_wcs.world_to_pixel(comp_coords)
+        x_out, y_out = np.asarray(x_out), np.asarray(y_out)
+        missing = ~(np.isfinite(x_out) & np.isfinite(y_out))
+        x_out[missing] = x[missing]
+        y_out[missing] = y[missing]
+        out_data = scatter_components(y_out, x_out, flux, in_map.data.shape)
+        out_map = smap.Map(out_data, out_header)
+    elif use_plan:
+        # Resample with the cached pixel mapping, missing data filled from original map
+        plan = get_rotation_plan(in_map, out_wcs, cache_dir=plan_cache_dir)
+        out_data = plan.apply(in_map.data)
+        out_map = smap.Map(out_data, out_header)
+    else:
+        # Perform reprojection
+        with propagate_with_solar_surface():
+            out_map, footprint = in_map.reproject_to(out_wcs, return_footprint=True)
+
+        # Fill missing data from original map
+        out_data = out_map.data
+        out_data[footprint == 0] = in_map.data[footprint == 0]
+
+        # Create new map with reprojected data
+        out_map = smap.Map(out_data, out_map.meta)
     out_map.meta['p_angle'] = in_map.meta['p_angle']
     
     # Display plots if requested
     if showplt:
+        import matplotlib.pyplot as plt
+
         fig = plt.figure(figsize=(12, 4))
 
         ax1 = fig.add_subplot(121, projection=in_map)
@@ -137,14 +336,6 @@ def solar_diff_rot_heliofits(in_fits, newtime, out_fits, template_fits=None, sho
         plt.colorbar()
         plt.show()
     
-    # Save to FITS file using template if provided
-    if template_fits is None:
-        template_fits = in_fits
-        
-    # Load template header
-    template_map = smap.Map(template_fits)
-    template_header = template_map.meta.copy()
-    
     # Update necessary header information
     template_header.update({
         'DATE-OBS': out_map.date.iso,
@@ -159,11 +350,8 @@ def solar_diff_rot_heliofits(in_fits, newtime, out_fits, template_fits=None, sho
         'PC2_2': out_map.rotation_matrix[1,1]
     })
     
-    # Create new map with template header and save to FITS
-    final_map = smap.Map(out_data, template_header)
-    final_map.save(out_fits,  overwrite=overwrite_prev)
-    
-    return out_fits
+    # Create new map with template header
+    return smap.Map(out_data, template_header)
 
 
 
@@ -182,16 +370,195 @@ def rotateimage(data, xc_centre, yc_centre, p_angle):
     :return: The rotated image.
     :rtype: numpy.ndarray
     """
+    return rotate_planes(data, xc_centre, yc_centre, p_angle)
 
-    padX = [data.shape[1] - xc_centre, xc_centre]
-    padY = [data.shape[0] - yc_centre, yc_centre]
-    imgP = np.pad(data, [padY, padX], 'constant')
-    imgR = ndimage.rotate(imgP, p_angle, reshape=False, order=0, prefilter=False)
-    return imgR[padY[0]:-padY[1], padX[0]:-padX[1]]
 
+def rotate_planes(data, xc_centre, yc_centre, p_angle, out=None, order=0, n_threads=1):
+    """
+    Rotate one image or a stack of images around (xc_centre, yc_centre).
 
+    The rotation is a single affine resampling of each plane into the output,
+    without the padding to twice the image size the original implementation
+    of rotateimage needed, and gives the same result.
 
-def sunpyfits_to_j2000fits(in_fits, out_fits, template_fits=None, overwrite_prev=True):
+    :param data: The image data, 2-D or a stack (..., ny, nx) of planes
+        (e.g. Stokes/frequency planes or time intervals) rotated alike.
+    :type data: numpy.ndarray
+    :param xc_centre: The x-coordinate of the rotation center.
+    :type xc_centre: int
+    :param yc_centre: The y-coordinate of the rotation center.
+    :type yc_centre: int
+    :param p_angle: The rotation angle in degrees.
+    :type p_angle: float
+    :param out: Preallocated output with the shape of data, optional.
+    :type out: numpy.ndarray
+    :param order: Spline interpolation order, 0 (nearest) as in rotateimage.
+    :type order: int
+    :param n_threads: Number of threads rotating planes of a stack in parallel.
+    :type n_threads: int
+    :return: The rotated image(s).
+    :rtype: numpy.ndarray
+    """
+    data = np.asarray(data)
+    if out is None:
+        out = np.empty_like(data)
+    ny, nx = data.shape[-2:]
+    planes = data.reshape(-1, ny, nx)
+    out_planes = out.reshape(-1, ny, nx)
+
+    from scipy import ndimage, special
+
+    # same transform as ndimage.rotate of the image padded so that the
+    # rotation center lands in the middle: about (yc - 0.5, xc - 0.5)
+    c, s = special.cosdg(p_angle), special.sindg(p_angle)
+    matrix = np.array([[c, s], [-s, c]])
+    centre = np.array([yc_centre - 0.5, xc_centre - 0.5])
+    offset = centre - matrix @ centre
+
+    if n_threads > 1 and len(planes) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def _rotate(i):
+            ndimage.affine_transform(planes[i], matrix, offset=offset, output=out_planes[i],
+                                     order=order, mode='grid-constant', cval=0.0, prefilter=False)
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(_rotate, range(len(planes))))
+    else:
+        # one call for the whole stack, identity along the plane axis
+        matrix3 = np.eye(3)
+        matrix3[1:, 1:] = matrix
+        ndimage.affine_transform(planes, matrix3, offset=np.concatenate([[0.0], offset]), output=out_planes,
+                                 order=order, mode='grid-constant', cval=0.0, prefilter=False)
+
+    if not np.shares_memory(out_planes, out):
+        out[...] = out_planes.reshape(out.shape)
+    return out
+
+
+def extract_clean_components(data):
+    """
+    Extract the nonzero pixels (CLEAN components) of a model image.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2-D model image
+
+    Returns
+    -------
+    tuple
+        (y, x, flux) arrays of the component pixel coordinates and values
+    """
+    data = np.asarray(data)
+    y, x = np.nonzero(np.isfinite(data) & (data != 0))
+    return y.astype(float), x.astype(float), data[y, x]
+
+
+def scatter_components(y, x, flux, shape, method='bilinear'):
+    """
+    Place components at fractional pixel positions onto a regular grid.
+
+    With method='bilinear' each component is split over its four neighbouring
+    pixels, so the total flux of components landing on the grid is conserved.
+    method='nearest' puts every component in its closest pixel.
+
+    Parameters
+    ----------
+    y, x : numpy.ndarray
+        Pixel coordinates of the components
+    flux : numpy.ndarray
+        Component values
+    shape : tuple
+        (ny, nx) of the output image
+    method : str, optional
+        'bilinear' or 'nearest', defaults to 'bilinear'
+
+    Returns
+    -------
+    numpy.ndarray
+        Output image with the components deposited
+    """
+    ny, nx = shape
+    if method == 'nearest':
+        iy = np.rint(y).astype(np.int64)
+        ix = np.rint(x).astype(np.int64)
+        inside = (iy >= 0) & (iy < ny) & (ix >= 0) & (ix < nx)
+        out = np.bincount(iy[inside] * nx + ix[inside], weights=flux[inside], minlength=ny * nx)
+        return out.reshape(shape)
+
+    x0 = np.floor(x).astype(np.int64)
+    y0 = np.floor(y).astype(np.int64)
+    fx = x - x0
+    fy = y - y0
+    out = np.zeros(ny * nx)
+    for dy, dx, w in [(0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx),
+                      (1, 0, fy * (1 - fx)), (1, 1, fy * fx)]:
+        iy = y0 + dy
+        ix = x0 + dx
+        inside = (iy >= 0) & (iy < ny) & (ix >= 0) & (ix < nx)
+        out += np.bincount(iy[inside] * nx + ix[inside], weights=(flux * w)[inside], minlength=ny * nx)
+    return out.reshape(shape)
+
+
+def rotate_components(y, x, xc_centre, yc_centre, p_angle):
+    """
+    Move component coordinates the way rotateimage moves image pixels.
+
+    Parameters
+    ----------
+    y, x : numpy.ndarray
+        Pixel coordinates of the components
+    xc_centre, yc_centre : int
+        Rotation center, as given to rotateimage
+    p_angle : float
+        The rotation angle in degrees
+
+    Returns
+    -------
+    tuple
+        (y, x) arrays of the rotated coordinates
+    """
+    # rotateimage pads so that the rotation is about (yc - 0.5, xc - 0.5)
+    yc = yc_centre - 0.5
+    xc = xc_centre - 0.5
+    c, s = np.cos(np.deg2rad(p_angle)), np.sin(np.deg2rad(p_angle))
+    # ndimage.rotate samples in = R @ (out - c) + c with R = [[c, s], [-s, c]],
+    # so components move by the transpose
+    y_out = c * (y - yc) - s * (x - xc) + yc
+    x_out = s * (y - yc) + c * (x - xc) + xc
+    return y_out, x_out
+
+
+def rotateimage_sparse(data, xc_centre, yc_centre, p_angle, method='bilinear'):
+    """
+    Rotate a sparse (CLEAN model) image by moving its nonzero components.
+
+    Equivalent to rotateimage, but the cost scales with the number of
+    components instead of the image size.
+
+    :param data: The image data.
+    :type data: numpy.ndarray
+    :param xc_centre: The x-coordinate of the rotation center.
+    :type xc_centre: int
+    :param yc_centre: The y-coordinate of the rotation center.
+    :type yc_centre: int
+    :param p_angle: The rotation angle in degrees.
+    :type p_angle: float
+    :param method: 'bilinear' (flux conserving) or 'nearest' placement.
+    :type method: str
+    :return: The rotated image.
+    :rtype: numpy.ndarray
+    """
+    y, x, flux = extract_clean_components(data)
+    y_out, x_out = rotate_components(y, x, xc_centre, yc_centre, p_angle)
+    return scatter_components(y_out, x_out, flux, np.shape(data), method=method)
+
+
+
+
+@timed('j2000_rotate')
+def sunpyfits_to_j2000fits(in_fits, out_fits, template_fits=None, overwrite_prev=True, sparse=False, writer=None):
     """
     Rotate a solar FITS file from helioprojective to RA-DEC coordinates and save to a new FITS file.
 
@@ -205,17 +572,52 @@ def sunpyfits_to_j2000fits(in_fits, out_fits, template_fits=None, overwrite_prev
         Path to template FITS file for output format. If None, uses in_fits as template
     overwrite_prev : bool, optional
         If True, overwrites existing output file. Defaults to True
+    sparse : bool, optional
+        Rotate with rotateimage_sparse, for CLEAN model images. Defaults to False
+    writer : eovsa_synop.fits_io.FitsWriter, optional
+        Writer of the output, defaults to float32 without compression
 
     Returns
     -------
     str
         Path to the output FITS file
     """
-    import astropy.units as u
-    from astropy.io import fits
+    # Load input map memory-mapped
+    in_map = read_map(in_fits)
     
-    # Load input map
-    in_map = smap.Map(in_fits)
+    # Use template if provided, otherwise use input file
+    if template_fits is None:
+        template_fits = in_fits
+        
+    # Read template header, parsed once per file
+    template_header = read_header(template_fits)
+
+    data_rot, template_header = j2000_rotate_map(in_map, template_header, sparse=sparse)
+    
+    # Write output FITS file, with the axes of the template
+    write_fits(out_fits, data_rot, template_header, writer=writer, overwrite=overwrite_prev)
+    
+    return out_fits
+
+
+def j2000_rotate_map(in_map, template_header, sparse=False):
+    """
+    Rotate a helioprojective map back to RA-DEC orientation, in memory.
+
+    Parameters
+    ----------
+    in_map : sunpy.map.GenericMap
+        Input map in helioprojective coordinates, with a p_angle entry
+    template_header : astropy.io.fits.Header
+        Header of the output, updated in place
+    sparse : bool, optional
+        Rotate with rotateimage_sparse. Defaults to False
+
+    Returns
+    -------
+    tuple
+        (rotated data, updated template header)
+    """
     p_ang = in_map.meta['p_angle'] * u.deg
     
     # Get reference pixel coordinates
@@ -223,15 +625,10 @@ def sunpyfits_to_j2000fits(in_fits, out_fits, template_fits=None, overwrite_prev
     ref_y = int(in_map.reference_pixel.y.value)
     
     # Perform rotation
-    data_rot = rotateimage(in_map.data, ref_x, ref_y, -p_ang.to('deg').value)
-    
-    # Use template if provided, otherwise use input file
-    if template_fits is None:
-        template_fits = in_fits
-        
-    # Read template header
-    with fits.open(template_fits) as hdul:
-        template_header = hdul[0].header.copy()
+    if sparse:
+        data_rot = rotateimage_sparse(in_map.data, ref_x, ref_y, -p_ang.to('deg').value)
+    else:
+        data_rot = rotateimage(in_map.data, ref_x, ref_y, -p_ang.to('deg').value)
     
     # Update necessary header information
     template_header.update({
@@ -248,8 +645,187 @@ def sunpyfits_to_j2000fits(in_fits, out_fits, template_fits=None, overwrite_prev
         'P_ANGLE': p_ang.to('deg').value
     })
     
-    # Create and write output FITS file
-    hdu = fits.PrimaryHDU(data_rot, header=template_header)
-    hdu.writeto(out_fits, overwrite=overwrite_prev)
-    
-    return out_fits
\ No newline at end of file
+    return data_rot, template_header
+
+
+def solar_ephemeris(time, location=None):
+    """
+    Apparent position and orientation of the Sun seen from the array.
+
+    Parameters
+    ----------
+    time : astropy.time.Time
+        Time of the ephemeris
+    location : astropy.coordinates.EarthLocation, optional
+        Observer location, defaults to eovsa_location()
+
+    Returns
+    -------
+    dict
+        'ra', 'dec' (deg, J2000 direction of the solar center), 'p_angle',
+        'b0', 'l0' (deg), 'dsun' (m), 'rsun_obs' (arcsec) and the
+        heliographic Stonyhurst observer position 'hgln_obs', 'hglt_obs'
+        (deg) and 'dsun_obs' (m). Arrays if time is an array.
+    """
+    from astropy.coordinates import SkyCoord, get_body, GCRS, ICRS
+    from sunpy.coordinates import sun, HeliographicStonyhurst
+
+    if location is None:
+        location = eovsa_location()
+    time = Time(time)
+    sun_gcrs = get_body('sun', time, location=location)
+    # drop the distance so only the topocentric direction is transformed
+    sun_dir = SkyCoord(sun_gcrs.ra, sun_gcrs.dec, frame=GCRS(obstime=time, obsgeoloc=sun_gcrs.obsgeoloc,
+                                                                obsgeovel=sun_gcrs.obsgeovel))
+    sun_icrs = sun_dir.transform_to(ICRS())
+    observer = location.get_itrs(time).transform_to(HeliographicStonyhurst(obstime=time))
+    return {
+        'ra': sun_icrs.ra.to_value(u.deg),
+        'dec': sun_icrs.dec.to_value(u.deg),
+        'p_angle': sun.P(time).to_value(u.deg),
+        'b0': sun.B0(time).to_value(u.deg),
+        'l0': sun.L0(time).to_value(u.deg),
+        'dsun': sun.earth_distance(time).to_value(u.m),
+        'rsun_obs': sun.angular_radius(time).to_value(u.arcsec),
+        'hgln_obs': observer.lon.to_value(u.deg),
+        'hglt_obs': observer.lat.to_value(u.deg),
+        'dsun_obs': observer.radius.to_value(u.m),
+    }
+
+
+def helio_header_from_j2000(header, t_begin, t_end, ephem):
+    """
+    Build the helioprojective header of a RA-DEC image rotated by the P angle.
+
+    This is the header part of the registration done by helioimage2fits.imreg:
+    the reference pixel keeps its position, its offset from the solar center
+    is rotated to solar north and the axes become HPLN/HPLT in arcsec.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        Header of the RA-DEC (e.g. wsclean model) image
+    t_begin, t_end : astropy.time.Time
+        Time range the image covers
+    ephem : dict
+        Solar ephemeris at the middle of the time range, see solar_ephemeris
+
+    Returns
+    -------
+    dict
+        Helioprojective header for the P-angle rotated image
+    """
+    ra_ref = header['CRVAL1']
+    dec_ref = header['CRVAL2']
+
+    # offset of the reference pixel from the solar center, x west and y north
+    dx = -((ra_ref - ephem['ra'] + 180) % 360 - 180) * np.cos(np.deg2rad(ephem['dec'])) * 3600
+    dy = (dec_ref - ephem['dec']) * 3600
+    p = np.deg2rad(ephem['p_angle'])
+    tx = dx * np.cos(p) + dy * np.sin(p)
+    ty = -dx * np.sin(p) + dy * np.cos(p)
+
+    helio_header = {
+        'NAXIS': 2,
+        'NAXIS1': header['NAXIS1'],
+        'NAXIS2': header['NAXIS2'],
+        'CTYPE1': 'HPLN-TAN',
+        'CTYPE2': 'HPLT-TAN',
+        'CUNIT1': 'arcsec',
+        'CUNIT2': 'arcsec',
+        'CDELT1': -header['CDELT1'] * 3600,
+        'CDELT2': header['CDELT2'] * 3600,
+        'CRPIX1': header['CRPIX1'],
+        'CRPIX2': header['CRPIX2'],
+        'CRVAL1': tx,
+        'CRVAL2': ty,
+        'DATE-OBS': Time(t_begin).isot,
+        'EXPTIME': (Time(t_end) - Time(t_begin)).sec,
+        'P_ANGLE': ephem['p_angle'],
+        'HGLN_OBS': 0.0,
+        'HGLT_OBS': ephem['b0'],
+        'DSUN_OBS': ephem['dsun'],
+        'RSUN_REF': 695700000.0,
+        'RSUN_OBS': ephem['rsun_obs'],
+        'TELESCOP': header.get('TELESCOP', 'EOVSA'),
+    }
+    for key in ['BUNIT', 'BMAJ', 'BMIN', 'BPA', 'CRVAL3', 'RESTFRQ']:
+        if key in header:
+            helio_header[key] = header[key]
+    return helio_header
+
+
+@timed('model_to_j2000')
+def model_to_j2000(model_data, model_header, trange, newtime, out_fits, sparse=True, use_plan=True,
+                   plan_cache_dir=None, debug=False, overwrite_prev=True, ephem_cache=None, writer=None):
+    """
+    Register, differentially rotate and rotate back to RA-DEC a model image in memory.
+
+    Fused equivalent of helioimage2fits.imreg, solar_diff_rot_heliofits and
+    sunpyfits_to_j2000fits: only the final RA-DEC product is written.
+
+    Parameters
+    ----------
+    model_data : numpy.ndarray
+        Model image data, e.g. (1, 1, ny, nx) from a wsclean *-model.fits
+    model_header : astropy.io.fits.Header
+        Header of the model image, also the template of the output
+    trange : tuple
+        (begin, end) astropy.time.Time of the interval the model was imaged from
+    newtime : astropy.time.Time
+        The new time to which the model is rotated
+    out_fits : str
+        Path for the output FITS file
+    sparse : bool, optional
+        Move only the CLEAN components, defaults to True
+    use_plan : bool, optional
+        Use a cached RotationPlan for the dense path, defaults to True
+    plan_cache_dir : str, optional
+        Directory to persist rotation plans in
+    debug : bool, optional
+        Also write the intermediate *.helio.fits and *.helio.rot.fits files
+    overwrite_prev : bool, optional
+        If True, overwrites existing output files. Defaults to True
+    ephem_cache : eovsa_synop.ephemeris.EphemerisCache, optional
+        Ephemeris of the day to interpolate instead of computing it
+    writer : eovsa_synop.fits_io.FitsWriter, optional
+        Writer of the output, defaults to float32 without compression
+
+    Returns
+    -------
+    str
+        Path to the output FITS file
+    """
+    import sunpy.map as smap
+
+    t_begin, t_end = Time(trange[0]), Time(trange[1])
+    data2d = np.asarray(model_data).reshape(np.shape(model_data)[-2:])
+
+    # step 1: register to helioprojective coordinates
+    t_mid = t_begin + (t_end - t_begin) / 2
+    ephem = solar_ephemeris(t_mid) if ephem_cache is None else ephem_cache.at(t_mid)
+    helio_header = helio_header_from_j2000(model_header, t_begin, t_end, ephem)
+    ref_x = int(helio_header['CRPIX1'] - 1)
+    ref_y = int(helio_header['CRPIX2'] - 1)
+    if sparse:
+        helio_data = rotateimage_sparse(data2d, ref_x, ref_y, ephem['p_angle'])
+    else:
+        helio_data = rotateimage(data2d, ref_x, ref_y, ephem['p_angle'])
+    helio_map = smap.Map(helio_data, helio_header)
+
+    # step 2: differential rotation to newtime
+    rot_map = diff_rot_map(helio_map, newtime, helio_map.meta.copy(), use_plan=use_plan,
+                           plan_cache_dir=plan_cache_dir, sparse=sparse)
+
+    if debug:
+        base = out_fits[:-len('.helio.rot.j2000.fits')] if out_fits.endswith('.helio.rot.j2000.fits') \
+            else out_fits[:-len('.fits')]
+        helio_map.save(base + '.helio.fits', overwrite=overwrite_prev)
+        rot_map.save(base + '.helio.rot.fits', overwrite=overwrite_prev)
+
+    # step 3: rotate back to RA-DEC orientation
+    data_rot, out_header = j2000_rotate_map(rot_map, model_header.copy(), sparse=sparse)
+    write_fits(out_fits, np.reshape(data_rot, np.shape(model_data)), out_header, writer=writer,
+               overwrite=overwrite_prev)
+
+    return out_fits
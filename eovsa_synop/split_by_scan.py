@@ -1,67 +1,171 @@
 import os
-from casatools import table, msmetadata
+import shutil
+import numpy as np
+from eovsa_synop.ms_index import get_ms_index
+from eovsa_synop.telemetry import timed
 
-def split_ms_by_scan(msfile):
+
+def _split_single_pass(tb, scan_col, outfiles, max_memory_mb):
+    """
+    Fan the rows of an open main table out to per-scan outputs in one pass.
+
+    Parameters:
+    -----------
+    tb : casatools.table
+        Open main table of the input measurement set
+    scan_col : numpy.ndarray
+        SCAN_NUMBER column of the main table
+    outfiles : dict
+        Output filename per scan number
+    max_memory_mb : float
+        Memory ceiling of one chunk of rows
+    """
+    from casatools import table
+
+    colnames = tb.colnames()
+    outputs = {}
+    for scan, outfile in outfiles.items():
+        # empty copy of the MS, subtables included
+        tb.copy(outfile, deep=True, valuecopy=True, norows=True)
+        outputs[scan] = table(outfile, nomodify=False)
+
+    try:
+        row_bytes = 0
+        for colname in colnames:
+            try:
+                row_bytes += np.asarray(tb.getcol(colname, 0, 1)).nbytes
+            except Exception:
+                pass
+        chunk_rows = max(1, int(max_memory_mb * 1024**2 // max(row_bytes, 1)))
+
+        failed = set()
+        nrows = tb.nrows()
+        for row in range(0, nrows, chunk_rows):
+            nrow = min(chunk_rows, nrows - row)
+            scans_chunk = scan_col[row:row + nrow]
+            selections = {}
+            for scan in np.unique(scans_chunk):
+                if scan in outputs:
+                    selections[scan] = np.nonzero(scans_chunk == scan)[0]
+                    outputs[scan].addrows(len(selections[scan]))
+
+            for colname in colnames:
+                if colname in failed:
+                    continue
+                try:
+                    col_data = tb.getcol(colname, row, nrow)
+                except Exception as e:
+                    print(f"Warning: Error reading column {colname}: {str(e)}")
+                    failed.add(colname)
+                    continue
+                for scan, sel in selections.items():
+                    out = outputs[scan]
+                    # the row axis is the last axis of casatools columns
+                    out.putcol(colname, np.take(col_data, sel, axis=-1), startrow=out.nrows() - len(sel))
+    finally:
+        for out in outputs.values():
+            out.close()
+
+
+@timed('split')
+def split_ms_by_scan(msfile, mode='copy', max_memory_mb=512, raise_errors=False):
     """
     Split a measurement set file into multiple files, one per scan.
-    
+
     Parameters:
     -----------
     msfile : str
         Input measurement set filename
+    mode : str, optional
+        'copy' queries and deep copies every scan separately (default).
+        'single_pass' reads the main table once, in row order, and fans the
+        rows out to all per-scan outputs.
+        'reference' writes per-scan reference tables that select the scan's
+        rows of msfile without copying data; msfile must be kept.
+    max_memory_mb : float, optional
+        Memory ceiling of one chunk of rows in 'single_pass' mode (default: 512)
+    raise_errors : bool, optional
+        Raise errors instead of only printing them, e.g. so that a pipeline
+        stage is not recorded as done (default: False). The scan files left
+        incomplete by an error are removed either way, so a rerun writes them
     """
+    from casatools import table
+
     # Initialize tools
     tb = table()
-    msmd = msmetadata()
-    
+    outfiles, written = {}, []
+
     try:
-        # Open the measurement set
-        msmd.open(msfile)
-        
         # Get list of scan numbers
-        scan_numbers = msmd.scannumbers()
+        scan_numbers = get_ms_index(msfile).scans
         print(f"Found {len(scan_numbers)} scans in {msfile}")
-        
+
         # Create output directory if it doesn't exist
         base_name = os.path.splitext(msfile)[0]
-        
-        # Process each scan
+
+        # Define output filenames, skipping existing ones
         for scan in scan_numbers:
-            # Define output filename
             outfile = f"{base_name}_scan{scan}.ms"
-            
-            # Skip if output file already exists
             if os.path.exists(outfile):
                 print(f"Skipping scan {scan}, output file {outfile} already exists")
-                continue
-                
+            else:
+                outfiles[scan] = outfile
+
+        if mode in ('single_pass', 'reference') and outfiles:
+            tb.open(msfile)
+            scan_col = tb.getcol('SCAN_NUMBER')
+
+            if mode == 'single_pass':
+                print(f"Splitting {len(outfiles)} scans in a single pass")
+                _split_single_pass(tb, scan_col, outfiles, max_memory_mb)
+                written.extend(outfiles.values())
+            else:
+                for scan, outfile in outfiles.items():
+                    rows = np.nonzero(scan_col == scan)[0]
+                    subtb = tb.selectrows(rows.tolist(), name=outfile)
+                    subtb.close()
+                    written.append(outfile)
+                    print(f"Created reference table {outfile}")
+
+            tb.close()
+            return
+
+        # Process each scan
+        for scan, outfile in outfiles.items():
             print(f"Processing scan {scan}")
-            
+
             # Create table query for the scan
             query = f"SCAN_NUMBER == {scan}"
-            
+
             # Split the MS for this scan
             tb.open(msfile)
             subtb = tb.query(query)
-            
+
             # Copy the subtable to new MS
             subtb.copy(outfile, deep=True)
-            
+
             # Clean up
             subtb.close()
             tb.close()
-            
+
+            written.append(outfile)
             print(f"Created {outfile}")
-            
+
     except Exception as e:
         print(f"Error processing measurement set: {str(e)}")
-        
+        for outfile in outfiles.values():
+            if outfile not in written and os.path.exists(outfile):
+                shutil.rmtree(outfile, ignore_errors=True)
+                print(f"Removed incomplete {outfile}")
+        if raise_errors:
+            raise
+
     finally:
         # Clean up
-        msmd.close()
         tb.close()
 
-ms_file = "UDB20241212.ms"
+if __name__ == "__main__":
+    ms_file = "UDB20241212.ms"
 
     # Run the splitting function
-split_ms_by_scan(ms_file)
\ No newline at end of file
+    split_ms_by_scan(ms_file)
@@ -0,0 +1,309 @@
+import os
+import re
+import shutil
+import tempfile
+from glob import glob
+import numpy as np
+from astropy.io import fits
+
+from eovsa_synop.fits_io import read_fits, image_plane
+
+# per group accumulators kept on disk while stacking
+ACCUMULATORS = ('sum_wx', 'sum_w', 'max', 'count')
+
+# header keywords of the frequency and stokes axes dropped from the 2D planes
+_AXIS_KEYS = ('CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CUNIT', 'CROTA', 'NAXIS')
+
+
+def _group_label(spws):
+    """Label of a comma separated spw group, e.g. 'spw0-1'."""
+    spw_ids = spws.split(',')
+    return f"spw{spw_ids[0]}-{spw_ids[-1]}"
+
+
+def find_rotated_products(runtime_root, pattern="*-model.helio.rot.j2000.fits", spws_all=None):
+    """
+    Group the rotated products of a day by spw group.
+
+    Units processed per group (``scan<N>_spw<a>-<b>``) are labelled by their
+    directory; in joint units (``scan<N>_joint``) the output channel of the
+    file gives the group, labelled from spws_all if it is given.
+
+    Parameters
+    ----------
+    runtime_root : str
+        Parent directory of the per-unit runtime directories
+    pattern : str, optional
+        Glob pattern of the products in a runtime directory
+    spws_all : list of str, optional
+        Spectral window groups of the joint units, in channel order
+
+    Returns
+    -------
+    dict
+        Sorted file lists per group label, in group order
+    """
+    groups = {}
+    for runtime_dir in sorted(glob(os.path.join(runtime_root, "scan*_*"))):
+        token = os.path.basename(os.path.normpath(runtime_dir)).split('_', 1)[1]
+        for fname in sorted(glob(os.path.join(runtime_dir, pattern))):
+            if token == 'joint':
+                match = re.search(r'-(\d{4})-model', os.path.basename(fname))
+                chan = int(match.group(1)) if match else 0
+                label = _group_label(spws_all[chan]) if spws_all is not None else f"chan{chan}"
+            else:
+                label = token
+            groups.setdefault(label, []).append(fname)
+
+    def group_key(label):
+        numbers = re.findall(r'\d+', label)
+        return int(numbers[0]) if numbers else -1
+    return {label: groups[label] for label in sorted(groups, key=group_key)}
+
+
+def estimate_noise(plane, max_samples=1000000):
+    """
+    Robust noise of an image plane from the median absolute deviation.
+
+    At most max_samples evenly strided pixels are used, so the cost stays
+    bounded for large planes.
+    """
+    values = plane.ravel()
+    values = values[::max(1, values.size // max_samples)]
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.nan
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+
+def matching_residual(fname):
+    """
+    The wsclean residual image of a model or restored image product, None if there is none.
+
+    e.g. x-model.helio.rot.j2000.fits -> x-residual.fits
+    """
+    residual = re.sub(r'-(model|image)(\.[\w.]*)?\.fits$', '-residual.fits', fname)
+    return residual if residual != fname and os.path.exists(residual) else None
+
+
+def image_noise(fname):
+    """
+    Noise of an image product, for its stacking weight.
+
+    Taken from the matching wsclean residual image when there is one, as a
+    CLEAN model is almost all zeros and has no noise of its own, and from
+    the image itself otherwise. None when neither gives a usable value.
+    """
+    data, _ = read_fits(matching_residual(fname) or fname)
+    noise = estimate_noise(image_plane(data))
+    return noise if np.isfinite(noise) and noise > 0 else None
+
+
+def _plane_header(header):
+    """Copy of an image header reduced to its two celestial axes."""
+    header = header.copy()
+    for axis in range(3, header.get('NAXIS', 2) + 1):
+        for key in _AXIS_KEYS:
+            header.remove(f"{key}{axis}", ignore_missing=True)
+    for key in list(header.keys()):
+        if re.match(r'^(PC|CD)0*[34]_0*\d$|^(PC|CD)0*\d_0*[34]$', key):
+            header.remove(key, ignore_missing=True, remove_all=True)
+    return header
+
+
+class SynopticStack:
+    """
+    Streaming accumulator of image planes per spw group.
+
+    Every plane is added in blocks of rows to memory-mapped accumulators
+    (sum of w*x, sum of w, max and count of finite pixels) with w = 1/sigma^2
+    from its robust noise, optionally times a per-image weight. Memory use is
+    about one image plane plus one block, whatever the number of images.
+    Groups whose images have no usable noise are stacked with uniform
+    weights (noise 1), and marked so in self.weighting.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (ny, nx) of the image planes
+    groups : list of str
+        Group labels, in cube order
+    work_dir : str, optional
+        Directory of the accumulator files, a temporary one by default
+    block_rows : int, optional
+        Number of image rows processed at once, defaults to 256
+    """
+
+    def __init__(self, shape, groups, work_dir=None, block_rows=256):
+        self.shape = tuple(shape)
+        self.groups = list(groups)
+        self.block_rows = block_rows
+        self._own_dir = work_dir is None
+        self.work_dir = tempfile.mkdtemp(prefix="synop_stack_") if work_dir is None else work_dir
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.n_images = {group: 0 for group in self.groups}
+        self.weighting = {group: 'noise' for group in self.groups}
+        cube_shape = (len(self.groups),) + self.shape
+        self.acc = {}
+        for name in ACCUMULATORS:
+            dtype = np.int32 if name == 'count' else np.float64
+            self.acc[name] = np.lib.format.open_memmap(os.path.join(self.work_dir, name + '.npy'),
+                                                       mode='w+', dtype=dtype, shape=cube_shape)
+            self.acc[name][:] = -np.inf if name == 'max' else 0
+
+    def add(self, group, plane, weight=1.0, noise=None):
+        """
+        Add an image plane to a group.
+
+        Parameters
+        ----------
+        group : str
+            Group label
+        plane : numpy.ndarray
+            Image plane of shape self.shape, may be memory-mapped
+        weight : float, optional
+            Extra weight of the image (e.g. its integration time), defaults to 1
+        noise : float, optional
+            Noise of the image, estimated with estimate_noise by default
+
+        Returns
+        -------
+        bool
+            False if the plane was skipped because its noise is not usable
+        """
+        if plane.shape != self.shape:
+            raise ValueError(f"plane shape {plane.shape} does not match the stack shape {self.shape}")
+        if noise is None:
+            noise = estimate_noise(plane)
+        if not np.isfinite(noise) or noise <= 0:
+            return False
+        w = weight / noise**2
+        g = self.groups.index(group)
+        for row in range(0, self.shape[0], self.block_rows):
+            rows = slice(row, row + self.block_rows)
+            block = np.asarray(plane[rows], dtype=np.float64)
+            finite = np.isfinite(block)
+            block = np.where(finite, block, 0.)
+            self.acc['sum_wx'][g, rows] += w * block
+            self.acc['sum_w'][g, rows] += w * finite
+            self.acc['count'][g, rows] += finite
+            np.maximum(self.acc['max'][g, rows], np.where(finite, block, -np.inf), out=self.acc['max'][g, rows])
+        self.n_images[group] += 1
+        return True
+
+    def add_fits(self, group, fname, weight=1.0, noise=None):
+        """Add the image plane of a FITS file, read through a memory map."""
+        data, _ = read_fits(fname)
+        return self.add(group, image_plane(data), weight=weight, noise=noise)
+
+    def write(self, out_fits, header, overwrite=True):
+        """
+        Write the daily synoptic cube.
+
+        The primary HDU holds the noise-weighted mean, sum(w*x)/sum(w), of
+        every group; extensions SNR (sum(w*x)/sqrt(sum(w)), the noise-weighted
+        sum in units of its own noise), MAX and COUNT hold the other products.
+        The cube axis is the group, whose labels are stored as GROUPn keywords
+        and weightings as WGHTn.
+
+        Parameters
+        ----------
+        out_fits : str
+            Output FITS file
+        header : astropy.io.fits.Header
+            Header of one of the input images, giving the celestial WCS
+        overwrite : bool, optional
+            Replace out_fits if it exists, defaults to True
+        """
+        cube_shape = (len(self.groups),) + self.shape
+        products = {}
+        for name in ('MEAN', 'SNR'):
+            products[name] = np.lib.format.open_memmap(os.path.join(self.work_dir, name.lower() + '.npy'),
+                                                       mode='w+', dtype=np.float32, shape=cube_shape)
+        for g in range(len(self.groups)):
+            for row in range(0, self.shape[0], self.block_rows):
+                rows = slice(row, row + self.block_rows)
+                sum_w = self.acc['sum_w'][g, rows]
+                sum_wx = self.acc['sum_wx'][g, rows]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    products['MEAN'][g, rows] = np.where(sum_w > 0, sum_wx / sum_w, np.nan)
+                    products['SNR'][g, rows] = np.where(sum_w > 0, sum_wx / np.sqrt(sum_w), np.nan)
+        max_cube = np.lib.format.open_memmap(os.path.join(self.work_dir, 'max_out.npy'),
+                                             mode='w+', dtype=np.float32, shape=cube_shape)
+        for g in range(len(self.groups)):
+            max_cube[g] = np.where(np.isfinite(self.acc['max'][g]), self.acc['max'][g], np.nan)
+
+        header = _plane_header(header)
+        header['CTYPE3'] = 'SPWGROUP'
+        header['CRPIX3'] = 1.0
+        header['CRVAL3'] = 0.0
+        header['CDELT3'] = 1.0
+        for g, group in enumerate(self.groups):
+            header[f'GROUP{g}'] = (group, 'spw group of cube plane')
+            header[f'NIMG{g}'] = (self.n_images[group], 'images stacked in cube plane')
+            header[f'WGHT{g}'] = (self.weighting[group], 'weighting of cube plane')
+
+        hdul = fits.HDUList([fits.PrimaryHDU(products['MEAN'], header=header)])
+        for name, data in (('SNR', products['SNR']), ('MAX', max_cube), ('COUNT', self.acc['count'])):
+            hdul.append(fits.ImageHDU(data, header=header, name=name))
+        hdul.writeto(out_fits, overwrite=overwrite)
+
+    def close(self):
+        """Release the accumulators, removing the work directory if it was created here"""
+        self.acc = {}
+        if self._own_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def stack_synoptic(groups, out_fits, work_dir=None, block_rows=256, weights=None):
+    """
+    Stack the images of a day into a synoptic cube, one plane per spw group.
+
+    The images are streamed one at a time through memory maps into a
+    SynopticStack, so memory stays at a few image planes however many
+    intervals there are. Every image is weighted by the noise of its
+    matching residual image (see image_noise), which the CLEAN model
+    products of find_rotated_products need; a group with an image without
+    usable noise is stacked with uniform weights.
+
+    Parameters
+    ----------
+    groups : dict
+        Image files per group label, e.g. from find_rotated_products
+    out_fits : str
+        Output FITS file, see SynopticStack.write
+    work_dir : str, optional
+        Directory of the accumulator files, a temporary one by default
+    block_rows : int, optional
+        Number of image rows processed at once, defaults to 256
+    weights : dict, optional
+        Extra weight per file name, defaults to 1
+
+    Returns
+    -------
+    dict
+        Number of images stacked per group
+    """
+    files = [fname for group_files in groups.values() for fname in group_files]
+    if not files:
+        print("No images to stack")
+        return {}
+    data, header = read_fits(files[0])
+    shape = image_plane(data).shape
+
+    stack = SynopticStack(shape, list(groups), work_dir=work_dir, block_rows=block_rows)
+    try:
+        for group, group_files in groups.items():
+            noises = [image_noise(fname) for fname in group_files]
+            if None in noises:
+                print(f"No usable noise for every image of {group}, stacking it with uniform weights")
+                stack.weighting[group] = 'uniform'
+                noises = [1.0] * len(group_files)
+            for fname, noise in zip(group_files, noises):
+                weight = 1.0 if weights is None else weights.get(fname, 1.0)
+                stack.add_fits(group, fname, weight=weight, noise=noise)
+        stack.write(out_fits, header)
+        print(f"Stacked {sum(stack.n_images.values())} images into {out_fits}")
+        return dict(stack.n_images)
+    finally:
+        stack.close()
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import socket
+import resource
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# JSON-lines file the records are appended to; inherited by worker processes
+TELEMETRY_ENV = 'EOVSA_SYNOP_TELEMETRY'
+
+_labels = contextvars.ContextVar('telemetry_labels', default={})
+
+
+def configure(path):
+    """
+    Append the stage records of this process and its children to a JSON-lines file.
+
+    Parameters
+    ----------
+    path : str or None
+        Output file, created if needed; None disables recording
+    """
+    if path is None:
+        os.environ.pop(TELEMETRY_ENV, None)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    os.environ[TELEMETRY_ENV] = os.path.abspath(path)
+
+
+@contextmanager
+def labels(**kwargs):
+    """Add labels (e.g. day, scan, spws, interval) to the records of the stages run inside"""
+    token = _labels.set({**_labels.get(), **kwargs})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def set_labels(**kwargs):
+    """Add labels to the records of every later stage in this context, e.g. in a worker process"""
+    _labels.set({**_labels.get(), **kwargs})
+
+
+def _proc_io():
+    """I/O counters of this process from /proc/self/io, empty if unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f)}
+    except (OSError, ValueError):
+        return {}
+
+
+def _snapshot():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.perf_counter(),
+        'cpu': self_usage.ru_utime + self_usage.ru_stime,
+        'cpu_children': child_usage.ru_utime + child_usage.ru_stime,
+        'io': _proc_io(),
+    }
+
+
+def _write_record(path, record):
+    line = json.dumps(record, default=str) + '\n'
+    # a single O_APPEND write keeps lines of concurrent processes whole
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def stage(name, **kwargs):
+    """
+    Time a pipeline stage and append its record to the telemetry file.
+
+    The record holds the stage name, its labels, wall and CPU time (of this
+    process and of waited-for children such as wsclean), the peak RSS of
+    this process and of its children so far, the bytes read and written
+    (read_bytes/write_bytes and rchar/wchar of /proc/self/io) and whether the
+    stage raised. Nothing is measured when no telemetry file is configured.
+
+    Parameters
+    ----------
+    name : str
+        Stage name, e.g. 'imreg'
+    **kwargs
+        Labels of this stage, added to those of the enclosing labels()
+    """
+    path = os.environ.get(TELEMETRY_ENV)
+    if not path:
+        yield
+        return
+    start_time = time.time()
+    before = _snapshot()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        after = _snapshot()
+        record = {
+            'stage': name,
+            'labels': {**_labels.get(), **kwargs},
+            'status': status,
+            'start': start_time,
+            'wall_sec': after['wall'] - before['wall'],
+            'cpu_sec': after['cpu'] - before['cpu'],
+            'cpu_children_sec': after['cpu_children'] - before['cpu_children'],
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        }
+        for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+            if key in before['io'] and key in after['io']:
+                record[key] = after['io'][key] - before['io'][key]
+        _write_record(path, record)
+
+
+def record(name, wall_sec, status='ok', **fields):
+    """
+    Append a record measured elsewhere, e.g. a phase of a wsclean run.
+
+    Parameters
+    ----------
+    name : str
+        Stage name, e.g. 'wsclean:gridding'
+    wall_sec : float
+        Duration of the stage
+    status : str, optional
+        'ok' (default) or e.g. 'stopped'
+    **fields
+        Added to the record
+    """
+    path = os.environ.get(TELEMETRY_ENV)
+    if not path:
+        return
+    _write_record(path, {
+        'stage': name,
+        'labels': dict(_labels.get()),
+        'status': status,
+        'start': time.time() - wall_sec,
+        'wall_sec': wall_sec,
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        **fields,
+    })
+
+
+def timed(name=None, **kwargs):
+    """
+    Decorator running a function as a telemetry stage.
+
+    Parameters
+    ----------
+    name : str, optional
+        Stage name, defaults to the function name
+    **kwargs
+        Labels of the stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **func_kwargs):
+            with stage(name or func.__name__, **kwargs):
+                return func(*args, **func_kwargs)
+        return wrapper
+    return decorator
+
+
+def load_records(path):
+    """Read the records of a telemetry file, skipping incomplete lines"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarize(path, top=10, key='wall_sec'):
+    """
+    Print the slowest stages of every day in a telemetry file.
+
+    Stages are ranked per day by their total of key over all scans, spw
+    groups and intervals, and the slowest single records are listed.
+
+    Parameters
+    ----------
+    path : str
+        Telemetry file
+    top : int, optional
+        Number of stages and records shown per day, defaults to 10
+    key : str, optional
+        Measure ranked by, e.g. 'wall_sec' (default), 'cpu_sec' or 'write_bytes'
+
+    Returns
+    -------
+    dict
+        Per day, the (stage, count, total) tuples in ranking order
+    """
+    by_day = {}
+    for record in load_records(path):
+        by_day.setdefault(record['labels'].get('day', 'unknown'), []).append(record)
+
+    summary = {}
+    for day in sorted(by_day):
+        records = by_day[day]
+        totals = {}
+        for record in records:
+            count, total = totals.get(record['stage'], (0, 0.))
+            totals[record['stage']] = (count + 1, total + record.get(key, 0.))
+        ranking = sorted(((stage_name, count, total) for stage_name, (count, total) in totals.items()),
+                         key=lambda item: -item[2])
+        summary[day] = ranking
+
+        print(f"== {day}: {len(records)} records, ranked by total {key}")
+        for stage_name, count, total in ranking[:top]:
+            print(f"  {stage_name:<24s} {count:6d} x  total {total:12.1f}  mean {total / count:10.1f}")
+        print("  slowest records:")
+        for record in sorted(records, key=lambda r: -r.get(key, 0.))[:top]:
+            label_str = ' '.join(f"{k}={v}" for k, v in record['labels'].items() if k != 'day')
+            print(f"  {record['stage']:<24s} {record.get(key, 0.):12.1f}  {label_str}")
+    return summary
+
+
+if __name__ == "__main__":
+    import sys
+
+    summarize(sys.argv[1] if len(sys.argv) > 1 else "./runtime/telemetry.jsonl")
@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import socket
+from contextlib import contextmanager
+
+# item states, one subdirectory of the queue each
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+def _write_json(path, content):
+    """Write a JSON file atomically, so readers never see it half written."""
+    tmp_file = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmp_file, path)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class WorkQueue:
+    """
+    Work queue kept as JSON files in a directory shared by the workers.
+
+    Every item is a file ``<state>/<item_id>.json``. A worker claims a
+    pending item by renaming it to running/ while holding the queue lock,
+    keeps it alive by touching it (heartbeat), and completes it by moving
+    it to done/. Every claim gets its own claim_id, so a worker whose item
+    was taken back and claimed again can no longer complete or fail it.
+    Items that fail, or whose heartbeat stops for longer than
+    heartbeat_timeout (e.g. a killed worker or a lost node), go back to
+    pending/ until max_attempts is reached and then to failed/. Only
+    rename and lock operations are used, so any number of workers on one
+    or several nodes can share a local or network directory.
+
+    Parameters
+    ----------
+    root : str
+        Queue directory, created if needed
+    heartbeat_timeout : float, optional
+        Seconds without heartbeat after which a running item is taken back,
+        defaults to 900
+    max_attempts : int, optional
+        Number of runs of an item before it is moved to failed/, defaults to 3
+    retry_delay : float, optional
+        Seconds a failed item waits before it can be claimed again, times
+        the number of attempts so far, defaults to 60
+    """
+
+    def __init__(self, root, heartbeat_timeout=900., max_attempts=3, retry_delay=60.):
+        self.root = os.path.abspath(root)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        for state in STATES:
+            os.makedirs(os.path.join(self.root, state), exist_ok=True)
+
+    def _path(self, state, item_id):
+        return os.path.join(self.root, state, item_id + '.json')
+
+    @contextmanager
+    def _lock(self):
+        """Hold the queue lock, serializing claims and the taking back of stale items."""
+        with open(os.path.join(self.root, 'queue.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def item_ids(self, state):
+        """Sorted ids of the items in a state."""
+        return sorted(fname[:-5] for fname in os.listdir(os.path.join(self.root, state))
+                      if fname.endswith('.json'))
+
+    def state_of(self, item_id):
+        """State of an item, None if it is not in the queue."""
+        for state in STATES:
+            if os.path.exists(self._path(state, item_id)):
+                return state
+        return None
+
+    def put(self, item_id, payload, requires=()):
+        """
+        Add an item, unless an item with this id is already in the queue.
+
+        Parameters
+        ----------
+        item_id : str
+            Unique id, also the claim order of the pending items
+        payload : dict
+            JSON-serializable description of the work
+        requires : list of str, optional
+            Items that must be done before this one can be claimed
+
+        Returns
+        -------
+        bool
+            True if the item was added
+        """
+        with self._lock():
+            if self.state_of(item_id) is not None:
+                return False
+            _write_json(self._path('pending', item_id), {
+                'id': item_id, 'payload': payload, 'requires': list(requires),
+                'attempts': 0, 'errors': [], 'created_at': time.time(), 'not_before': 0.,
+            })
+        return True
+
+    def claim(self, worker=None):
+        """
+        Claim the first pending item whose requirements are done.
+
+        Parameters
+        ----------
+        worker : str, optional
+            Name of the claiming worker, defaults to host:pid
+
+        Returns
+        -------
+        dict or None
+            The item, with its 'payload' and the 'worker' and 'claim_id' of
+            this claim, or None if nothing can be claimed now
+        """
+        worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        with self._lock():
+            self._reap_stale()
+            now = time.time()
+            for item_id in self.item_ids('pending'):
+                pending_file = self._path('pending', item_id)
+                try:
+                    item = _read_json(pending_file)
+                except (OSError, ValueError):
+                    continue
+                if item.get('not_before', 0.) > now:
+                    continue
+                if not all(os.path.exists(self._path('done', required)) for required in item['requires']):
+                    continue
+                running_file = self._path('running', item_id)
+                try:
+                    os.rename(pending_file, running_file)
+                except FileNotFoundError:
+                    continue
+                item.update(worker=worker, claim_id=uuid.uuid4().hex, claimed_at=now)
+                _write_json(running_file, item)
+                return item
+        return None
+
+    def _owns(self, item):
+        """True if item is running under the claim it was returned by claim."""
+        try:
+            running = _read_json(self._path('running', item['id']))
+        except (OSError, ValueError):
+            return False
+        return running.get('claim_id') == item.get('claim_id') and running.get('worker') == item.get('worker')
+
+    def heartbeat(self, item):
+        """
+        Mark a claimed item as alive.
+
+        Returns
+        -------
+        bool
+            False if the item is no longer running under this claim, e.g.
+            because it was taken back after a missed heartbeat
+        """
+        if not self._owns(item):
+            return False
+        try:
+            os.utime(self._path('running', item['id']))
+        except OSError:
+            return False
+        return True
+
+    def complete(self, item, result=None):
+        """
+        Move a claimed item to done/, recording its result.
+
+        Returns
+        -------
+        bool
+            False, and nothing is changed, if the item was taken back from
+            this claim (it may be running under another one)
+        """
+        item = dict(item, result=result, completed_at=time.time())
+        with self._lock():
+            if not self._owns(item):
+                print(f"Not completing {item['id']}, it was taken back from {item.get('worker')}")
+                return False
+            _write_json(self._path('done', item['id']), item)
+            os.remove(self._path('running', item['id']))
+        return True
+
+    def fail(self, item, error):
+        """
+        Record a failed run of a claimed item.
+
+        The item goes back to pending/, claimable after retry_delay times
+        its number of attempts, or to failed/ after max_attempts runs.
+
+        Returns
+        -------
+        bool
+            False, and nothing is changed, if the item was taken back from
+            this claim
+        """
+        with self._lock():
+            if not self._owns(item):
+                print(f"Not recording the failure of {item['id']}, it was taken back from {item.get('worker')}")
+                return False
+            self._fail(item, error)
+        return True
+
+    def _fail(self, item, error):
+        running_file = self._path('running', item['id'])
+        item = dict(item, attempts=item.get('attempts', 0) + 1,
+                    errors=item.get('errors', []) + [{'time': time.time(), 'worker': item.get('worker'),
+                                                      'error': str(error)}])
+        if item['attempts'] >= self.max_attempts:
+            _write_json(self._path('failed', item['id']), item)
+        else:
+            item['not_before'] = time.time() + self.retry_delay * item['attempts']
+            _write_json(self._path('pending', item['id']), item)
+        try:
+            os.remove(running_file)
+        except FileNotFoundError:
+            pass
+
+    def _reap_stale(self):
+        """Take back the running items whose heartbeat is older than heartbeat_timeout; call with the lock."""
+        now = time.time()
+        for item_id in self.item_ids('running'):
+            running_file = self._path('running', item_id)
+            try:
+                heartbeat_age = now - os.stat(running_file).st_mtime
+                if heartbeat_age <= self.heartbeat_timeout:
+                    continue
+                item = _read_json(running_file)
+            except (OSError, ValueError):
+                continue
+            print(f"Taking back {item_id}, no heartbeat from {item.get('worker')} for {heartbeat_age:.0f} s")
+            self._fail(item, 'heartbeat lost')
+
+    def reap_stale(self):
+        """Take back the running items whose heartbeat is older than heartbeat_timeout."""
+        with self._lock():
+            self._reap_stale()
+
+    def retry_failed(self):
+        """Move the failed items back to pending/ with a fresh attempt count."""
+        with self._lock():
+            for item_id in self.item_ids('failed'):
+                item = _read_json(self._path('failed', item_id))
+                item.update(attempts=0, not_before=0.)
+                _write_json(self._path('pending', item_id), item)
+                os.remove(self._path('failed', item_id))
+
+    def is_drained(self):
+        """
+        True when nothing is running and no pending item can become claimable,
+        i.e. every pending item waits for an item that has failed.
+        """
+        if self.item_ids('running'):
+            return False
+        for item in self.items('pending'):
+            if not any(os.path.exists(self._path('failed', required)) for required in item['requires']):
+                return False
+        return True
+
+    def items(self, state):
+        """The items in a state."""
+        items = []
+        for item_id in self.item_ids(state):
+            try:
+                items.append(_read_json(self._path(state, item_id)))
+            except (OSError, ValueError):
+                continue
+        return items
+
+    def status(self, straggler_factor=3.):
+        """
+        Counts, throughput and stragglers of the queue.
+
+        Parameters
+        ----------
+        straggler_factor : float, optional
+            A running item is a straggler when it has run longer than this
+            times the median duration of the done items, defaults to 3
+
+        Returns
+        -------
+        dict
+            'counts' per state, 'throughput_per_hour' over the last hour and
+            overall, 'median_sec' of the done items, 'workers' seen in the
+            last heartbeat_timeout and the 'stragglers' (id, worker, seconds
+            running, seconds since heartbeat)
+        """
+        now = time.time()
+        counts = {state: len(self.item_ids(state)) for state in STATES}
+        done = self.items('done')
+        durations = sorted(item['completed_at'] - item['claimed_at'] for item in done if 'claimed_at' in item)
+        median_sec = durations[len(durations) // 2] if durations else None
+        throughput = {'last_hour': sum(1 for item in done if now - item['completed_at'] <= 3600)}
+        if done:
+            first = min(item.get('claimed_at', item['completed_at']) for item in done)
+            last = max(item['completed_at'] for item in done)
+            throughput['overall'] = len(done) / max(last - first, 1.) * 3600
+        else:
+            throughput['overall'] = 0.
+
+        stragglers, workers = [], set()
+        for item_id in self.item_ids('running'):
+            running_file = self._path('running', item_id)
+            try:
+                item = _read_json(running_file)
+                heartbeat_age = now - os.stat(running_file).st_mtime
+            except (OSError, ValueError):
+                continue
+            if heartbeat_age <= self.heartbeat_timeout:
+                workers.add(item.get('worker'))
+            running_sec = now - item.get('claimed_at', now)
+            if (median_sec is not None and running_sec > straggler_factor * median_sec) or \
+                    heartbeat_age > self.heartbeat_timeout:
+                stragglers.append((item_id, item.get('worker'), running_sec, heartbeat_age))
+        return {'counts': counts, 'throughput_per_hour': throughput, 'median_sec': median_sec,
+                'workers': sorted(workers), 'stragglers': stragglers}
@@ -1,5 +1,41 @@
+import queue
+import threading
 import subprocess
-from typing import List, Optional, Union
+from glob import glob
+from typing import Callable, List, Optional, Union
+
+from eovsa_synop.telemetry import stage, record
+from eovsa_synop.wsclean_progress import parse_line, ProgressTracker
+
+
+def _read_lines(stream, lines: queue.Queue):
+    """Move the lines of a pipe to a queue, None at the end"""
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+class WSCleanError(RuntimeError):
+    """
+    wsclean exited with an error, or was stopped
+
+    Attributes:
+    -----------
+    returncode : int
+        Return code of wsclean
+    stop_reason : str or None
+        Why the run was stopped (see ProgressTracker.check), None if it failed
+    """
+
+    def __init__(self, argv: List[str], returncode: int, stop_reason: Optional[str] = None):
+        self.returncode = returncode
+        self.stop_reason = stop_reason
+        if stop_reason is None:
+            message = f"{argv[0]} exited with code {returncode}"
+        else:
+            message = f"{argv[0]} was stopped: {stop_reason}"
+        super().__init__(message)
+
 
 class WSClean:
     def __init__(self, vis: str):
@@ -23,8 +59,13 @@ class WSClean:
             'multiscale': False,         # default no multiscale
             'local_rms': False,          # default no local rms
             'no_update_model': False,    # default update model
-            'no_negative': False         # default allow negative
+            'no_negative': False,        # default allow negative
+            'quiet': False               # default print wsclean output
         }
+        # selection whose reordered files were saved by the last imaging run, per temp_dir
+        self._reordered_selections = {}
+        # ProgressTracker.report of the last run or predict
+        self.progress = None
 
     def setup(self, **kwargs):
         """
@@ -58,12 +99,45 @@ class WSClean:
             Disable model data updates
         intervals_out : int, optional
             Number of time intervals
+        interval : tuple of int, optional
+            (start, end) timestep indices of the data imaged, end exclusive
+        channels_out : int, optional
+            Number of output channels
+        channel_division_frequencies : list, optional
+            Frequencies in Hz at which the bandwidth is split into channels
         spws : list or str, optional
             Spectral windows to image
         pol : str, optional
             Polarization to image
         no_negative : bool, optional
             Prevent negative components
+        quiet : bool, optional
+            Do not echo wsclean output, it is still parsed for progress
+        threads : int, optional
+            Number of threads wsclean may use (-j)
+        parallel_gridding : int, optional
+            Number of parallel gridders (-parallel-gridding)
+        parallel_deconvolution : int, optional
+            Sub-image size for parallel deconvolution (-parallel-deconvolution)
+        abs_mem : float, optional
+            Memory limit in GB (-abs-mem)
+        temp_dir : str, optional
+            Directory for temporary and reordered files (-temp-dir), e.g. on
+            local scratch or tmpfs
+        save_reordered : bool, optional
+            Keep the reordered files in temp_dir for a following predict of
+            the same selection; give every selection its own temp_dir
+        timeout : float, optional
+            Wall-clock seconds after which a run or predict is stopped
+        phase_timeouts : dict, optional
+            Seconds allowed per phase of a run, e.g. {'reorder': 600}, see
+            wsclean_progress for the phase names
+        stall_cycles : int, optional
+            Stop the run when the residual peak has not improved over this
+            many major cycles
+        min_improvement : float, optional
+            Relative decrease of the peak that counts as an improvement
+            (default: 0.01)
         """
         # Handle size parameter specially
         if 'size' in kwargs:
@@ -82,12 +156,35 @@ class WSClean:
 
     def build_command(self) -> str:
         """Build wsclean command"""
+        return ' '.join(self.build_argv())
+
+    def build_argv(self) -> List[str]:
+        """Build wsclean argument list"""
         cmd = ['wsclean']
         
         # Add basic parameters
         cmd.extend(['-size', str(self.params['size'][0]), str(self.params['size'][1])])
         cmd.extend(['-scale', self.params['scale']])
         cmd.extend(['-weight', 'briggs', str(self.params['weight_briggs'])])
+        cmd.extend(['-data-column', self.params['data_column']])
+
+        if 'threads' in self.params:
+            cmd.extend(['-j', str(self.params['threads'])])
+
+        if 'parallel_gridding' in self.params:
+            cmd.extend(['-parallel-gridding', str(self.params['parallel_gridding'])])
+
+        if 'parallel_deconvolution' in self.params:
+            cmd.extend(['-parallel-deconvolution', str(self.params['parallel_deconvolution'])])
+
+        if 'abs_mem' in self.params:
+            cmd.extend(['-abs-mem', str(self.params['abs_mem'])])
+
+        if 'temp_dir' in self.params:
+            cmd.extend(['-temp-dir', self.params['temp_dir']])
+
+        if self.params.get('save_reordered') and 'temp_dir' in self.params:
+            cmd.extend(['-reorder', '-save-reordered'])
         
         if self.params['niter'] > 0:
             cmd.extend(['-niter', str(self.params['niter'])])
@@ -119,8 +216,10 @@ class WSClean:
         if 'intervals_out' in self.params:
             cmd.extend(['-intervals-out', str(self.params['intervals_out'])])
 
-        if self.params['quiet']:
-            cmd.append('-quiet')
+        if 'interval' in self.params:
+            cmd.extend(['-interval', str(self.params['interval'][0]), str(self.params['interval'][1])])
+
+        cmd.extend(self._channel_argv())
 
         if 'spws' in self.params:
             spws = self.params['spws']
@@ -131,9 +230,9 @@ class WSClean:
         cmd.extend(['-name', self.params['name']])
         cmd.append(self.vis)
         
-        return ' '.join(cmd)
+        return cmd
     
-    def run(self, dryrun: bool = False) -> int:
+    def run(self, dryrun: bool = False, on_event: Optional[Callable] = None, check: bool = False) -> int:
         """
         Run wsclean command
         
@@ -141,11 +240,17 @@ class WSClean:
         -----------
         dryrun : bool, optional
             If True, only print the command without executing
+        on_event : callable, optional
+            Called with every progress event of the run, see
+            wsclean_progress.parse_line
+        check : bool, optional
+            Raise WSCleanError when wsclean fails or is stopped
             
         Returns:
         --------
         int
-            Return code from wsclean execution
+            Return code from wsclean execution, negative when the run was
+            stopped (the reason is in self.progress['stop_reason'])
         """
         cmd = self.build_command()
         
@@ -154,8 +259,233 @@ class WSClean:
             return 0
             
         print(f"Running: {cmd}")
-        process = subprocess.run(cmd, shell=True)
-        return process.returncode
+        argv = self.build_argv()
+        returncode = self._execute(argv, 'wsclean', on_event=on_event)
+        self._after_run(returncode)
+        if check:
+            self._check(argv, returncode)
+        return returncode
+
+    def _check(self, argv: List[str], returncode: int):
+        """Raise WSCleanError for a failed or stopped run"""
+        if returncode != 0 or self.progress['stop_reason'] is not None:
+            raise WSCleanError(argv, returncode, self.progress['stop_reason'])
+
+    def _execute(self, argv: List[str], stage_name: str, on_event: Optional[Callable] = None) -> int:
+        """
+        Run wsclean, parsing its output as it comes
+
+        The run is stopped (terminated, then killed) when the ProgressTracker
+        built from the timeout, phase_timeouts, stall_cycles and
+        min_improvement parameters gives a reason. The seconds spent in
+        every phase are recorded as telemetry stages '<stage_name>:<phase>'.
+        """
+        tracker = ProgressTracker(timeout=self.params.get('timeout'),
+                                  phase_timeouts=self.params.get('phase_timeouts'),
+                                  stall_cycles=self.params.get('stall_cycles'),
+                                  min_improvement=self.params.get('min_improvement', 0.01))
+        with stage(stage_name):
+            process = subprocess.Popen(argv, stdout=subprocess.PIPE, text=True, errors='replace', bufsize=1)
+            lines = queue.Queue()
+            reader = threading.Thread(target=_read_lines, args=(process.stdout, lines), daemon=True)
+            reader.start()
+            while True:
+                try:
+                    line = lines.get(timeout=1.)
+                except queue.Empty:
+                    line = ''
+                if line is None:
+                    break
+                if line:
+                    if not self.params['quiet']:
+                        print(line, end='')
+                    event = parse_line(line)
+                    if event is not None:
+                        tracker.update(event)
+                        if on_event is not None:
+                            on_event(event)
+                if tracker.check() is not None:
+                    print(f"Stopping wsclean after {tracker.elapsed():.0f} s in {tracker.phase}: "
+                          f"{tracker.stop_reason}")
+                    process.terminate()
+                    try:
+                        process.wait(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                    break
+            returncode = process.wait()
+            reader.join(timeout=5)
+            tracker.finish()
+        self.progress = tracker.report()
+        status = 'ok' if returncode == 0 else ('stopped' if tracker.stop_reason else 'error')
+        for phase, seconds in tracker.phase_times.items():
+            record(f'{stage_name}:{phase}', seconds, status=status)
+        return returncode
+
+    def _channel_argv(self) -> List[str]:
+        """Output channel arguments, shared by imaging and predict"""
+        cmd = []
+        if 'channels_out' in self.params:
+            cmd.extend(['-channels-out', str(self.params['channels_out'])])
+        if 'channel_division_frequencies' in self.params:
+            freqs = self.params['channel_division_frequencies']
+            cmd.extend(['-channel-division-frequencies', ','.join(f"{f:.0f}" for f in freqs)])
+        return cmd
+
+    def setup_spw_groups(self, spw_groups: List[str], spw_freqs: List):
+        """
+        Image several spectral window groups in one run, one output channel per group
+
+        The bandwidth is split halfway between the last spw of a group and
+        the first spw of the next one, so output channel k holds group k.
+
+        Parameters:
+        -----------
+        spw_groups : list of str
+            Comma separated spectral windows per group, in increasing frequency
+        spw_freqs : list of array
+            Channel frequencies in Hz of every spectral window of the MS
+        """
+        groups = [[int(spw) for spw in str(group).split(',')] for group in spw_groups]
+        bounds = [(min(min(spw_freqs[spw]) for spw in group), max(max(spw_freqs[spw]) for spw in group))
+                  for group in groups]
+        for (_, hi), (lo, _) in zip(bounds[:-1], bounds[1:]):
+            if lo <= hi:
+                raise ValueError("spw groups must be disjoint and in increasing frequency")
+
+        self.setup(spws=','.join(','.join(map(str, group)) for group in groups),
+                   channels_out=len(groups),
+                   channel_division_frequencies=[(hi + lo) / 2 for (_, hi), (lo, _) in zip(bounds[:-1], bounds[1:])])
+        return self
+
+    @staticmethod
+    def output_name(name: str, interval: int = 0, channel: int = 0,
+                    intervals_out: int = 1, channels_out: int = 1) -> str:
+        """
+        Prefix wsclean uses for the images of one interval and output channel
+
+        e.g. "name-t0001-0002" with several intervals and channels, "name" with one of each
+        """
+        if intervals_out > 1:
+            name += f"-t{interval:04d}"
+        if channels_out > 1:
+            name += f"-{channel:04d}"
+        return name
+
+    def _selection(self, spws=None, pol=None, intervals_out=None, interval=None) -> tuple:
+        """Data selection that determines the content of reordered files"""
+        if isinstance(spws, list):
+            spws = ','.join(map(str, spws))
+        if interval is not None:
+            interval = tuple(interval)
+        return (self.vis, spws, pol, intervals_out or 1, interval, self.params.get('channels_out'))
+
+    def _after_run(self, returncode: int):
+        """Remember which selection has reordered files saved in temp_dir by a successful imaging run"""
+        if 'temp_dir' not in self.params:
+            return
+        if returncode == 0 and self.params.get('save_reordered'):
+            self._reordered_selections[self.params['temp_dir']] = self._selection(
+                self.params.get('spws'), self.params.get('pol'), self.params.get('intervals_out'),
+                self.params.get('interval'))
+        else:
+            self._reordered_selections.pop(self.params['temp_dir'], None)
+
+    def build_predict_argv(self, name: Optional[str] = None, intervals_out: Optional[int] = None,
+                           spws: Optional[Union[list, str]] = None, pol: Optional[str] = None,
+                           interval: Optional[tuple] = None) -> List[str]:
+        """
+        Build wsclean -predict argument list
+
+        The temp directory and thread count of the imaging setup are shared.
+        The reordered files saved in the temp directory by an imaging run are
+        reused when the predict selects the same spws, polarization, timesteps
+        and intervals; otherwise the MS is reordered again.
+        """
+        spws = self.params.get('spws') if spws is None else spws
+        cmd = ['wsclean', '-predict']
+
+        if 'threads' in self.params:
+            cmd.extend(['-j', str(self.params['threads'])])
+
+        if 'temp_dir' in self.params:
+            cmd.extend(['-temp-dir', self.params['temp_dir']])
+
+        saved = self._reordered_selections.get(self.params.get('temp_dir'))
+        if saved is not None and saved == self._selection(spws, pol, intervals_out, interval):
+            cmd.append('-reuse-reordered')
+        else:
+            cmd.append('-reorder')
+
+        if pol is not None:
+            cmd.extend(['-pol', pol])
+
+        if spws is not None:
+            if isinstance(spws, list):
+                spws = ','.join(map(str, spws))
+            cmd.extend(['-spws', spws])
+
+        if intervals_out is not None:
+            cmd.extend(['-intervals-out', str(intervals_out)])
+
+        if interval is not None:
+            cmd.extend(['-interval', str(interval[0]), str(interval[1])])
+
+        cmd.extend(self._channel_argv())
+
+        cmd.extend(['-name', name or self.params['name']])
+        cmd.append(self.vis)
+
+        return cmd
+
+    def predict(self, name: Optional[str] = None, intervals_out: Optional[int] = None,
+                spws: Optional[Union[list, str]] = None, pol: Optional[str] = None,
+                interval: Optional[tuple] = None, dryrun: bool = False,
+                on_event: Optional[Callable] = None, check: bool = False) -> int:
+        """
+        Predict model visibilities into MODEL_DATA from model images
+
+        Parameters:
+        -----------
+        name : str, optional
+            Name prefix of the model images (default: the imaging name)
+        intervals_out : int, optional
+            Number of time intervals, one model image each
+        spws : list or str, optional
+            Spectral windows to predict (default: the imaging spws)
+        pol : str, optional
+            Polarization to predict (default: wsclean's default)
+        interval : tuple of int, optional
+            (start, end) timestep indices predicted, end exclusive (default: all)
+        dryrun : bool, optional
+            If True, only print the command without executing
+        on_event : callable, optional
+            Called with every progress event of the predict
+        check : bool, optional
+            Raise WSCleanError when the predict fails or is stopped
+
+        Returns:
+        --------
+        int
+            Return code from wsclean execution, negative when it was stopped
+        """
+        argv = self.build_predict_argv(name=name, intervals_out=intervals_out, spws=spws, pol=pol,
+                                       interval=interval)
+        cmd = ' '.join(argv)
+
+        if dryrun:
+            print(f"Would run: {cmd}")
+            return 0
+
+        print(f"Running: {cmd}")
+        returncode = self._execute(argv, 'wsclean_predict', on_event=on_event)
+        if check:
+            self._check(argv, returncode)
+        return returncode
+
+    def output_files(self) -> List[str]:
+        """List the FITS files written under the output name prefix"""
+        return sorted(glob(self.params['name'] + '-*.fits'))
 
 # Example usage:
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+import re
+import time
+
+# flux density units of the wsclean log, in Jy
+_UNITS = {'KJy': 1e3, 'Jy': 1., 'mJy': 1e-3, 'µJy': 1e-6, 'uJy': 1e-6, 'nJy': 1e-9}
+_FLUX = r'(-?[\d.]+(?:e[-+]?\d+)?)\s*(KJy|Jy|mJy|µJy|uJy|nJy)'
+
+# log lines that start a phase of a run
+_PHASES = [
+    (re.compile(r'^Reordering '), 'reorder'),
+    (re.compile(r'== Constructing PSF =='), 'psf'),
+    (re.compile(r'== Constructing image =='), 'gridding'),
+    (re.compile(r'== Deconvolving \((\d+)\) =='), 'deconvolution'),
+    (re.compile(r'== Converting model image to visibilities =='), 'predict'),
+    (re.compile(r'^Writing '), 'writing'),
+]
+_ITERATION = re.compile(r'^Iteration (\d+)(?:, scale \d+ px)?\s*:\s*' + _FLUX)
+_INITIAL_PEAK = re.compile(r'^Initial peak:\s*' + _FLUX)
+_NOISE = re.compile(r'standard deviation of background noise:\s*' + _FLUX)
+_THRESHOLD = re.compile(r'^Next major (?:iteration|cycle) at:?\s*' + _FLUX)
+_STOPPED = re.compile(r'^Stopped on peak\s*' + _FLUX + r',?\s*(.*)')
+_AUTO_MASK = re.compile(r'^Auto-masking threshold reached')
+_SUMMARY = re.compile(r'^Inversion: ([\d:.]+), prediction: ([\d:.]+), deconvolution: ([\d:.]+)')
+
+
+def _flux(value, unit):
+    return float(value) * _UNITS[unit]
+
+
+def _duration(value):
+    """Seconds of a wsclean duration such as 0:01:05.61"""
+    seconds = 0.
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_line(line):
+    """
+    Structured event of a wsclean log line.
+
+    Parameters
+    ----------
+    line : str
+        One line of wsclean's standard output
+
+    Returns
+    -------
+    dict or None
+        The event, with an 'event' key: 'phase' (with 'phase' and, for
+        deconvolution, the 'major_cycle' number), 'peak' (with 'peak' in Jy
+        and the minor 'iteration' when given), 'noise', 'threshold' (the
+        peak where the next major cycle starts), 'auto_mask' (the mask
+        threshold was reached), 'stopped' (with the 'peak' and 'reason' a
+        minor loop stopped on) or 'summary' (the inversion, prediction and
+        deconvolution seconds wsclean reports at the end). None for lines
+        that carry no progress.
+    """
+    line = line.strip()
+    for pattern, phase in _PHASES:
+        match = pattern.search(line)
+        if match:
+            event = {'event': 'phase', 'phase': phase}
+            if phase == 'deconvolution':
+                event['major_cycle'] = int(match.group(1))
+            return event
+    match = _ITERATION.match(line)
+    if match:
+        return {'event': 'peak', 'iteration': int(match.group(1)), 'peak': _flux(*match.group(2, 3))}
+    match = _INITIAL_PEAK.match(line)
+    if match:
+        return {'event': 'peak', 'iteration': 0, 'peak': _flux(*match.group(1, 2))}
+    match = _NOISE.search(line)
+    if match:
+        return {'event': 'noise', 'noise': _flux(*match.group(1, 2))}
+    match = _THRESHOLD.match(line)
+    if match:
+        return {'event': 'threshold', 'threshold': _flux(*match.group(1, 2))}
+    match = _STOPPED.match(line)
+    if match:
+        return {'event': 'stopped', 'peak': _flux(*match.group(1, 2)), 'reason': match.group(3).rstrip('.')}
+    if _AUTO_MASK.match(line):
+        return {'event': 'auto_mask'}
+    match = _SUMMARY.match(line)
+    if match:
+        return {'event': 'summary', 'inversion_sec': _duration(match.group(1)),
+                'prediction_sec': _duration(match.group(2)), 'deconvolution_sec': _duration(match.group(3))}
+    return None
+
+
+class ProgressTracker:
+    """
+    State of a running wsclean job, built from its events.
+
+    Tracks the current phase and major cycle, the time spent in every
+    phase, the residual peak at the start of every major cycle and the
+    latest threshold, and decides when the run should be stopped.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Wall-clock seconds after which the run is stopped
+    phase_timeouts : dict, optional
+        Seconds allowed per phase, e.g. {'reorder': 600}
+    stall_cycles : int, optional
+        Stop when the residual peak has not improved over this many major
+        cycles; None (default) never stops on the peak
+    min_improvement : float, optional
+        Relative decrease of the best peak that counts as an improvement,
+        defaults to 0.01
+    """
+
+    def __init__(self, timeout=None, phase_timeouts=None, stall_cycles=None, min_improvement=0.01):
+        self.timeout = timeout
+        self.phase_timeouts = phase_timeouts or {}
+        self.stall_cycles = stall_cycles
+        self.min_improvement = min_improvement
+        self.start = time.perf_counter()
+        self.phase = 'startup'
+        self.phase_start = self.start
+        self.phase_times = {}
+        self.major_cycle = 0
+        self.cycle_peaks = []
+        self.peak = None
+        self.threshold = None
+        self.noise = None
+        self.summary = None
+        self.stop_reason = None
+
+    def elapsed(self, now=None):
+        """Seconds since the run started"""
+        return (time.perf_counter() if now is None else now) - self.start
+
+    def _close_phase(self, now):
+        self.phase_times[self.phase] = self.phase_times.get(self.phase, 0.) + now - self.phase_start
+        self.phase_start = now
+
+    def update(self, event, now=None):
+        """Take an event of parse_line into account, and stamp it with its 'time' in the run"""
+        now = time.perf_counter() if now is None else now
+        event['time'] = now - self.start
+        if event['event'] == 'phase':
+            self._close_phase(now)
+            self.phase = event['phase']
+            if 'major_cycle' in event:
+                self.major_cycle = event['major_cycle']
+                self.cycle_peaks.append(None)
+        elif event['event'] == 'peak':
+            self.peak = event['peak']
+            if self.cycle_peaks and self.cycle_peaks[-1] is None:
+                self.cycle_peaks[-1] = event['peak']
+        elif event['event'] == 'threshold':
+            self.threshold = event['threshold']
+        elif event['event'] == 'noise':
+            self.noise = event['noise']
+        elif event['event'] == 'summary':
+            self.summary = {key: value for key, value in event.items() if key.endswith('_sec')}
+        return event
+
+    def finish(self, now=None):
+        """Close the current phase when the run ended"""
+        self._close_phase(time.perf_counter() if now is None else now)
+
+    def stalled(self):
+        """True if the peak at the start of the last stall_cycles major cycles did not improve on the best before"""
+        peaks = [peak for peak in self.cycle_peaks if peak is not None]
+        if self.stall_cycles is None or len(peaks) <= self.stall_cycles:
+            return False
+        best_before = min(abs(peak) for peak in peaks[:-self.stall_cycles])
+        return min(abs(peak) for peak in peaks[-self.stall_cycles:]) > best_before * (1 - self.min_improvement)
+
+    def check(self, now=None):
+        """
+        Reason to stop the run now, None to let it continue.
+
+        Returns
+        -------
+        str or None
+            'timeout', 'phase_timeout:<phase>' or 'stalled'
+        """
+        now = time.perf_counter() if now is None else now
+        if self.timeout is not None and now - self.start > self.timeout:
+            self.stop_reason = 'timeout'
+        elif self.phase in self.phase_timeouts and now - self.phase_start > self.phase_timeouts[self.phase]:
+            self.stop_reason = f'phase_timeout:{self.phase}'
+        elif self.stalled():
+            self.stop_reason = 'stalled'
+        return self.stop_reason
+
+    def report(self):
+        """Summary of the run: phase seconds, major cycles, peaks, threshold and stop reason"""
+        return {
+            'elapsed_sec': self.elapsed(),
+            'phase_sec': dict(self.phase_times),
+            'major_cycles': self.major_cycle,
+            'cycle_peaks': list(self.cycle_peaks),
+            'peak': self.peak,
+            'threshold': self.threshold,
+            'noise': self.noise,
+            'wsclean_sec': self.summary,
+            'stop_reason': self.stop_reason,
+        }
@@ -0,0 +1,145 @@
+import os
+import copy
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+from eovsa_synop.wrap_wsclean import WSClean
+from eovsa_synop.telemetry import labels
+
+
+class WSCleanResult:
+    """
+    Outcome of one wsclean run.
+
+    Attributes:
+    -----------
+    returncode : int
+        Exit code of wsclean
+    wall_time : float
+        Wall-clock duration of the run in seconds
+    outputs : list of str
+        FITS files written under the output name prefix
+    argv : list of str
+        Command line that was run
+    progress : dict
+        ProgressTracker.report of the run, with the stop reason if it was stopped
+    job : WSClean
+        The copy of the submitted object that ran, e.g. for a predict that
+        reuses its reordered files
+    """
+
+    def __init__(self, returncode: int, wall_time: float, outputs: List[str], argv: List[str],
+                 progress: Optional[dict] = None, job: Optional[WSClean] = None):
+        self.returncode = returncode
+        self.wall_time = wall_time
+        self.outputs = outputs
+        self.argv = argv
+        self.progress = progress
+        self.job = job
+
+    def __repr__(self):
+        return (f"WSCleanResult(returncode={self.returncode}, wall_time={self.wall_time:.1f}, "
+                f"outputs={len(self.outputs)} files)")
+
+
+class WSCleanRunner:
+    def __init__(self, max_cores: Optional[int] = None, max_mem_gb: Optional[float] = None):
+        """
+        Run several WSClean instances concurrently within a core and memory budget.
+
+        A job starts only when its cores and memory fit into what the running
+        jobs leave free; the allocation is passed to wsclean as -j and -abs-mem
+        so it does not use more than it was given.
+
+        Parameters:
+        -----------
+        max_cores : int, optional
+            Total number of cores shared by all jobs (default: all cores)
+        max_mem_gb : float, optional
+            Total memory in GB shared by all jobs (default: no limit)
+        """
+        self.max_cores = max_cores or os.cpu_count() or 1
+        self.max_mem_gb = max_mem_gb
+        self._cores_free = self.max_cores
+        self._mem_free = max_mem_gb
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_cores)
+
+    def submit(self, clean_obj: WSClean, cores: Optional[int] = None,
+               mem_gb: Optional[float] = None) -> Future:
+        """
+        Queue a configured WSClean object for execution.
+
+        The job is a copy of clean_obj taken now, with its argument list
+        built, so clean_obj is left unchanged and may be reconfigured and
+        submitted again while the job waits in the queue.
+
+        Parameters:
+        -----------
+        clean_obj : WSClean
+            Configured wsclean job
+        cores : int, optional
+            Cores for this job (default: its 'threads' parameter, else 1)
+        mem_gb : float, optional
+            Memory for this job in GB (default: its 'abs_mem' parameter,
+            else an equal share of max_mem_gb per core)
+
+        Returns:
+        --------
+        concurrent.futures.Future
+            Resolves to a WSCleanResult
+        """
+        cores = min(int(cores or clean_obj.params.get('threads', 1)), self.max_cores)
+        if mem_gb is None:
+            mem_gb = clean_obj.params.get('abs_mem')
+        if self.max_mem_gb is not None:
+            if mem_gb is None:
+                mem_gb = self.max_mem_gb * cores / self.max_cores
+            mem_gb = min(mem_gb, self.max_mem_gb)
+
+        job = copy.deepcopy(clean_obj)
+        job.setup(threads=cores)
+        if mem_gb is not None:
+            job.setup(abs_mem=mem_gb)
+        return self._pool.submit(self._run, job, job.build_argv(), cores, mem_gb)
+
+    def _acquire(self, cores, mem_gb):
+        with self._cond:
+            while cores > self._cores_free or (
+                    self._mem_free is not None and mem_gb is not None and mem_gb > self._mem_free + 1e-9):
+                self._cond.wait()
+            self._cores_free -= cores
+            if self._mem_free is not None and mem_gb is not None:
+                self._mem_free -= mem_gb
+
+    def _release(self, cores, mem_gb):
+        with self._cond:
+            self._cores_free += cores
+            if self._mem_free is not None and mem_gb is not None:
+                self._mem_free += mem_gb
+            self._cond.notify_all()
+
+    def _run(self, job, argv, cores, mem_gb):
+        self._acquire(cores, mem_gb)
+        try:
+            print(f"Running: {' '.join(argv)}")
+            t_start = time.time()
+            with labels(cores=cores, mem_gb=mem_gb):
+                returncode = job._execute(argv, 'wsclean')
+            wall_time = time.time() - t_start
+        finally:
+            self._release(cores, mem_gb)
+        job._after_run(returncode)
+        return WSCleanResult(returncode, wall_time, job.output_files(), argv, progress=job.progress, job=job)
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting jobs, optionally waiting for the queued ones"""
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(wait=True)
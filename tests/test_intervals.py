@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from eovsa_synop.intervals import plan_intervals
+
+FULL_PER_STEP = 78 * 4 * 50
+
+
+def covered(plan, n_steps):
+    """Timesteps inside the imaging intervals of a plan"""
+    mask = np.zeros(n_steps, dtype=bool)
+    for interval in plan:
+        mask[slice(*interval['index'])] = True
+    return mask
+
+
+@pytest.mark.parametrize('dt', [1., 4.])
+def test_unflagged_scan_fully_covered(dt):
+    # every scan length from min_fill * interval_sec up, across the interval boundaries
+    for duration in np.arange(1500., 20000., 50.):
+        times = 5e9 + np.arange(0., duration, dt)
+        counts = np.full(len(times), FULL_PER_STEP)
+        plan = plan_intervals(times, counts, full_per_step=FULL_PER_STEP)
+        assert covered(plan, len(times)).all(), duration
+        for interval in plan:
+            i0, i1 = interval['index']
+            assert times[i1 - 1] - times[i0] + dt <= 3000.
+            assert interval['fill'] >= 0.75
+
+
+def test_short_scan_dropped():
+    times = np.arange(0., 1400., 1.)
+    assert plan_intervals(times, np.full(len(times), FULL_PER_STEP), full_per_step=FULL_PER_STEP) == []
+
+
+def test_unflagged_data_around_gaps_covered():
+    for gap in (500., 2000., 4000.):
+        for duration in (1000., 2500., 4100.):
+            times = np.arange(0., 2 * duration + gap, 1.)
+            counts = np.full(len(times), FULL_PER_STEP)
+            in_gap = (times >= duration) & (times < duration + gap)
+            counts[in_gap] = 0
+            mask = covered(plan_intervals(times, counts, full_per_step=FULL_PER_STEP), len(times))
+            assert mask[~in_gap].all(), (gap, duration)
+
+
+def test_flagged_stretch_dropped():
+    # a stretch with 90% of its visibilities flagged, too long to merge
+    times = np.arange(0., 9000., 1.)
+    counts = np.full(len(times), FULL_PER_STEP)
+    counts[3000:9000] = FULL_PER_STEP // 10
+    plan = plan_intervals(times, counts, full_per_step=FULL_PER_STEP)
+    assert covered(plan, len(times))[:3000].all()
+    assert all(interval['index'][1] <= 3000 or interval['fill'] >= 0.75 for interval in plan)